@@ -117,7 +117,7 @@ await cl.delete_recs_wait(domains="$event/measurement/testdata")
 events
 # %%
 ev = IndraEvent()
-vars(ev)
+ev.to_dict()
 # %%
-ev.__dict__
+ev.as_dict()
 # %%
@@ -7,7 +7,7 @@ import json
 import time
 import datetime
 from datetime import timezone
-from typing import TypedDict, cast
+from typing import Any, TypedDict, cast
 
 from .indra_event import IndraEvent
 from .indra_time import IndraTime
@@ -27,10 +27,19 @@ class IndraClient:
         verbose: bool =False,
         module_name: str | None =None,
         log_handler: logging.Handler | None =None,
+        wire_codec: str = "json",
     ):
         self.log: logging.Logger = logging.getLogger("IndraClient")
         if log_handler is not None:
             self.log.addHandler(log_handler)
+        # "msgpack" sends binary frames, the server replies with the codec the client uses
+        if wire_codec not in IndraEvent.wire_codecs:
+            self.log.error(f"Invalid wire_codec {wire_codec}, using json")
+            wire_codec = "json"
+        elif wire_codec == "msgpack" and IndraEvent.msgpack_available() is False:
+            self.log.error("wire_codec msgpack requires the msgpack module, using json")
+            wire_codec = "json"
+        self.wire_codec: str = wire_codec
         if module_name is None:
             self.module_name: str = "IndraClient (python)"
         else:
@@ -46,7 +55,7 @@ class IndraClient:
         self.error_shown: bool = False
         self.profiles: Profiles = Profiles()
         self.uri: str | None = None
-        if profile is not None and Profile.check_profile(profile) is False:
+        if profile is not None and Profiles.check_profile(profile) is False:
             self.log.error(f"Invalid profile {profile}")
             self.profile: Profile | None = None
             return
@@ -115,15 +124,18 @@ class IndraClient:
         while self.websocket is not None:
             try:
                 message_raw = await self.websocket.recv()
-                message = str(message_raw)
                 if self.verbose is True:
-                    self.log.info(f"Received message: {message}")
+                    self.log.info(f"Received message: {message_raw!r}")
             except Exception as e:
                 self.log.error(f"Could not receive message: {e}, exiting recv_task()")
                 self.recv_task = None
                 return False
             # ie = IndraEvent()
-            ie = IndraEvent.from_json(message)
+            try:
+                ie = IndraEvent.from_wire(message_raw)
+            except Exception as e:
+                self.log.error(f"Could not decode message: {e}")
+                continue
             if ie.uuid4 in self.trx:
                 fRec: IeFutureTable = cast(IeFutureTable, self.trx[ie.uuid4])
                 dt: float = time.time() - fRec["start_time"]
@@ -174,7 +186,7 @@ class IndraClient:
         else:
             replyEventFuture = None
         try:
-            await self.websocket.send(event.to_json())
+            await self.websocket.send(event.to_wire(self.wire_codec))
         except Exception as e:
             self.log.error(f"Could not send message: {e}")
             self.initialized = False
@@ -252,7 +264,7 @@ class IndraClient:
             ie.data = json.dumps(domains)
         else:
             ie.data = json.dumps([domains])
-        await self.websocket.send(ie.to_json())
+        await self.websocket.send(ie.to_wire(self.wire_codec))
         return True
 
     async def unsubscribe(self, domains: str | list[str] | None):
@@ -278,14 +290,22 @@ class IndraClient:
             ie.data = json.dumps(domains)
         else:
             ie.data = json.dumps([domains])
-        await self.websocket.send(ie.to_json())
+        await self.websocket.send(ie.to_wire(self.wire_codec))
         return True
 
     async def get_history(
-        self, domain: str | None, start_time: float | None =None, end_time: float | None =None, sample_size: int | None =None, mode: str ="Sample"
+        self, domain: str | None, start_time: float | None =None, end_time: float | None =None, sample_size: int | None =None, mode: str ="Sample",
+        page_size: int | None = None, cursor: list[float] | None = None
     ):
         """Get history of domain
 
+        mode is one of Sample, Sequential (up to sample_size events), or Min, Max, Mean, Count,
+        First, Last, LTTB (server-side reduction to sample_size points).
+
+        If page_size is given, Sequential (and unlimited Sample) requests are answered page by page:
+        the reply is a json/historypage object {"history": [...], "cursor": cursor}, the next page
+        is requested with that cursor, a cursor of None marks the last page.
+
         returns a future object, which will be set when the reply is received
         """
         cmd = {
@@ -296,6 +316,9 @@ class IndraClient:
             # "data_type": "number/float%",
             "mode": mode,
         }
+        if page_size is not None:
+            cmd["page_size"] = page_size
+            cmd["cursor"] = cursor
         ie = IndraEvent()
         ie.domain = "$trx/db/req/history"
         ie.from_id = "ws/python"
@@ -308,14 +331,38 @@ class IndraClient:
         return await self.send_event(ie)
 
     async def get_wait_history(
-        self, domain: str | None, start_time: float | None =None, end_time: float | None =None, sample_size: int | None =None, mode: str ="Sample"
+        self, domain: str | None, start_time: float | None =None, end_time: float | None =None, sample_size: int | None =None, mode: str ="Sample",
+        page_size: int | None = None
     ):
-        future = await self.get_history(domain, start_time, end_time, sample_size, mode)
-        if future is None:
-            return None
-        hist_result = await future
-        hist: list[tuple[float, float]] = json.loads(hist_result.data)
-        return hist
+        """Get history of domain, with page_size the history is transferred in pages of up to page_size events"""
+        if page_size is None:
+            future = await self.get_history(domain, start_time, end_time, sample_size, mode)
+            if future is None:
+                return None
+            hist_result = await future
+            hist: list[tuple[float, float]] = hist_result.data_value()
+            return hist
+        hist = []
+        cursor = None
+        while True:
+            future = await self.get_history(domain, start_time, end_time, sample_size, mode, page_size, cursor)
+            if future is None:
+                return None
+            hist_result = await future
+            if hist_result.data_type.startswith("error") is True:
+                self.log.error(f"Error: {hist_result.data}")
+                return None
+            if hist_result.data_type != "json/historypage":
+                # Modes that reduce the history server-side are not paged
+                hist_page: list[tuple[float, float]] = hist_result.data_value()
+                return hist_page
+            page = hist_result.data_value()
+            hist += page["history"]
+            cursor = page["cursor"]
+            if sample_size is not None:
+                sample_size -= len(page["history"])
+            if cursor is None or (sample_size is not None and sample_size <= 0):
+                return hist
 
     @staticmethod
     def get_current_time_jd():
@@ -423,17 +470,34 @@ class IndraClient:
         doms: list[str] | None = json.loads(domain_result.data)
         return doms
 
-    async def delete_recs(self, domains: str | list[str] | None = None, uuid4s: str | list[str] | None = None):
+    async def delete_recs(
+        self,
+        domains: str | list[str] | None = None,
+        uuid4s: str | list[str] | None = None,
+        start_time: float | None = None,
+        end_time: float | None = None,
+        background: bool = False,
+    ):
+        """Delete records by domains (optionally only between start_time and end_time) or by uuid4s
+
+        With background=True, the server deletes in chunks and keeps writing incoming events in between
+        """
         if domains is None and uuid4s is None:
             self.log.error("Please provide a domain or uuid4s")
             return None
         if domains is not None and uuid4s is not None:
             self.log.error("Please provide either a domain or uuid4s")
             return None
-        cmd = {
+        cmd: dict[str, str | list[str] | float | bool | None] = {
             "domains": domains,
             "uuid4s": uuid4s,
         }
+        if start_time is not None:
+            cmd["time_jd_start"] = start_time
+        if end_time is not None:
+            cmd["time_jd_end"] = end_time
+        if background is True:
+            cmd["background"] = True
         ie = IndraEvent()
         ie.domain = "$trx/db/req/del"
         ie.from_id = "ws/python"
@@ -443,8 +507,15 @@ class IndraClient:
         ie.data = json.dumps(cmd)
         return await self.send_event(ie)
 
-    async def delete_recs_wait(self, domains: str | list[str] | None = None, uuid4s: str | list[str] | None = None):
-        future = await self.delete_recs(domains, uuid4s)
+    async def delete_recs_wait(
+        self,
+        domains: str | list[str] | None = None,
+        uuid4s: str | list[str] | None = None,
+        start_time: float | None = None,
+        end_time: float | None = None,
+        background: bool = False,
+    ):
+        future = await self.delete_recs(domains, uuid4s, start_time, end_time, background)
         if future is None:
             return None
         result = await future
@@ -455,13 +526,20 @@ class IndraClient:
             res:int = json.loads(result.data)  # Number of deleted records
             return res
 
-    async def update_recs(self, recs: IndraEvent | list[IndraEvent]):
+    async def update_recs(self, recs: IndraEvent | list[IndraEvent], counts: bool = False):
+        """Insert or update records, matched by domain and time_jd_start
+
+        With counts=True, the reply contains the numbers of inserted, updated, unchanged and ambiguous records
+        """
         if isinstance(recs, list) is False:
             self.log.error("Not a list")
             recsl: list[IndraEvent] = [cast(IndraEvent, recs)]
         else:
             recsl = cast(list[IndraEvent], recs)
-        cmd = recsl
+        recs_dicts = [r.to_dict() for r in recsl]
+        cmd: list[dict[str, Any]] | dict[str, list[dict[str, Any]]] = recs_dicts
+        if counts is True:
+            cmd = {"events": recs_dicts}
         ie = IndraEvent()
         ie.domain = "$trx/db/req/update"
         ie.from_id = "ws/python"
@@ -471,14 +549,17 @@ class IndraClient:
         ie.data = json.dumps(cmd)
         return  await self.send_event(ie)
 
-    async def update_recs_wait(self, recs: IndraEvent | list[IndraEvent]):
-        future = await self.update_recs(recs)
+    async def update_recs_wait(self, recs: IndraEvent | list[IndraEvent], counts: bool = False):
+        future = await self.update_recs(recs, counts)
         if future is None:
             return None
         result = await future
         if result.data_type.startswith("error") is True:
             self.log.error(f"Error: {result.data}")
             return None
+        elif counts is True:
+            num_counts: dict[str, int] = json.loads(result.data)
+            return num_counts
         else:
             num_updated:int = cast(int, json.loads(result.data))
         return num_updated
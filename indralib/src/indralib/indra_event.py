@@ -1,11 +1,60 @@
 import json
 import datetime
+import time
 import uuid
+import threading
+from collections import OrderedDict
 from .indra_time import IndraTime
 
+try:
+    import msgpack  # type: ignore
+except ModuleNotFoundError:  # optional, only required for the binary wire codec
+    msgpack = None
+
+
+# Marker for default values that are only computed on first access
+_LAZY = object()
+# Serializes the generation of lazy uuid4s of events that are shared between threads
+_lazy_lock = threading.Lock()
+
 
 # XXX  https://en.wikipedia.org/wiki/Decimal_time
 class IndraEvent:
+    # Field order of the binary wire format, changes require a new version()
+    wire_fields = [
+        "domain",
+        "from_id",
+        "uuid4",
+        "parent_uuid4",
+        "seq_no",
+        "to_scope",
+        "time_jd_start",
+        "data_type",
+        "data",
+        "auth_hash",
+        "time_jd_end",
+    ]
+    wire_codecs = ["json", "msgpack"]
+    # The JSON payload `data` of these data_types is sent as native msgpack structure (ExtType wire_data_ext)
+    wire_native_data_types = ("json", "number/", "vector/")
+    wire_data_ext = 1
+
+    __slots__ = [
+        "domain",
+        "from_id",
+        "_uuid4",
+        "parent_uuid4",
+        "seq_no",
+        "to_scope",
+        "_time_jd_start",
+        "data_type",
+        "_data",
+        "_data_value",
+        "auth_hash",
+        "time_jd_end",
+        "_time_created",
+    ]
+
     def __init__(self):
         """Create an IndraEvent json object
 
@@ -20,21 +69,78 @@ class IndraEvent:
         :param data           JSON data (note: simple values are valid)
         :param auth_hash:     security auth (optional)
         :param time_jd_end:      end-of-event jd (optional)
+
+        uuid4 and time_jd_start defaults are generated on first access, since they are
+        overwritten for most events (e.g. replies, events read from json).
+        time_jd_start is the time of creation of the event nevertheless.
         """
         self.domain: str = ""
         self.from_id: str = ""
-        self.uuid4: str = str(uuid.uuid4())
+        self._uuid4 = _LAZY
         self.parent_uuid4: str = ""
         self.seq_no: int = 0
         self.to_scope: str = ""
-        self.time_jd_start: float | None = IndraTime.datetime_to_julian(
-            datetime.datetime.now(tz=datetime.timezone.utc)
-        )
+        self._time_created: float = time.time()
+        self._time_jd_start = _LAZY
         self.data_type: str = ""
-        self.data: str = ""
+        self._data = ""
+        self._data_value = _LAZY
         self.auth_hash: str = ""
         self.time_jd_end: float | None = None
 
+    @property
+    def uuid4(self) -> str:
+        if self._uuid4 is _LAZY:
+            # Two threads must not generate different uuid4s, e.g. a request and its reply_to()
+            with _lazy_lock:
+                if self._uuid4 is _LAZY:
+                    self._uuid4 = str(uuid.uuid4())
+        return self._uuid4
+
+    @uuid4.setter
+    def uuid4(self, value: str):
+        self._uuid4 = value
+
+    @property
+    def time_jd_start(self) -> float | None:
+        if self._time_jd_start is _LAZY:
+            self._time_jd_start = IndraTime.datetime_to_julian(
+                datetime.datetime.fromtimestamp(
+                    self._time_created, tz=datetime.timezone.utc
+                )
+            )
+        return self._time_jd_start
+
+    @time_jd_start.setter
+    def time_jd_start(self, value: float | None):
+        self._time_jd_start = value
+
+    @property
+    def data(self) -> str:
+        if self._data is _LAZY:
+            # Payload received as msgpack structure, JSON text is only created if it is used
+            self._data = json.dumps(self._data_value)
+        return self._data
+
+    @data.setter
+    def data(self, value: str):
+        self._data = value
+        self._data_value = _LAZY
+
+    def data_value(self):
+        """Decoded JSON payload of `data`, without JSON round trip for payloads received as msgpack structure"""
+        if self._data_value is not _LAZY:
+            return self._data_value
+        return json.loads(self.data)
+
+    def __getstate__(self):
+        # Pickled events (multiprocessing queues) must carry their uuid4 and time
+        return self.to_dict()
+
+    def __setstate__(self, state):
+        for field in state:
+            setattr(self, field, state[field])
+
     def version(self):
         return "02"
 
@@ -42,23 +148,102 @@ class IndraEvent:
         return ["", "01"]
 
     def to_dict(self):
-        return self.__dict__
+        return {field: getattr(self, field) for field in IndraEvent.wire_fields}
 
     def to_json(self):
         """Convert to JSON string"""
-        return json.dumps(self.__dict__)
+        return json.dumps(self.to_dict())
 
     def as_dict(self):
         """Return (jsonable) dict of object"""
-        return self.__dict__
+        return self.to_dict()
+
+    @staticmethod
+    def from_dict(ev_dict: dict):
+        """Convert from dict, keys that are not IndraEvent fields (e.g. database `id`) are ignored"""
+        ie = IndraEvent()
+        for field in IndraEvent.wire_fields:
+            if field in ev_dict:
+                setattr(ie, field, ev_dict[field])
+        return ie
 
     @staticmethod
     def from_json(json_str: str):
         """Convert from JSON string"""
+        return IndraEvent.from_dict(json.loads(json_str))
+
+    @staticmethod
+    def reply_to(ev: "IndraEvent", from_id: str = ""):
+        """Create the reply event to transaction `ev`
+
+        The reply is addressed to ev.from_id, has the uuid4 of ev as correlator and ev.domain as to_scope.
+        """
+        rev = IndraEvent()
+        rev.domain = ev.from_id
+        rev.from_id = from_id
+        rev.uuid4 = ev.uuid4
+        rev.to_scope = ev.domain
+        return rev
+
+    @staticmethod
+    def msgpack_available():
+        """Check if the optional msgpack module for the binary wire codec is installed"""
+        return msgpack is not None
+
+    def to_msgpack(self):
+        """Convert to binary wire format: one version byte followed by a msgpack array in `wire_fields` order"""
+        if msgpack is None:
+            raise ModuleNotFoundError("msgpack is required for the binary wire codec")
+        fields = [getattr(self, field) for field in IndraEvent.wire_fields]
+        if isinstance(self.data_type, str) and self.data_type.startswith(IndraEvent.wire_native_data_types):
+            # Structured payloads (e.g. history replies) are not sent as JSON text within msgpack
+            try:
+                fields[IndraEvent.wire_fields.index("data")] = msgpack.ExtType(
+                    IndraEvent.wire_data_ext, msgpack.packb(self.data_value(), use_bin_type=True)
+                )
+            except (ValueError, TypeError, OverflowError):
+                pass  # not valid JSON or not representable in msgpack, sent as text
+        return bytes([int(self.version())]) + msgpack.packb(fields, use_bin_type=True)
+
+    @staticmethod
+    def from_msgpack(msg: bytes):
+        """Convert from binary wire format"""
+        if msgpack is None:
+            raise ModuleNotFoundError("msgpack is required for the binary wire codec")
         ie = IndraEvent()
-        ie.__dict__ = json.loads(json_str)
+        if len(msg) == 0 or msg[0] != int(ie.version()):
+            raise ValueError(f"Unsupported binary IndraEvent version: {msg[:1]!r}")
+        fields = msgpack.unpackb(msg[1:], raw=False)
+        if len(fields) != len(IndraEvent.wire_fields):
+            raise ValueError(
+                f"Invalid binary IndraEvent, expected {len(IndraEvent.wire_fields)} fields, got {len(fields)}"
+            )
+        for field, value in zip(IndraEvent.wire_fields, fields):
+            if isinstance(value, msgpack.ExtType):
+                if field != "data" or value.code != IndraEvent.wire_data_ext:
+                    raise ValueError(f"Invalid binary IndraEvent, unexpected extension type in {field}")
+                # `data` is JSON text on all transports, it is encoded on first access
+                ie._data = _LAZY
+                ie._data_value = msgpack.unpackb(value.data, raw=False)
+                continue
+            setattr(ie, field, value)
         return ie
 
+    def to_wire(self, codec: str = "json"):
+        """Encode for transport, codec is one of `wire_codecs`, json returns str, msgpack bytes"""
+        if codec == "msgpack":
+            return self.to_msgpack()
+        return self.to_json()
+
+    @staticmethod
+    def from_wire(msg: str | bytes):
+        """Decode a wire message of either codec: JSON objects start with '{', binary messages with the version byte"""
+        if isinstance(msg, str) is True:
+            return IndraEvent.from_json(msg)
+        if len(msg) > 0 and msg[0] == ord("{"):
+            return IndraEvent.from_json(msg)
+        return IndraEvent.from_msgpack(msg)
+
     @staticmethod
     def mqcmp(pub: str, sub: str):
         """MQTT-style wildcard compare"""
@@ -94,3 +279,138 @@ class IndraEvent:
             if sub[inds] == "+" or sub[inds] == "#":
                 return True
         return False
+
+
+class SubscriptionPattern:
+    # Compiled patterns by pattern string, see compile()
+    _compiled: dict[str, "SubscriptionPattern"] = {}
+    _compiled_max_size = 4096
+
+    def __init__(self, pattern: str):
+        """MQTT-style wildcard pattern that is split into segments once
+
+        Matching has the same semantics as IndraEvent.mqcmp(): '+' matches exactly
+        one segment, '#' matches one or more segments. Patterns with wildcards
+        within a segment (e.g. 'ab+') and domains with empty segments (e.g. 'a//b'),
+        which mqcmp() compares character-wise, fall back to mqcmp().
+
+        :param pattern: subscription pattern, e.g. '$event/measurement/+/#'
+        """
+        self.pattern: str = pattern
+        self.segments: list[str] | None = SubscriptionPattern.split_pattern(pattern)
+
+    @staticmethod
+    def split_pattern(pattern: str):
+        """Split `pattern` into segments, returns None if the pattern can't be matched segment-wise"""
+        segs = pattern.split("/")
+        for index, seg in enumerate(segs):
+            if seg == "#":
+                # mqcmp() matches everything once '#' is reached
+                return segs[: index + 1]
+            if ("+" in seg or "#" in seg) and seg != "+":
+                return None
+        return segs
+
+    @staticmethod
+    def compile(pattern: str):
+        """Return the (cached) SubscriptionPattern for `pattern`"""
+        sp = SubscriptionPattern._compiled.get(pattern)
+        if sp is None:
+            if len(SubscriptionPattern._compiled) >= SubscriptionPattern._compiled_max_size:
+                SubscriptionPattern._compiled.clear()
+            sp = SubscriptionPattern(pattern)
+            SubscriptionPattern._compiled[pattern] = sp
+        return sp
+
+    def match_segments(self, domain: str, domain_segs: list[str]):
+        """Match a domain that has been split into `domain_segs` already"""
+        if self.segments is None or "" in domain_segs:
+            return IndraEvent.mqcmp(domain, self.pattern)
+        n_segs = len(domain_segs)
+        for index, seg in enumerate(self.segments):
+            if seg == "#":
+                return index < n_segs
+            if index >= n_segs:
+                return False
+            if seg != "+" and seg != domain_segs[index]:
+                return False
+        return len(self.segments) == n_segs
+
+    def match(self, domain: str):
+        """Check if `domain` matches this pattern"""
+        if "+" in domain or "#" in domain:
+            return False
+        return self.match_segments(domain, domain.split("/"))
+
+
+class SubscriptionPatternSet:
+    def __init__(self, patterns: list[str] | None = None, cache_size: int = 1024):
+        """Set of SubscriptionPatterns with an LRU cache of domain -> matching patterns
+
+        :param patterns: initial list of patterns
+        :param cache_size: max number of domains in the LRU cache, 0 disables the cache
+        """
+        self.patterns: dict[str, SubscriptionPattern] = {}
+        self.cache: OrderedDict[str, list[str]] = OrderedDict()
+        self.cache_size: int = cache_size
+        # Sets are shared between threads (e.g. a writer and read workers), the cache is guarded
+        self.lock = threading.Lock()
+        if patterns is not None:
+            for pattern in patterns:
+                self.add(pattern)
+
+    def __getstate__(self):
+        # Locks can't be pickled (multiprocessing), the cache is rebuilt on use
+        state = self.__dict__.copy()
+        del state["lock"]
+        state["cache"] = OrderedDict()
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self.lock = threading.Lock()
+
+    def add(self, pattern: str):
+        with self.lock:
+            if pattern not in self.patterns:
+                # Replaced, not modified, match() iterates the patterns without the lock
+                patterns = dict(self.patterns)
+                patterns[pattern] = SubscriptionPattern.compile(pattern)
+                self.patterns = patterns
+                self.cache.clear()
+
+    def remove(self, pattern: str):
+        with self.lock:
+            if pattern in self.patterns:
+                patterns = dict(self.patterns)
+                del patterns[pattern]
+                self.patterns = patterns
+                self.cache.clear()
+
+    def __len__(self):
+        return len(self.patterns)
+
+    def match(self, domain: str):
+        """Return the list of patterns that match `domain`"""
+        with self.lock:
+            matches = self.cache.get(domain)
+            if matches is not None:
+                self.cache.move_to_end(domain)
+                return matches
+        matches = []
+        if "+" not in domain and "#" not in domain:
+            domain_segs = domain.split("/")
+            patterns = self.patterns
+            for pattern in patterns:
+                if patterns[pattern].match_segments(domain, domain_segs) is True:
+                    matches.append(pattern)
+        if self.cache_size > 0:
+            with self.lock:
+                self.cache[domain] = matches
+                if len(self.cache) > self.cache_size:
+                    self.cache.popitem(last=False)
+        return matches
+
+    def match_any(self, domain: str):
+        """Check if any pattern matches `domain`"""
+        return len(self.match(domain)) > 0
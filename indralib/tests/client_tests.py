@@ -0,0 +1,97 @@
+# Add the parent directory to the path so we can import the client
+import sys
+import os
+import json
+import asyncio
+
+import websockets.asyncio.server
+
+path = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "src/")
+print(path)
+sys.path.append(path)
+from indralib.indra_event import IndraEvent  # type: ignore
+from indralib.indra_client import IndraClient  # type: ignore
+
+update_fields = ["domain", "time_jd_start", "data_type", "data"]
+
+
+async def update_handler(websocket):
+    """Answer $trx/db/req/update like indra_db: records are dicts, {"events": [...]} requests counts"""
+    async for message in websocket:
+        ev = IndraEvent.from_wire(message)
+        rev = IndraEvent.reply_to(ev, "test_server")
+        try:
+            rq_data = json.loads(ev.data)
+        except Exception as e:
+            rev.data_type = "error/invalid"
+            rev.data = json.dumps(f"Invalid request: {e}")
+            await websocket.send(rev.to_wire())
+            continue
+        reply_counts = False
+        if isinstance(rq_data, dict) and "events" in rq_data:
+            reply_counts = True
+            rq_data = rq_data["events"]
+        if not isinstance(rq_data, list) or not all(
+            isinstance(rq, dict) and all(field in rq for field in update_fields)
+            for rq in rq_data
+        ):
+            rev.data_type = "error/invalid"
+            rev.data = json.dumps(f"Invalid records: {rq_data}")
+        elif reply_counts is True:
+            rev.data_type = "json/updatecounts"
+            rev.data = json.dumps(
+                {"inserted": len(rq_data), "updated": 0, "unchanged": 0, "ambiguous": 0}
+            )
+        else:
+            rev.data_type = "number/int"
+            rev.data = json.dumps(len(rq_data))
+        await websocket.send(rev.to_wire())
+
+
+def make_recs(num):
+    recs = []
+    for i in range(num):
+        ie = IndraEvent()
+        ie.domain = f"$event/measurement/test/{i}"
+        ie.from_id = "client_tests"
+        ie.data_type = "number/float"
+        ie.data = json.dumps(i * 1.5)
+        ie.time_jd_start = 2460000.5 + i
+        recs.append(ie)
+    return recs
+
+
+async def do_tests():
+    result = {"num_ok": 0, "num_failed": 0, "num_skipped": 0, "errors": []}
+    async with websockets.asyncio.server.serve(update_handler, "localhost", 0) as server:
+        port = server.sockets[0].getsockname()[1]
+        profile = {"name": "test", "host": "localhost", "port": port, "TLS": False}
+        cl = IndraClient(profile=profile)
+        if await cl.init_connection() is None:
+            result["num_failed"] += 1
+            result["errors"].append("Error: connection to test server failed")
+            return result
+        tests = [
+            ("update_recs_wait counts", make_recs(3), True,
+             {"inserted": 3, "updated": 0, "unchanged": 0, "ambiguous": 0}),
+            ("update_recs_wait", make_recs(2), False, 2),
+            ("update_recs_wait single", make_recs(1)[0], True,
+             {"inserted": 1, "updated": 0, "unchanged": 0, "ambiguous": 0}),
+        ]
+        for name, recs, counts, expected in tests:
+            try:
+                res = await cl.update_recs_wait(recs, counts=counts)
+            except Exception as e:
+                res = f"{type(e).__name__}: {e}"
+            if res == expected:
+                result["num_ok"] += 1
+            else:
+                result["num_failed"] += 1
+                result["errors"].append(f"Error: {name}: {res} != {expected}")
+        await cl.close_connection()
+    return result
+
+
+result = asyncio.run(do_tests())
+print("#$#$# Result #$#$#")
+print(json.dumps(result, indent=2))
@@ -6,7 +6,7 @@ import json
 path = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "src/")
 print(path)
 sys.path.append(path)
-from indralib.indra_event import IndraEvent  # type: ignore
+from indralib.indra_event import IndraEvent, SubscriptionPattern  # type: ignore
 from indralib.indra_time import IndraTime  # type: ignore
 
 
@@ -21,6 +21,11 @@ def do_tests(data):
         else:
             result["num_failed"] += 1
             result["errors"].append(f"Error: {pub} {sub} != {res}")
+        if SubscriptionPattern(sub).match(pub) == res:
+            result["num_ok"] += 1
+        else:
+            result["num_failed"] += 1
+            result["errors"].append(f"Error (SubscriptionPattern): {pub} {sub} != {res}")
     return result
 
 
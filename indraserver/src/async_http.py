@@ -5,7 +5,7 @@ from aiohttp import web
 import json
 import os
 
-from indralib.indra_event import IndraEvent  # type: ignore
+from indralib.indra_event import IndraEvent, SubscriptionPatternSet  # type: ignore
 from indra_serverlib import IndraProcessCore
 
 
@@ -228,22 +228,22 @@ class IndraProcess(IndraProcessCore):
                 ev.data = data
                 try:
                     for k in request.query:
-                        if k not in ev.__dict__:
+                        if k not in IndraEvent.wire_fields:
                             return web.json_response(
                                 {"status": "error", "message": f"Parameter `{k}` is not a valid IndraEvent member"},
                                 status=400
                             )
                     for k in request.query:
-                        ev.__dict__[k] = request.query[k]
+                        setattr(ev, k, request.query[k])
                 except Exception as e:
                     return web.json_response(
                         {"status": "error", "message": f"Parameter parsing failure: {e}"},
                         status=400
                     )                    
                 if 'from_id' not in request.query:
-                    ev.__dict__['from_id'] = self.name
+                    ev.from_id = self.name
                 if 'data_type' not in request.query:
-                    ev.__dict__['data_type'] = 'number/float'  # XXX stupid assumption
+                    ev.data_type = 'number/float'  # XXX stupid assumption
                 return web.json_response(
                     {"status": "ok", "message": f"Forwarded to {domain}"},
                     status=200
@@ -303,7 +303,9 @@ class IndraProcess(IndraProcessCore):
                 "from_id": None,
                 "user_id": None,
                 "session_id": None,
-                "subs": [],
+                "subs": {},  # subscription -> reference count
+                "sub_patterns": SubscriptionPatternSet(),  # compiled keys of "subs"
+                "wire_codec": "json",  # switches to msgpack, if client sends binary messages
             }
             self.log.info(
                 f"New ws client {client_address}! (num clients: {len(self.ws_clients)})"
@@ -315,24 +317,32 @@ class IndraProcess(IndraProcessCore):
             )
 
         async for msg in ws:
-            if msg.type == aiohttp.WSMsgType.TEXT:
+            if msg.type == aiohttp.WSMsgType.TEXT or msg.type == aiohttp.WSMsgType.BINARY:
                 # if msg.data is not None:
                 self.log.debug("Client ws_dispatch: ws:{} msg:{}".format(ws, msg.data))
                 try:
-                    ev = IndraEvent.from_json(msg.data)
+                    if msg.type == aiohttp.WSMsgType.BINARY:
+                        if IndraEvent.msgpack_available() is False:
+                            self.log.warning(
+                                f"WS client {client_address} sent binary message, but msgpack is not available, ignored"
+                            )
+                            continue
+                        # Client negotiated the binary codec, reply in kind
+                        self.ws_clients[client_address]["wire_codec"] = "msgpack"
+                        ev = IndraEvent.from_msgpack(msg.data)
+                    else:
+                        ev = IndraEvent.from_json(msg.data)
                     if IndraEvent.mqcmp(ev.domain, "$trx/kv/req/login") is False:
                         if self.ws_clients[client_address]["session_id"] is None:
                             self.log.warning(
                                 f"WS client {client_address} not logged in, ignoring event"
                             )
-                            rev = IndraEvent()
-                            rev.from_id = f"{self.name}/ws/{client_address}"
-                            rev.to_scope = ev.domain
-                            rev.domain = ev.from_id
-                            rev.uuid4 = ev.uuid4
+                            rev = IndraEvent.reply_to(
+                                ev, f"{self.name}/ws/{client_address}"
+                            )
                             rev.data_type = "error/access"
                             rev.data = json.dumps("Not logged in")
-                            await ws.send_str(rev.to_json())
+                            await self._ws_send(client_address, rev)
                             continue
                         elif (
                             ev.auth_hash
@@ -341,14 +351,12 @@ class IndraProcess(IndraProcessCore):
                             self.log.warning(
                                 f"WS client {client_address} session mismatch, ignoring event"
                             )
-                            rev = IndraEvent()
-                            rev.from_id = f"{self.name}/ws/{client_address}"
-                            rev.to_scope = ev.domain
-                            rev.domain = ev.from_id
-                            rev.uuid4 = ev.uuid4
+                            rev = IndraEvent.reply_to(
+                                ev, f"{self.name}/ws/{client_address}"
+                            )
                             rev.data_type = "error/access"
                             rev.data = json.dumps("Session mismatch")
-                            await ws.send_str(rev.to_json())
+                            await self._ws_send(client_address, rev)
                             continue
                     self.ws_clients[client_address]["old_from_id"] = ev.from_id
                     ev.from_id = f"{self.name}/ws/{client_address}"
@@ -357,19 +365,34 @@ class IndraProcess(IndraProcessCore):
                     self.log.info(
                         f"Received (upd.): {client_address}: {ev.from_id}->{ev.domain}"
                     )
+                    client_subs = self.ws_clients[client_address]["subs"]
+                    client_patterns = self.ws_clients[client_address]["sub_patterns"]
                     if ev.domain == "$cmd/subs":
                         new_subs = json.loads(ev.data)
                         for new_sub in new_subs:
-                            self.ws_clients[client_address]["subs"].append(
-                                new_sub
-                            )  # allow dups
+                            client_subs[new_sub] = client_subs.get(new_sub, 0) + 1
+                            client_patterns.add(new_sub)
                     elif ev.domain == "$cmd/unsubs":
                         new_unsubs = json.loads(ev.data)
+                        valid_unsubs = []
                         for new_unsub in new_unsubs:
-                            self.ws_clients[client_address]["subs"].remove(new_unsub)
+                            if new_unsub not in client_subs:
+                                self.log.warning(
+                                    f"WS client {client_address} unsubscribes from {new_unsub} without subscription, ignored"
+                                )
+                                continue
+                            client_subs[new_unsub] -= 1
+                            if client_subs[new_unsub] == 0:
+                                del client_subs[new_unsub]
+                                client_patterns.remove(new_unsub)
+                            valid_unsubs.append(new_unsub)
+                        # Only release references this client holds, the main router counts references per module
+                        if len(valid_unsubs) == 0:
+                            continue
+                        ev.data = json.dumps(valid_unsubs)
                     self.event_send(ev)
                 except Exception as e:
-                    self.log.warning(f"WebClient sent invalid JSON: {msg.data}: {e}")
+                    self.log.warning(f"WebClient sent invalid message: {msg.data}: {e}")
             elif msg.type == aiohttp.WSMsgType.ERROR:
                 self.log.warning(
                     f"ws connection closed with exception {ws.exception()}"
@@ -379,6 +402,18 @@ class IndraProcess(IndraProcessCore):
                 self.log.error(f"Unexpected message {msg.data}, of type {msg.type}")
                 break
 
+        client_subs = self.ws_clients[client_address]["subs"]
+        if len(client_subs) > 0:
+            # Release the subscription references of this client in the main router
+            ev = IndraEvent()
+            ev.from_id = f"{self.name}/ws/{client_address}"
+            ev.domain = "$cmd/unsubs"
+            ev.data_type = "vector/string"
+            unsubs = []
+            for sub in client_subs:
+                unsubs.extend([sub] * client_subs[sub])
+            ev.data = json.dumps(unsubs)
+            self.event_send(ev)
         if self.ws_clients[client_address]["session_id"] is not None:
             self.log.warning(
                 f"WS-CLOSE: {client_address}, session {self.ws_clients[client_address]['session_id']} was still active, logging out"
@@ -396,15 +431,11 @@ class IndraProcess(IndraProcessCore):
     async def async_outbound(self, ev: IndraEvent):
         self.log.debug(f"WS outbound (pre-route): {ev.domain} from {ev.from_id}")
         for client_address in self.ws_clients:
-            ws = self.ws_clients[client_address]["ws"]
             route = False
             if ev.domain.endswith(client_address):
                 route = True
-            else:
-                for sub in self.ws_clients[client_address]["subs"]:
-                    if IndraEvent.mqcmp(ev.domain, sub):
-                        route = True
-                        break
+            elif self.ws_clients[client_address]["sub_patterns"].match_any(ev.domain):
+                route = True
             if route is True:
                 self.log.info(
                     f"Sending to ws-client: {client_address}, dom: {ev.domain}, scope: {ev.to_scope}, ws_from_id: {self.ws_clients[client_address]['from_id']}"
@@ -423,7 +454,14 @@ class IndraProcess(IndraProcessCore):
                     self.ws_clients[client_address]["session_id"] = None
                     self.log.info(f"WS client {client_address} logged out")
 
-                await ws.send_str(ev.to_json())
+                await self._ws_send(client_address, ev)
+
+    async def _ws_send(self, client_address, ev: IndraEvent):
+        client = self.ws_clients[client_address]
+        if client["wire_codec"] == "msgpack":
+            await client["ws"].send_bytes(ev.to_msgpack())
+        else:
+            await client["ws"].send_str(ev.to_json())
 
     async def async_shutdown(self):
         # XXX Cleanup!
@@ -197,11 +197,7 @@ class IndraProcess(IndraProcessCore):
 
     def _trx_err(self, ev: IndraEvent, err_msg: str):
         self.log.error(err_msg)
-        rev = IndraEvent()
-        rev.domain = ev.from_id
-        rev.from_id = self.name
-        rev.uuid4 = ev.uuid4
-        rev.to_scope = ev.domain
+        rev = IndraEvent.reply_to(ev, self.name)
         rev.time_jd_start = IndraTime.datetime_to_julian(
             datetime.datetime.now(tz=datetime.timezone.utc)
         )
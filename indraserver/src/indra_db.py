@@ -2,17 +2,118 @@ import sqlite3
 import time
 import json
 import threading
+import re
+import queue
+import bisect
+import math
+from collections import OrderedDict
 import datetime
 import uuid
+import hmac
+import hashlib
 import bcrypt  # type: ignore
 import os
-
-from indralib.indra_event import IndraEvent  # type: ignore
+import random
+import urllib.parse
+import string
+import numpy as np
+
+try:
+    import pyarrow as pa  # type: ignore
+    import pyarrow.parquet as pq  # type: ignore
+except ModuleNotFoundError:  # optional, only required for the parquet archive
+    pa = None
+    pq = None
+
+from indralib.indra_event import IndraEvent, SubscriptionPattern, SubscriptionPatternSet  # type: ignore
 from indralib.indra_time import IndraTime  # type: ignore
 from indra_serverlib import IndraProcessCore
 
 
 class IndraProcess(IndraProcessCore):
+    # Upper bounds (ms) of the latency histogram buckets of request statistics
+    latency_buckets_ms = [1, 2, 5, 10, 20, 50, 100, 200, 500, 1000, 2000, 5000]
+    # SQLITE_MAX_COMPOUND_SELECT, maximum number of terms of a UNION ALL
+    compound_select_limit = 500
+    # Case folding of SQLite's LIKE and NOCASE, which only fold ASCII letters
+    ascii_lower = str.maketrans(string.ascii_uppercase, string.ascii_lowercase)
+    # Resolution of the VM step count of request statistics, the progress handler is called every N steps
+    vm_steps_resolution = 1000
+
+    # Column order of SELECTs that return complete event records
+    event_columns = [
+        "id",
+        "domain",
+        "from_id",
+        "uuid4",
+        "parent_uuid4",
+        "seq_no",
+        "to_scope",
+        "time_jd_start",
+        "data_type",
+        "data",
+        "auth_hash",
+        "time_jd_end",
+    ]
+    # SELECT of complete event records in event_columns order, resolves the interned ids.
+    # {source} is indra_events or a single partition table
+    event_select = """SELECT e.id, d.domain, e.from_id, e.uuid4, e.parent_uuid4, e.seq_no,
+                         e.to_scope, e.time_jd_start, t.data_type, e.data, e.auth_hash, e.time_jd_end
+                      FROM {source} e
+                      JOIN indra_domains d ON d.id = e.domain_id
+                      JOIN indra_data_types t ON t.id = e.data_type_id"""
+
+    # Events are stored in one table per time period (partition), indra_events is a view of all partitions
+    partition_table = """CREATE TABLE IF NOT EXISTS {table} (
+                 id INTEGER PRIMARY KEY,
+                 seq_no INTEGER NOT NULL,
+                 domain_id INTEGER NOT NULL REFERENCES indra_domains (id),
+                 from_id TEXT NOT NULL,
+                 uuid4 UUID NOT NULL,
+                 parent_uuid4 UUID,
+                 to_scope TEXT NOT NULL,
+                 time_jd_start DOUBLE,
+                 data_type_id INTEGER NOT NULL REFERENCES indra_data_types (id),
+                 data TEXT NOT NULL,
+                 auth_hash TEXT,
+                 time_jd_end DOUBLE,
+                 value_num DOUBLE );"""
+    # value_num of stored events, the numeric JSON value of number/ events, else NULL. See _value_num()
+    value_num_sql = """CASE WHEN data_type_id IN (SELECT id FROM indra_data_types WHERE data_type LIKE 'number/%')
+                         AND json_valid(data) THEN CASE WHEN json_type(data) IN ('integer', 'real')
+                         THEN json_extract(data, '$') END END"""
+    # Records of a $trx/db/req/update request, matched with one join per partition, see _update_events()
+    update_batch_table = """CREATE TEMP TABLE IF NOT EXISTS indra_update_batch (
+                 n INTEGER PRIMARY KEY, domain TEXT NOT NULL, time_jd_start DOUBLE NOT NULL);"""
+    # (domain_id, time_jd_start) serves history ranges, last-event seeks and updates,
+    # (domain_id, data_type_id) covers the data_type checks of uniquedomains and rollups.
+    partition_indices = [
+        "CREATE INDEX IF NOT EXISTS {table}_domain_time ON {table} (domain_id, time_jd_start);",
+        "CREATE INDEX IF NOT EXISTS {table}_domain_data_type ON {table} (domain_id, data_type_id);",
+        "CREATE INDEX IF NOT EXISTS {table}_from_id ON {table} (to_scope);",
+        "CREATE INDEX IF NOT EXISTS {table}_time_start ON {table} (time_jd_start);",
+        "CREATE INDEX IF NOT EXISTS {table}_time_end ON {table} (time_jd_end);",
+        "CREATE INDEX IF NOT EXISTS {table}_seq_no ON {table} (seq_no);",
+        "CREATE INDEX IF NOT EXISTS {table}_uuid4 ON {table} (uuid4);",
+        "CREATE INDEX IF NOT EXISTS {table}_parent_uuid4 ON {table} (parent_uuid4);",
+    ]
+
+    # Sample and Sequential return events, the others reduce to `limit` points, see _history_downsampled()
+    history_modes = [
+        "Sample",
+        "Sequential",
+        "Min",
+        "Max",
+        "Mean",
+        "Count",
+        "First",
+        "Last",
+        "LTTB",
+    ]
+
+    # Resolutions of the rollup tables in seconds: minute, hour, day
+    rollup_resolutions = [60, 3600, 86400]
+
     def __init__(
         self,
         config_data,
@@ -52,18 +153,175 @@ class IndraProcess(IndraProcessCore):
             self.cache_size_pages = config_data["cache_size_pages"]
         else:
             self.cache_size_pages = 10000
+        if "ingest_batch_size" in config_data:
+            self.ingest_batch_size = config_data["ingest_batch_size"]
+        else:
+            self.ingest_batch_size = 100
+        if "history_default_points" in config_data:
+            self.history_default_points = config_data["history_default_points"]
+        else:
+            self.history_default_points = 1000
+        if "rollup_domains" in config_data:
+            self.rollup_patterns = SubscriptionPatternSet(config_data["rollup_domains"])
+        else:
+            self.rollup_patterns = SubscriptionPatternSet(["$event/measurement/#"])
+        if "history_max_page_size" in config_data:
+            self.history_max_page_size = config_data["history_max_page_size"]
+        else:
+            self.history_max_page_size = 10000
+        if "delete_chunk_size" in config_data:
+            self.delete_chunk_size = config_data["delete_chunk_size"]
+        else:
+            self.delete_chunk_size = 10000
+        if "last_cache_size" in config_data:
+            self.last_cache_size = config_data["last_cache_size"]
+        else:
+            self.last_cache_size = 10000
+        if "read_pool_size" in config_data:
+            self.read_pool_size = config_data["read_pool_size"]
+        else:
+            self.read_pool_size = 2
+        if "partition_period" in config_data:
+            self.partition_period = config_data["partition_period"]
+        else:
+            self.partition_period = "month"
+        if self.partition_period not in ["month", "year"]:
+            self.log.error(
+                f"Invalid partition_period {self.partition_period}, expected month or year, using month"
+            )
+            self.partition_period = "month"
+        # Once max_partitions exist, partitions are extended instead of created, see _partition_of()
+        if "max_partitions" in config_data:
+            self.max_partitions = max(int(config_data["max_partitions"]), 1)
+        else:
+            self.max_partitions = 240
+        # domain pattern -> retention in days, domains that match no pattern are kept
+        if "retention" in config_data:
+            self.retention = config_data["retention"]
+        else:
+            self.retention = {}
+        if "retention_run_condition" in config_data:
+            self.retention_run_condition = config_data["retention_run_condition"]
+        else:
+            self.retention_run_condition = "daily@03:30"
+        # Parquet archive of closed partitions, see _archive_job()
+        if "archive_directory" in config_data and config_data["archive_directory"] is not None:
+            self.archive_directory = os.path.expanduser(config_data["archive_directory"])
+        else:
+            self.archive_directory = None
+        if "archive_domains" in config_data:
+            self.archive_patterns = SubscriptionPatternSet(config_data["archive_domains"])
+        else:
+            self.archive_patterns = SubscriptionPatternSet(["$event/measurement/#"])
+        if "archive_run_condition" in config_data:
+            self.archive_run_condition = config_data["archive_run_condition"]
+        else:
+            self.archive_run_condition = "daily@04:00"
+        if "cached_statements" in config_data:
+            self.cached_statements = config_data["cached_statements"]
+        else:
+            self.cached_statements = 512
+        if "slow_query_ms" in config_data:
+            self.slow_query_ms = config_data["slow_query_ms"]
+        else:
+            self.slow_query_ms = 500
+        if "stats_run_condition" in config_data:
+            self.stats_run_condition = config_data["stats_run_condition"]
+        else:
+            self.stats_run_condition = "periodic@1m"
+        if "checkpoint_run_condition" in config_data:
+            self.checkpoint_run_condition = config_data["checkpoint_run_condition"]
+        else:
+            self.checkpoint_run_condition = "periodic@1m"
+        if "checkpoint_truncate_mb" in config_data:
+            self.checkpoint_truncate_mb = config_data["checkpoint_truncate_mb"]
+        else:
+            self.checkpoint_truncate_mb = 64
+        if "backup_directory" in config_data:
+            self.backup_directory = os.path.expanduser(config_data["backup_directory"])
+        else:
+            self.backup_directory = None
+        if "backup_run_condition" in config_data:
+            self.backup_run_condition = config_data["backup_run_condition"]
+        else:
+            self.backup_run_condition = "daily@02:30"
+        if "backup_pages_per_step" in config_data:
+            self.backup_pages_per_step = config_data["backup_pages_per_step"]
+        else:
+            self.backup_pages_per_step = 1000
+        if "backup_keep" in config_data:
+            self.backup_keep = config_data["backup_keep"]
+        else:
+            self.backup_keep = 7
         if "use_hash_cache" in config_data:
-            self.use_hash_cache = config_data["use_hash_cache"]
+            self.log.warning("use_hash_cache is no longer supported, see credential_cache_ttl_sec")
+        if "credential_cache_ttl_sec" in config_data:
+            self.credential_cache_ttl_sec = config_data["credential_cache_ttl_sec"]
+        else:
+            self.credential_cache_ttl_sec = 300
+        if "session_ttl_sec" in config_data:
+            self.session_ttl_sec = config_data["session_ttl_sec"]
+        else:
+            self.session_ttl_sec = 86400
+        if "login_workers" in config_data:
+            self.login_workers = config_data["login_workers"]
+        else:
+            self.login_workers = 2
+        if "login_queue_size" in config_data:
+            self.login_queue_size = config_data["login_queue_size"]
+        else:
+            self.login_queue_size = 32
+        if "login_max_per_key" in config_data:
+            self.login_max_per_key = config_data["login_max_per_key"]
+        else:
+            self.login_max_per_key = 2
+        if "login_max_per_source" in config_data:
+            self.login_max_per_source = config_data["login_max_per_source"]
         else:
-            self.use_hash_cache = False
+            self.login_max_per_source = 4
 
         self.bUncommitted = False
         self.commit_timer_thread = None
+        self.ingest_buffer = []
+        self.ingest_buffer_start = 0
+        # Writer-side caches of the interned domain and data_type ids
+        self.domain_ids = {}
+        self.data_type_ids = {}
+        # (jd_start, jd_end, table) of all partitions, sorted by time, see _partitions_load()
+        self.partitions = []
+        # (jd_start, jd_end, name) of all archived periods, see _archive_load()
+        self.archive_periods = []
+        # session_id -> {"user", "last_access", "from_id"}, sessions expire session_ttl_sec after last access
         self.sessions = {}
         self.subscribe(["$trx/db/#", "$trx/kv/#", "$event/#"])
         self._get_secure_key_names(config_data)
-        self.unique_domains_cache = None
-        self.hash_cache = None
+        # domain -> {"data_types": {data_type: count}, "count", "first", "last"}, see _domain_stats_load()
+        self.domain_stats = None
+        # domain -> latest event (dict), LRU with at most last_cache_size entries
+        self.last_cache = OrderedDict()
+        # key -> (HMAC of password, hashed password, expiry time) of recently verified passwords
+        self.credential_cache = {}
+        # Per-process HMAC key of the credential cache, created in outbound_init()
+        self.credential_secret = None
+        # Read pool is started in outbound_init(), the instance is pickled before
+        self.read_queue = None
+        self.read_workers = []
+        # Request statistics, per request type, see _stats_begin(). The lock and the
+        # thread-local of the current request are created in outbound_init()
+        self.request_stats = {}
+        self.stats_lock = None
+        self.stats_local = None
+        # Background deletes of $trx/db/req/del, processed chunk by chunk, see _delete_job_step()
+        self.delete_jobs = []
+        # Password checks of verify and login requests, see _start_login_pool()
+        self.login_queue = None
+        self.login_workers_active = []
+        # job id -> (request event, key, hashed password), waiting for a login worker
+        self.login_pending = {}
+        self.login_job_id = 0
+        # Number of pending password checks per key and per from_id
+        self.login_active_keys = {}
+        self.login_active_sources = {}
 
     def start_commit_timer(self):
         if self.commit_delay_sec > 0.0:
@@ -194,9 +452,8 @@ class IndraProcess(IndraProcessCore):
         Check if a plain password matches a hashed password.
 
         Warning: this is SLOW by design, to prevent brute-force attacks. 200ms(!) per check.
-        If use_hash_cache is true (in config), results of the hashing operation are cached in memory,
-        to speed up repeated checks of the same password, at (some theoretical) cost of security, since
-        no brute-force protection is applied to the cache. For production use, set use_hash_cache to False (default).
+        Successful checks are remembered for credential_cache_ttl_sec (in config), repeated logins
+        with the same password (e.g. reconnecting clients) skip the bcrypt check, see _credential_cached().
 
         Args:
             key (str): The key to be checked.
@@ -206,25 +463,8 @@ class IndraProcess(IndraProcessCore):
         Returns:
             bool: True if the plain password matches the hashed password, False otherwise.
         """
-        hash_key = f"{key}:{plain_password}"
-        if (
-            self.use_hash_cache is True
-            and self.hash_cache is not None
-            and hash_key in self.hash_cache
-        ):
-            self.log.info("Using hash cache")
-            if self.hash_cache[hash_key] != hashed_password:
-                return False
+        if self._credential_cached(key, plain_password, hashed_password) is True:
             return True
-        else:
-            if self.use_hash_cache is False:
-                self.log.info("Hash cache disabled")
-            elif self.hash_cache is None:
-                self.log.info("Hash cache not initialized")
-            elif hash_key not in self.hash_cache:
-                self.log.info("Hash cache miss")
-            else:
-                self.log.error("Algo error")
         try:
             checked = bcrypt.checkpw(
                 plain_password.encode("utf-8"), hashed_password.encode("utf-8")
@@ -232,14 +472,46 @@ class IndraProcess(IndraProcessCore):
         except Exception as e:
             self.log.error(f"Failed to check password: {e}")
             return False
-        if self.hash_cache is None:
-            self.hash_cache = {}
         if checked is True:
-            self.hash_cache[hash_key] = hashed_password
-        else:
-            self.hash_cache[hash_key] = None
+            self._credential_cache_put(key, plain_password, hashed_password)
         return checked
 
+    def _credential_digest(self, plain_password: str):
+        return hmac.new(
+            self.credential_secret, plain_password.encode("utf-8"), hashlib.sha256
+        ).digest()
+
+    def _credential_cached(self, key: str, plain_password: str, hashed_password: str):
+        """True, if plain_password of key was verified within credential_cache_ttl_sec
+
+        The cache holds an HMAC of the password with a secret that never leaves the process, not the
+        password itself. Only successful checks are cached, wrong passwords always need bcrypt.
+        """
+        entry = self.credential_cache.get(key)
+        if entry is None:
+            return False
+        digest, cached_hash, expiry = entry
+        if expiry < time.time() or cached_hash != hashed_password:
+            del self.credential_cache[key]
+            return False
+        return hmac.compare_digest(digest, self._credential_digest(plain_password))
+
+    def _credential_cache_put(self, key: str, plain_password: str, hashed_password: str):
+        if self.credential_cache_ttl_sec <= 0 or self.credential_secret is None:
+            return
+        self.credential_cache[key] = (
+            self._credential_digest(plain_password),
+            hashed_password,
+            time.time() + self.credential_cache_ttl_sec,
+        )
+
+    def _credential_cache_invalidate(self, key: str):
+        """Forget cached credentials of key, a LIKE pattern clears the cache"""
+        if "%" in key:
+            self.credential_cache = {}
+        else:
+            self.credential_cache.pop(key, None)
+
     def _create_session(self, key, from_id):
         user_template = "entity/indrajala/user/+/password"
         if IndraEvent.mqcmp(key, user_template) is False:
@@ -289,33 +561,1085 @@ class IndraProcess(IndraProcessCore):
         return False
 
     def _check_session(self, session_id):
-        for session_id in self.sessions:
-            self.sessions[session_id]["last_access"] = time.time()
-            return self.session[session_id]
-        return None
+        """Return the session of session_id and extend its lifetime, None if unknown or expired"""
+        session = self.sessions.get(session_id)
+        if session is None:
+            return None
+        now = time.time()
+        if now - session["last_access"] > self.session_ttl_sec:
+            self._remove_session(session_id, session["from_id"])
+            return None
+        session["last_access"] = now
+        return session
+
+    def _session_timer(self):
+        # Runs in the timer thread, sessions are expired by the writer
+        ev = IndraEvent()
+        ev.domain = "$self/sessions"
+        self.event_send_self(ev)
+        return True
 
-    def _write_event(self, ev: IndraEvent):
-        """Write an IndraEvent to the database"""
+    def _expire_sessions(self):
+        """End all sessions that were not accessed within session_ttl_sec"""
+        now = time.time()
+        expired = [
+            x for x in self.sessions if now - self.sessions[x]["last_access"] > self.session_ttl_sec
+        ]
+        for session_id in expired:
+            self._remove_session(session_id, self.sessions[session_id]["from_id"])
+        # Expired credentials are otherwise only removed on their next use
+        for key in [x for x in self.credential_cache if self.credential_cache[x][2] < now]:
+            del self.credential_cache[key]
+
+    def _write_event(self, ev: IndraEvent, flush: bool = False):
+        """Write an IndraEvent to the database
+
+        Events are collected in an ingest buffer and written with one executemany()
+        in one transaction, once `ingest_batch_size` events are buffered, or the oldest
+        buffered event is older than `commit_delay_sec`. With commit_delay_sec = 0, the
+        buffer is written when all received events were processed (see outbound_idle()),
+        so bursts are still written as batch. seq_no is assigned on arrival.
+
+        :param ev: event to write
+        :param flush: write the ingest buffer immediately
+        """
         self.last_state["last_seq_no"] = self.last_state["last_seq_no"] + 1
         ev.seq_no = self.last_state["last_seq_no"]
-        cmd = """INSERT INTO indra_events (
-                    domain, from_id, uuid4, parent_uuid4,
-                    seq_no, to_scope, time_jd_start, data_type,
-                    data, auth_hash, time_jd_end)
+        if len(self.ingest_buffer) == 0:
+            self.ingest_buffer_start = time.time()
+        self.ingest_buffer.append(ev.to_dict())
+        if (
+            flush is True
+            or len(self.ingest_buffer) >= self.ingest_batch_size
+            or (
+                self.commit_delay_sec > 0.0
+                and time.time() - self.ingest_buffer_start >= self.commit_delay_sec
+            )
+        ):
+            return self._flush_ingest_buffer()
+        return True
+
+    def _flush_ingest_buffer(self):
+        """Write all buffered events in one transaction"""
+        if len(self.ingest_buffer) == 0:
+            return True
+        cmd = """INSERT INTO {table} (
+                    domain_id, from_id, uuid4, parent_uuid4,
+                    seq_no, to_scope, time_jd_start, data_type_id,
+                    data, auth_hash, time_jd_end, value_num)
                  VALUES (
-                    :domain, :from_id, :uuid4, :parent_uuid4,
-                    :seq_no, :to_scope, :time_jd_start, :data_type,
-                    :data, :auth_hash, :time_jd_end);
+                    :domain_id, :from_id, :uuid4, :parent_uuid4,
+                    :seq_no, :to_scope, :time_jd_start, :data_type_id,
+                    :data, :auth_hash, :time_jd_end, :value_num);
               """
+        rows = self.ingest_buffer
+        self.ingest_buffer = []
+        ret = True
         try:
-            self.cur.execute(cmd, vars(ev))
-            self._check_commit()
-            # self.log.info(f"Wrote {ev.uuid4}")
+            written, pending = self._insert_rows(cmd, rows)
+            self.conn.commit()
+        except sqlite3.Error as e:
+            # Nothing of the batch is written, it is kept and retried with the next flush
+            self.log.error(f"Failed to write {len(rows)} event-records, retrying with the next write: {e}")
+            try:
+                self.conn.rollback()
+            except sqlite3.Error as e:
+                self.log.error(f"Rollback failed: {e}")
+            # Interned ids of the rolled back transaction are invalid
+            self.domain_ids = {}
+            self.data_type_ids = {}
+            self.ingest_buffer = rows + self.ingest_buffer
+            return False
+        if len(written) + len(pending) < len(rows):
+            ret = False
+        if len(pending) > 0:
+            self.ingest_buffer = pending + self.ingest_buffer
+            ret = False
+        for row in written:
+            self._last_cache_update(row)
+        if self.domain_stats is not None:
+            for row in written:
+                self._domain_stats_add(
+                    row["domain"], row["data_type"], 1, row["time_jd_start"], row["time_jd_start"]
+                )
+        self.bUncommitted = False
+        self.last_commit = time.time()
+        # self.log.debug(f"Wrote {len(rows)} event-records")
+        return ret
+
+    def _insert_rows(self, cmd: str, rows):
+        """Insert event-records into their partitions, returns the written records and the records
+        that are retried later, since their partition can't be created. Invalid records are dropped."""
+        partition_rows = {}
+        pending = []
+        for row in rows:
+            try:
+                row["domain_id"] = self._domain_id(row["domain"])
+                row["data_type_id"] = self._data_type_id(row["data_type"])
+            except sqlite3.Error as e:
+                # Only the record whose domain or data_type can't be interned is lost
+                self.log.error(f"Failed to intern domain of event-record: {e}")
+                continue
+            row["value_num"] = self._value_num(row["data_type"], row["data"])
+            try:
+                table = self._partition_of(row["time_jd_start"])
+            except sqlite3.Error as e:
+                self.log.error(f"Failed to create the partition of event-record, retrying with the next write: {e}")
+                pending.append(row)
+                continue
+            if table not in partition_rows:
+                partition_rows[table] = []
+            partition_rows[table].append(row)
+        written = []
+        current_table = self._partition_of(None)
+        for table in partition_rows:
+            if table != current_table:
+                # Late events change a closed partition, it needs to be archived again
+                self._partition_changed(table)
+            try:
+                self.cur.executemany(cmd.format(table=table), partition_rows[table])
+                written += partition_rows[table]
+            except sqlite3.Error as e:
+                # executemany() is all-or-nothing within the statement, retry row by row to only lose invalid records
+                self.log.warning(
+                    f"Failed to write {len(partition_rows[table])} event-records as batch: {e}"
+                )
+                for row in partition_rows[table]:
+                    try:
+                        self.cur.execute(cmd.format(table=table), row)
+                        written.append(row)
+                    except sqlite3.Error as e:
+                        self.log.error(f"Failed to write event-record: {e}")
+        try:
+            self._rollup_add(written)
+        except sqlite3.Error as e:
+            self.log.error(f"Failed to update rollups: {e}")
+        return written, pending
+
+    def _intern(self, table: str, column: str, value: str, cache: dict):
+        """Return the id of `value` in the dictionary `table`, the value is inserted if new"""
+        value_id = cache.get(value)
+        if value_id is None:
+            self.cur.execute(
+                f"INSERT OR IGNORE INTO {table} ({column}) VALUES (?);", [value]
+            )
+            self.cur.execute(f"SELECT id FROM {table} WHERE {column} = ?;", [value])
+            value_id = self.cur.fetchone()[0]
+            cache[value] = value_id
+        return value_id
+
+    def _domain_id(self, domain: str):
+        return self._intern("indra_domains", "domain", domain, self.domain_ids)
+
+    def _data_type_id(self, data_type: str):
+        return self._intern("indra_data_types", "data_type", data_type, self.data_type_ids)
+
+    @staticmethod
+    def _value_num(data_type: str, data: str):
+        """Numeric value of a number/ event, stored as value_num, None for all other events"""
+        if data_type.startswith("number/") is False:
+            return None
+        try:
+            value = json.loads(data)
+        except (ValueError, TypeError):
+            return None
+        if isinstance(value, bool) or not isinstance(value, (int, float)):
+            return None
+        return float(value)
+
+    @staticmethod
+    def _history_value(value_num, data: str):
+        """Value of a history point, as the stored JSON would decode it
+
+        value_num is a DOUBLE: integral numbers (e.g. number/int, or "20") are decoded from
+        data, so they keep their int type and precision beyond 2^53.
+        """
+        if value_num is not None and value_num.is_integer() is False:
+            return value_num
+        return json.loads(data)
+
+    def _drop_unused_domains(self):
+        """Remove domains without events or rollups from the domain dictionary, after deletes or updates"""
+        self.cur.execute(
+            """DELETE FROM indra_domains WHERE NOT EXISTS (
+                   SELECT 1 FROM indra_events WHERE domain_id = indra_domains.id)
+                   AND NOT EXISTS (SELECT 1 FROM indra_rollups WHERE domain_id = indra_domains.id);"""
+        )
+        if self.cur.rowcount > 0:
+            self.domain_ids = {}
+
+    def _partition_bounds(self, time_jd: float):
+        """Table name, jd_start and jd_end of the calendar month or year that contains time_jd"""
+        year, month = IndraTime.julian_to_discrete_time(time_jd)[:2]
+        if self.partition_period == "year":
+            month = 1
+        while True:
+            if self.partition_period == "year":
+                next_year, next_month = year + 1, 1
+            elif month == 12:
+                next_year, next_month = year + 1, 1
+            else:
+                next_year, next_month = year, month + 1
+            jd_start = IndraTime.discrete_time_to_julian(year, month, 1, 0, 0, 0, 0)
+            jd_end = IndraTime.discrete_time_to_julian(next_year, next_month, 1, 0, 0, 0, 0)
+            # Rounding of julian_to_discrete_time() at period boundaries
+            if time_jd < jd_start:
+                if self.partition_period == "year":
+                    year -= 1
+                elif month == 1:
+                    year, month = year - 1, 12
+                else:
+                    month -= 1
+            elif time_jd >= jd_end:
+                year, month = next_year, next_month
+            else:
+                break
+        table = f"indra_events_{'m' if year < 0 else ''}{abs(year):04d}"
+        if self.partition_period == "month":
+            table += f"_{month:02d}"
+        return table, jd_start, jd_end
+
+    def _partition_of(self, time_jd):
+        """Table of the partition that stores events of time_jd, the partition is created if needed
+
+        Events without time are stored in the current partition."""
+        if time_jd is None:
+            time_jd = IndraTime.datetime_to_julian(
+                datetime.datetime.now(tz=datetime.timezone.utc)
+            )
+        index = bisect.bisect_right(self.partitions, (time_jd, math.inf)) - 1
+        if index >= 0 and time_jd < self.partitions[index][1]:
+            return self.partitions[index][2]
+        table, jd_start, jd_end = self._partition_bounds(time_jd)
+        if len(self.partitions) >= self.max_partitions:
+            return self._partition_extend(index, jd_start, jd_end)
+        self._partition_create(table, jd_start, jd_end)
+        return table
+
+    def _partition_extend(self, index: int, jd_start: float, jd_end: float):
+        """Extend the partition before the period [jd_start, jd_end), or the first partition, to cover the period
+
+        Bounds the number of partitions (e.g. for historic or paleo data, which would need thousands
+        of month partitions). Partitions stay disjoint, the extended partition is archived again."""
+        if index >= 0:
+            partition_start, partition_end, table = self.partitions[index]
+            if index + 1 < len(self.partitions):
+                partition_end = min(jd_end, self.partitions[index + 1][0])
+            else:
+                partition_end = jd_end
+        else:
+            partition_end, table = self.partitions[0][1], self.partitions[0][2]
+            partition_start = jd_start
+            index = 0
+        self.log.info(
+            f"{len(self.partitions)} partitions (max_partitions) exist, extending {table} to {partition_start} - {partition_end}"
+        )
+        self.cur.execute(
+            "UPDATE indra_partitions SET jd_start = ?, jd_end = ?, version = version + 1 WHERE name = ?;",
+            [partition_start, partition_end, table],
+        )
+        self.partitions = (
+            self.partitions[:index] + [(partition_start, partition_end, table)] + self.partitions[index + 1:]
+        )
+        # Committed at once, read connections route by the new bounds as soon as they are in self.partitions
+        self.conn.commit()
+        return table
+
+    def _partition_create(self, table: str, jd_start: float, jd_end: float):
+        self.log.info(f"Creating partition {table}")
+        if table in [x[2] for x in self.archive_periods]:
+            self.log.warning(
+                f"Partition {table} was archived and dropped before, new events are archived separately"
+            )
+        self.cur.execute(self.partition_table.format(table=table))
+        for index_cmd in self.partition_indices:
+            self.cur.execute(index_cmd.format(table=table))
+        self.cur.execute(
+            "INSERT OR REPLACE INTO indra_partitions (name, jd_start, jd_end) VALUES (?, ?, ?);",
+            [table, jd_start, jd_end],
+        )
+        self.partitions = sorted(self.partitions + [(jd_start, jd_end, table)])
+        self._create_events_view()
+        # Committed at once, read connections may select from the new table as soon as it is in self.partitions
+        self.conn.commit()
+
+    @classmethod
+    def _union_all(cls, tables):
+        """UNION ALL of the tables, nested so that no compound SELECT exceeds SQLite's limit of terms
+
+        SQLite pushes WHERE terms into each partition of the UNION ALL and merges
+        index-ordered partition results, queries of the union use the partition indices."""
+        selects = [f"SELECT * FROM {table}" for table in tables]
+        limit = cls.compound_select_limit
+        while len(selects) > limit:
+            selects = [
+                "SELECT * FROM (" + " UNION ALL ".join(selects[i : i + limit]) + ")"
+                for i in range(0, len(selects), limit)
+            ]
+        return " UNION ALL ".join(selects)
+
+    def _create_events_view(self):
+        """(Re-)create indra_events as view of all partitions, used by maintenance queries of all events
+
+        Requests read the partitions of their time range, see _events_source()."""
+        self.cur.execute("DROP VIEW IF EXISTS indra_events;")
+        self.cur.execute(f"CREATE VIEW indra_events AS {self._union_all(x[2] for x in self.partitions)};")
+
+    def _partitions_load(self):
+        """Read the partition catalog, and make sure that the partition of the current time exists"""
+        self.cur.execute("SELECT jd_start, jd_end, name FROM indra_partitions ORDER BY jd_start;")
+        self.partitions = [tuple(x) for x in self.cur.fetchall()]
+        for partition in self.partitions:
+            self._value_num_migrate(partition[2])
+            for index_cmd in self.partition_indices:
+                self.cur.execute(index_cmd.format(table=partition[2]))
+        self._partition_of(None)
+        self._create_events_view()
+        self.conn.commit()
+
+    def _value_num_migrate(self, table: str):
+        """Add the value_num column to partitions created before it existed, and fill it from data"""
+        self.cur.execute(f"SELECT name FROM pragma_table_info('{table}');")
+        if "value_num" in [x[0] for x in self.cur.fetchall()]:
+            return
+        self.log.info(f"Adding value_num to {table}, this may take a while")
+        self.cur.execute(f"ALTER TABLE {table} ADD COLUMN value_num DOUBLE;")
+        self.cur.execute(f"UPDATE {table} SET value_num = {self.value_num_sql};")
+        self.conn.commit()
+
+    def _events_source(self, jd_start=None, jd_end=None):
+        """FROM source of the events between jd_start and jd_end, that only reads the overlapping partitions"""
+        partitions = self.partitions
+        tables = [
+            x[2]
+            for x in partitions
+            if (jd_end is None or x[0] <= jd_end) and (jd_start is None or x[1] > jd_start)
+        ]
+        if len(tables) == 1:
+            return tables[0]
+        if len(tables) == 0:
+            return f"(SELECT * FROM {partitions[-1][2]} WHERE 0)"
+        return "(" + self._union_all(tables) + ")"
+
+    def _delete_events(self, where_cmd: str, q_params: list):
+        """Delete the events selected by where_cmd from all partitions, returns the number of deleted events"""
+        num_deleted = 0
+        for partition in self.partitions:
+            self.cur.execute(f"DELETE FROM {partition[2]} WHERE {where_cmd};", q_params)
+            if self.cur.rowcount > 0:
+                num_deleted += self.cur.rowcount
+                self._partition_changed(partition[2])
+        return num_deleted
+
+    def _partition_changed(self, table: str):
+        # The archive job compares versions to detect changes during or after an export
+        self.cur.execute(
+            "UPDATE indra_partitions SET version = version + 1 WHERE name = ?;", [table]
+        )
+
+    def _retention_days(self, domain: str):
+        """Retention of `domain` in days, the longest of all matching retention patterns, None: kept forever"""
+        days = None
+        for pattern in self.retention:
+            if SubscriptionPattern.compile(pattern).match(domain) is True:
+                if days is None or self.retention[pattern] > days:
+                    days = self.retention[pattern]
+        return days
+
+    def _retention_timer(self):
+        # Runs in the timer thread, retention is applied by the writer
+        ev = IndraEvent()
+        ev.domain = "$self/retention"
+        self.event_send_self(ev)
+        return True
+
+    def _apply_retention(self):
+        """Remove events that are older than the retention of their domain
+
+        A partition is expired for a domain, once its end is older than the domain's retention.
+        Partitions that only hold expired domains are dropped as a whole, otherwise the expired
+        domains are deleted from the partition. Rollups of expired events are kept.
+        """
+        if len(self.retention) == 0:
+            return
+        self._flush_ingest_buffer()
+        now_jd = IndraTime.datetime_to_julian(
+            datetime.datetime.now(tz=datetime.timezone.utc)
+        )
+        dropped = []
+        num_deleted = 0
+        expired_domains = set()
+        retention_days = {}
+        archived = self._archived_partitions()
+        # The most recent partition is kept, the events view needs at least one table
+        for jd_start, jd_end, table in self.partitions[:-1]:
+            if self.archive_directory is not None and table not in archived:
+                # Expired events are removed once they are in the archive
+                continue
+            self.cur.execute(
+                f"SELECT d.id, d.domain FROM indra_domains d WHERE EXISTS (SELECT 1 FROM {table} WHERE domain_id = d.id);"
+            )
+            domains = self.cur.fetchall()
+            expired = []
+            for domain_id, domain in domains:
+                if domain not in retention_days:
+                    retention_days[domain] = self._retention_days(domain)
+                days = retention_days[domain]
+                if days is not None and jd_end <= now_jd - days:
+                    expired.append((domain_id, domain))
+            if len(expired) == len(domains):
+                dropped.append(table)
+            elif len(expired) > 0:
+                placeholders = ", ".join(["?"] * len(expired))
+                self.cur.execute(
+                    f"DELETE FROM {table} WHERE domain_id IN ({placeholders});",
+                    [x[0] for x in expired],
+                )
+                num_deleted += self.cur.rowcount
+            for _, domain in expired:
+                expired_domains.add(domain)
+        if len(dropped) > 0:
+            self.partitions = [x for x in self.partitions if x[2] not in dropped]
+            self._create_events_view()
+            for table in dropped:
+                self.cur.execute(f"DROP TABLE {table};")
+                # An archived period stays in indra_archive, its history is read from the parquet files
+                self.cur.execute("DELETE FROM indra_partitions WHERE name = ?;", [table])
+        for domain in expired_domains:
+            self._domain_stats_refresh(domain)
+            self.last_cache.pop(domain, None)
+        if len(expired_domains) > 0:
+            self._drop_unused_domains()
+        self.conn.commit()
+        self.bUncommitted = False
+        self.log.info(
+            f"Retention: dropped partitions {dropped}, deleted {num_deleted} events of other partitions"
+        )
+
+    def _archive_load(self):
+        self.cur.execute("SELECT jd_start, jd_end, name FROM indra_archive ORDER BY jd_start;")
+        self.archive_periods = [tuple(x) for x in self.cur.fetchall()]
+
+    def _archived_partitions(self):
+        """Names of the partitions that are unchanged since their export to the archive"""
+        self.cur.execute(
+            "SELECT p.name FROM indra_partitions p JOIN indra_archive a ON a.name = p.name AND a.version = p.version;"
+        )
+        return set(x[0] for x in self.cur.fetchall())
+
+    def _archive_path(self, domain: str, period: str):
+        # One directory per domain, one file per period: pq.read_table() of a directory reads a domain's archive
+        return os.path.join(
+            self.archive_directory, urllib.parse.quote(domain, safe="$"), f"{period}.parquet"
+        )
+
+    def _archive_timer(self):
+        # Runs in the timer thread with its own read-only connection, the writer is not blocked
+        try:
+            conn = sqlite3.connect(f"file:{self.database}?mode=ro", uri=True)
+        except sqlite3.Error as e:
+            self.log.error(f"Archive: failed to open {self.database}: {e}")
+            return False
+        now_jd = IndraTime.datetime_to_julian(
+            datetime.datetime.now(tz=datetime.timezone.utc)
+        )
+        ret = True
+        try:
+            cur = conn.cursor()
+            cur.execute(
+                """SELECT p.name, p.jd_start, p.jd_end, a.domains FROM indra_partitions p
+                   LEFT JOIN indra_archive a ON a.name = p.name
+                   WHERE p.jd_end <= ? AND (a.version IS NULL OR a.version != p.version)
+                   ORDER BY p.jd_start;""",
+                [now_jd],
+            )
+            for table, jd_start, jd_end, old_domains in cur.fetchall():
+                if self._archive_partition(conn, table, jd_start, jd_end, old_domains) is False:
+                    ret = False
+        except Exception as e:
+            self.log.error(f"Archive job failed: {e}")
+            ret = False
+        conn.close()
+        return ret
+
+    def _archive_partition(self, conn, table: str, jd_start: float, jd_end: float, old_domains):
+        """Export the events of the archive domains of one closed partition to parquet files
+
+        Each file holds the events of one domain sorted by time, with the numeric value of
+        number/ events in the float64 column `value`. The writer records the export, if the
+        partition was not changed in the meantime.
+        """
+        cur = conn.cursor()
+        # One read transaction: the version belongs to the exported snapshot
+        cur.execute("BEGIN;")
+        cur.execute("SELECT version FROM indra_partitions WHERE name = ?;", [table])
+        version = cur.fetchone()[0]
+        cur.execute(
+            f"""SELECT d.domain, e.time_jd_start, e.time_jd_end, e.seq_no, e.uuid4, e.from_id, t.data_type, e.data,
+                   e.value_num
+                FROM {table} e
+                JOIN indra_domains d ON d.id = e.domain_id
+                JOIN indra_data_types t ON t.id = e.data_type_id
+                ORDER BY e.domain_id, e.time_jd_start;"""
+        )
+        domains = []
+        rows = []
+        current = None
+        for row in cur:
+            if row[0] != current:
+                if current is not None and len(rows) > 0:
+                    self._archive_write(current, table, rows)
+                    domains.append(current)
+                current = row[0]
+                rows = []
+                if self.archive_patterns.match_any(current) is False:
+                    current = None
+            if current is not None:
+                rows.append(row)
+        if current is not None and len(rows) > 0:
+            self._archive_write(current, table, rows)
+            domains.append(current)
+        conn.commit()
+        if old_domains is not None:
+            # Files of domains that no longer have events in this period
+            for domain in set(json.loads(old_domains)) - set(domains):
+                path = self._archive_path(domain, table)
+                if os.path.exists(path):
+                    os.remove(path)
+        self.log.info(f"Archive: exported {len(domains)} domains of {table}")
+        ev = IndraEvent()
+        ev.domain = "$self/archived"
+        ev.data_type = "json/archived"
+        ev.data = json.dumps(
+            {"name": table, "jd_start": jd_start, "jd_end": jd_end, "version": version, "domains": domains}
+        )
+        self.event_send_self(ev)
+        return True
+
+    def _archive_write(self, domain: str, period: str, rows):
+        archive_table = pa.table(
+            {
+                "time_jd_start": pa.array([x[1] for x in rows], type=pa.float64()),
+                "time_jd_end": pa.array([x[2] for x in rows], type=pa.float64()),
+                "seq_no": pa.array([x[3] for x in rows], type=pa.int64()),
+                "uuid4": pa.array([x[4] for x in rows], type=pa.string()),
+                "from_id": pa.array([x[5] for x in rows], type=pa.string()),
+                "data_type": pa.array([x[6] for x in rows], type=pa.string()),
+                "value": pa.array([x[8] for x in rows], type=pa.float64()),
+                "data": pa.array([x[7] for x in rows], type=pa.string()),
+            }
+        )
+        path = self._archive_path(domain, period)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        # Readers never see partially written files
+        pq.write_table(archive_table, path + ".tmp")
+        os.replace(path + ".tmp", path)
+
+    def _send_stat(self, stat: str, data: dict):
+        """Publish database statistics as $sys/stat/db/<stat> event"""
+        ev = IndraEvent()
+        ev.domain = f"$sys/stat/db/{stat}"
+        ev.from_id = self.name
+        ev.data_type = "json"
+        ev.data = json.dumps(data)
+        self.event_send(ev)
+
+    def _stats_begin(self, domain: str):
+        """Start the statistics of the request that is served by the current thread"""
+        if self.stats_local is None:
+            return
+        self.stats_local.current = {
+            "kind": domain[len("$trx/"):],
+            "start": time.time(),
+            "sql_sec": 0.0,
+            "vm_steps": 0,
+            "rows": 0,
+            "json_sec": 0.0,
+            "reply_bytes": 0,
+            "error": False,
+        }
+
+    def _stats_current(self):
+        if self.stats_local is None:
+            return None
+        return getattr(self.stats_local, "current", None)
+
+    def _stats_discard(self):
+        # The request is continued by another thread, which has its own statistics
+        if self.stats_local is not None:
+            self.stats_local.current = None
+
+    def _stats_end(self):
+        """Add the statistics of the current request to the totals of its request type"""
+        current = self._stats_current()
+        if current is None:
+            return
+        self.stats_local.current = None
+        latency_ms = (time.time() - current["start"]) * 1000
+        bucket = len(self.latency_buckets_ms)
+        for index, bound in enumerate(self.latency_buckets_ms):
+            if latency_ms <= bound:
+                bucket = index
+                break
+        with self.stats_lock:
+            stats = self.request_stats.get(current["kind"])
+            if stats is None:
+                stats = {
+                    "count": 0,
+                    "errors": 0,
+                    "latency_ms_hist": [0] * (len(self.latency_buckets_ms) + 1),
+                    "latency_ms_sum": 0.0,
+                    "latency_ms_max": 0.0,
+                    "sql_ms": 0.0,
+                    "vm_steps": 0,
+                    "rows": 0,
+                    "json_ms": 0.0,
+                    "reply_bytes": 0,
+                }
+                self.request_stats[current["kind"]] = stats
+            stats["count"] += 1
+            if current["error"] is True:
+                stats["errors"] += 1
+            stats["latency_ms_hist"][bucket] += 1
+            stats["latency_ms_sum"] += latency_ms
+            stats["latency_ms_max"] = max(stats["latency_ms_max"], latency_ms)
+            stats["sql_ms"] += current["sql_sec"] * 1000
+            stats["vm_steps"] += current["vm_steps"]
+            stats["rows"] += current["rows"]
+            stats["json_ms"] += current["json_sec"] * 1000
+            stats["reply_bytes"] += current["reply_bytes"]
+
+    def _stats_timer(self):
+        # Runs in the timer thread: publish and reset the request statistics
+        with self.stats_lock:
+            request_stats = self.request_stats
+            self.request_stats = {}
+        if len(request_stats) > 0:
+            self._send_stat(
+                "requests",
+                {"latency_buckets_ms": self.latency_buckets_ms, "requests": request_stats},
+            )
+        return True
+
+    def _query(self, cur, sql_cmd: str, params):
+        """Execute a read query and fetch all rows, with timing and slow-query log
+
+        sqlite3 doesn't expose the rows a statement scanned, the work of a query is measured in
+        virtual machine steps (counted in units of vm_steps_resolution by a progress handler),
+        which grow with the rows visited. Queries that take longer than slow_query_ms are logged
+        with their query plan.
+        """
+        self.log.debug(f"Executing {sql_cmd} with {params}")
+        ticks = [0]
+
+        def count_steps():
+            ticks[0] += 1
+            return 0
+
+        cur.connection.set_progress_handler(count_steps, self.vm_steps_resolution)
+        start_time = time.time()
+        try:
+            cur.execute(sql_cmd, params)
+            result = cur.fetchall()
+        finally:
+            cur.connection.set_progress_handler(None, 0)
+        sql_sec = time.time() - start_time
+        vm_steps = ticks[0] * self.vm_steps_resolution
+        current = self._stats_current()
+        if current is not None:
+            current["sql_sec"] += sql_sec
+            current["vm_steps"] += vm_steps
+            current["rows"] += len(result)
+        if sql_sec * 1000 > self.slow_query_ms:
+            try:
+                cur.execute(f"EXPLAIN QUERY PLAN {sql_cmd}", params)
+                plan = [x[3] for x in cur.fetchall()]
+            except sqlite3.Error as e:
+                plan = [f"not available: {e}"]
+            self.log.warning(
+                f"Slow query, {sql_sec * 1000:.0f} ms, ~{vm_steps} VM steps, {len(result)} rows: {sql_cmd} with {params}, plan: {plan}"
+            )
+        return result
+
+    def _encode(self, data):
+        """JSON encoding of reply data, with timing"""
+        start_time = time.time()
+        encoded = json.dumps(data)
+        current = self._stats_current()
+        if current is not None:
+            current["json_sec"] += time.time() - start_time
+            current["reply_bytes"] += len(encoded)
+        return encoded
+
+    def _checkpoint_timer(self):
+        # Runs in the timer thread, the checkpoint is run by the writer
+        ev = IndraEvent()
+        ev.domain = "$self/checkpoint"
+        self.event_send_self(ev)
+        return True
+
+    def _checkpoint(self):
+        """Copy the WAL into the database, and truncate the WAL once it exceeds checkpoint_truncate_mb
+
+        A PASSIVE checkpoint copies what readers allow without waiting. Readers that keep old
+        snapshots prevent the WAL from being reset, so it keeps growing; TRUNCATE waits (up to the
+        busy timeout) for the readers and shrinks the WAL file to zero bytes.
+        """
+        self._flush_ingest_buffer()
+        if self.bUncommitted is True:
+            self.conn.commit()
+            self.bUncommitted = False
+        wal_file = f"{self.database}-wal"
+        start_time = time.time()
+        try:
+            wal_bytes = os.path.getsize(wal_file)
+        except OSError:
+            wal_bytes = 0
+        if wal_bytes > self.checkpoint_truncate_mb * 1024 * 1024:
+            mode = "TRUNCATE"
+        else:
+            mode = "PASSIVE"
+        try:
+            self.cur.execute(f"PRAGMA wal_checkpoint({mode});")
+            busy, wal_frames, checkpointed = self.cur.fetchone()
+        except sqlite3.Error as e:
+            self.log.error(f"WAL checkpoint {mode} failed: {e}")
+            return
+        try:
+            wal_bytes_after = os.path.getsize(wal_file)
+        except OSError:
+            wal_bytes_after = 0
+        if mode == "TRUNCATE":
+            self.log.info(
+                f"WAL checkpoint {mode}: {wal_bytes} -> {wal_bytes_after} bytes, busy={busy}, {time.time() - start_time:.3f} sec"
+            )
+        self._send_stat(
+            "checkpoint",
+            {
+                "mode": mode,
+                "busy": busy,
+                "wal_frames": wal_frames,
+                "checkpointed_frames": checkpointed,
+                "wal_bytes": wal_bytes_after,
+                "sec": time.time() - start_time,
+            },
+        )
+
+    def _backup_timer(self):
+        """Online backup of the database with the sqlite backup API, runs in the timer thread
+
+        Pages are copied in steps of backup_pages_per_step from one read transaction: the backup
+        is the snapshot of its start, the writer continues meanwhile. Progress is published as
+        $sys/stat/db/backup events.
+        """
+        if os.path.exists(self.backup_directory) is False:
+            try:
+                os.makedirs(self.backup_directory)
+            except OSError as e:
+                self.log.error(f"Backup: failed to create {self.backup_directory}: {e}")
+                return False
+        name = os.path.splitext(os.path.basename(self.database))[0]
+        stamp = datetime.datetime.now(tz=datetime.timezone.utc).strftime("%Y%m%d-%H%M%S")
+        backup_file = os.path.join(self.backup_directory, f"{name}-{stamp}.db")
+        tmp_file = f"{backup_file}.tmp"
+        start_time = time.time()
+        progress = {"last_stat": 0.0}
+
+        def backup_progress(status, remaining, total):
+            # Rate-limited, a step of a small database takes milliseconds
+            if time.time() - progress["last_stat"] >= 1.0:
+                progress["last_stat"] = time.time()
+                self._send_stat(
+                    "backup",
+                    {
+                        "file": backup_file,
+                        "state": "running",
+                        "remaining_pages": remaining,
+                        "total_pages": total,
+                        "sec": time.time() - start_time,
+                    },
+                )
+
+        ret = True
+        src = None
+        dst = None
+        try:
+            src = sqlite3.connect(f"file:{self.database}?mode=ro", uri=True, isolation_level=None)
+            dst = sqlite3.connect(tmp_file)
+            # Without a snapshot, each write of the writer would restart the backup
+            src.execute("BEGIN;")
+            src.execute("SELECT COUNT(*) FROM sqlite_master;").fetchone()
+            src.backup(dst, pages=self.backup_pages_per_step, progress=backup_progress, sleep=0.01)
+            src.execute("COMMIT;")
+            # A single self-contained file
+            dst.execute("PRAGMA journal_mode = DELETE;")
+            dst.close()
+            dst = None
+            os.replace(tmp_file, backup_file)
+        except (sqlite3.Error, OSError) as e:
+            self.log.error(f"Backup to {backup_file} failed: {e}")
+            ret = False
+        if dst is not None:
+            dst.close()
+            if os.path.exists(tmp_file):
+                os.remove(tmp_file)
+        if src is not None:
+            src.close()
+        state = {
+            "file": backup_file,
+            "state": "done" if ret is True else "failed",
+            "sec": time.time() - start_time,
+        }
+        if ret is True:
+            state["bytes"] = os.path.getsize(backup_file)
+            self.log.info(f"Backup {backup_file} complete in {state['sec']:.1f} sec")
+            self._backup_cleanup(name)
+        self._send_stat("backup", state)
+        return ret
+
+    def _backup_cleanup(self, name: str):
+        """Remove all but the newest backup_keep backups"""
+        if self.backup_keep <= 0:
+            return
+        backups = sorted(
+            x
+            for x in os.listdir(self.backup_directory)
+            if x.startswith(f"{name}-") and x.endswith(".db")
+        )
+        for backup in backups[: -self.backup_keep]:
+            try:
+                os.remove(os.path.join(self.backup_directory, backup))
+                self.log.info(f"Removed old backup {backup}")
+            except OSError as e:
+                self.log.error(f"Failed to remove old backup {backup}: {e}")
+
+    def _archive_done(self, ev: IndraEvent):
+        """Record an export of the archive job, unless the partition changed since its snapshot"""
+        archived = json.loads(ev.data)
+        self.cur.execute("SELECT version FROM indra_partitions WHERE name = ?;", [archived["name"]])
+        result = self.cur.fetchone()
+        if result is None or result[0] != archived["version"]:
+            self.log.info(f"Archive: {archived['name']} changed during export, exported again next run")
+            return
+        self.cur.execute(
+            """INSERT OR REPLACE INTO indra_archive (name, jd_start, jd_end, version, domains)
+               VALUES (?, ?, ?, ?, ?);""",
+            [
+                archived["name"],
+                archived["jd_start"],
+                archived["jd_end"],
+                archived["version"],
+                json.dumps(archived["domains"]),
+            ],
+        )
+        self.conn.commit()
+        self.bUncommitted = False
+        self._archive_load()
+
+    def _archive_history(self, rq_data, jd_start, jd_end):
+        """(jd, value) of the events of the requested domain in archived periods that are no longer partitions
+
+        Only exact domains are served from the archive."""
+        if (
+            pq is None
+            or self.archive_directory is None
+            or "%" in rq_data["domain"]
+            or len(self.archive_periods) == 0
+        ):
+            return []
+        partitions = set(x[2] for x in self.partitions)
+        filters = []
+        if jd_start is not None:
+            filters.append(("time_jd_start", ">=", jd_start))
+        if jd_end is not None:
+            filters.append(("time_jd_start", "<=", jd_end))
+            filters.append(("time_jd_end", "<=", jd_end))
+        data_type_regex = None
+        if rq_data.get("data_type") is not None and len(rq_data["data_type"]) > 0:
+            data_type_regex = self._like_regex(rq_data["data_type"])
+        points = []
+        for period_start, period_end, period in self.archive_periods:
+            if period in partitions:
+                continue
+            if (jd_end is not None and period_start > jd_end) or (
+                jd_start is not None and period_end <= jd_start
+            ):
+                continue
+            path = self._archive_path(rq_data["domain"], period)
+            if os.path.exists(path) is False:
+                continue
+            archive_table = pq.read_table(
+                path,
+                columns=["time_jd_start", "data_type", "value", "data"],
+                filters=filters if len(filters) > 0 else None,
+            )
+            for jd, data_type, value, data in zip(
+                archive_table.column("time_jd_start").to_pylist(),
+                archive_table.column("data_type").to_pylist(),
+                archive_table.column("value").to_pylist(),
+                archive_table.column("data").to_pylist(),
+            ):
+                if data_type_regex is not None and data_type_regex.fullmatch(data_type) is None:
+                    continue
+                points.append((jd, self._history_value(value, data)))
+        points.sort(key=lambda x: x[0])
+        return points
+
+    def _migrate_partitions(self):
+        """Move the events of a single indra_events table into time partitions"""
+        self.cur.execute("SELECT type FROM sqlite_master WHERE name = 'indra_events';")
+        result = self.cur.fetchone()
+        if result is not None and result[0] == "table":
+            # The name indra_events is needed for the view of all partitions
+            self.cur.execute("ALTER TABLE indra_events RENAME TO indra_events_unpartitioned;")
+            self.conn.commit()
+        self.cur.execute(
+            "SELECT name FROM sqlite_master WHERE name = 'indra_events_unpartitioned';"
+        )
+        if self.cur.fetchone() is None:
+            return True
+        self.log.info("Migrating indra_events to time partitions, this may take a while")
+        columns = """id, seq_no, domain_id, from_id, uuid4, parent_uuid4, to_scope,
+                     time_jd_start, data_type_id, data, auth_hash, time_jd_end"""
+        try:
+            # One commit per partition, ids are kept: an interrupted migration is simply repeated
+            self.cur.execute("SELECT MIN(time_jd_start) FROM indra_events_unpartitioned;")
+            time_jd = self.cur.fetchone()[0]
+            while time_jd is not None:
+                table, jd_start, jd_end = self._partition_bounds(time_jd)
+                self._partition_create(table, jd_start, jd_end)
+                self.cur.execute(
+                    f"""INSERT OR IGNORE INTO {table} ({columns}, value_num)
+                        SELECT {columns}, {self.value_num_sql} FROM indra_events_unpartitioned
+                        WHERE time_jd_start >= ? AND time_jd_start < ?;""",
+                    [jd_start, jd_end],
+                )
+                self.conn.commit()
+                self.cur.execute(
+                    "SELECT MIN(time_jd_start) FROM indra_events_unpartitioned WHERE time_jd_start >= ?;",
+                    [jd_end],
+                )
+                time_jd = self.cur.fetchone()[0]
+            table = self._partition_of(None)
+            self.cur.execute(
+                f"""INSERT OR IGNORE INTO {table} ({columns}, value_num)
+                    SELECT {columns}, {self.value_num_sql} FROM indra_events_unpartitioned WHERE time_jd_start IS NULL;"""
+            )
+            self.cur.execute("DROP TABLE indra_events_unpartitioned;")
+            self.conn.commit()
         except sqlite3.Error as e:
-            self.log.error(f"Failed to write event-record: {e}")
+            self.log.error(f"Failed to migrate indra_events to partitions: {e}")
+            self.conn.rollback()
             return False
+        self.log.info("Migration of indra_events to partitions complete, run VACUUM to reclaim space")
         return True
 
+    def _is_rollup_domain(self, domain: str):
+        return self.rollup_patterns.match_any(domain)
+
+    @staticmethod
+    def _rollup_bucket(time_jd: float, resolution_sec: int):
+        # Same truncation as CAST(time_jd_start * 86400 / resolution_sec AS INTEGER) in SQL
+        return int(time_jd * 86400 / resolution_sec)
+
+    def _rollup_add(self, rows):
+        """Add newly written event-records (dicts) incrementally to the rollup table"""
+        if len(self.rollup_patterns) == 0:
+            return
+        aggs = {}
+        for row in rows:
+            value = row["value_num"]
+            if (
+                value is None
+                or row["time_jd_start"] is None
+                or self._is_rollup_domain(row["domain"]) is False
+            ):
+                continue
+            for resolution_sec in self.rollup_resolutions:
+                key = (
+                    row["domain_id"],
+                    resolution_sec,
+                    self._rollup_bucket(row["time_jd_start"], resolution_sec),
+                )
+                agg = aggs.get(key)
+                if agg is None:
+                    aggs[key] = [1, value, value, value]
+                else:
+                    agg[0] += 1
+                    agg[1] += value
+                    agg[2] = min(agg[2], value)
+                    agg[3] = max(agg[3], value)
+        if len(aggs) == 0:
+            return
+        cmd = """INSERT INTO indra_rollups (
+                    domain_id, resolution_sec, bucket, count, sum, min, max)
+                 VALUES (?, ?, ?, ?, ?, ?, ?)
+                 ON CONFLICT (domain_id, resolution_sec, bucket) DO UPDATE SET
+                    count = count + excluded.count,
+                    sum = sum + excluded.sum,
+                    min = MIN(min, excluded.min),
+                    max = MAX(max, excluded.max);
+              """
+        self.cur.executemany(cmd, [key + tuple(agg) for key, agg in aggs.items()])
+
+    def _rollup_recompute(self, domain: str, time_jd: float):
+        """Rebuild the rollup buckets of `domain` that contain `time_jd` from the events table"""
+        if time_jd is None or self._is_rollup_domain(domain) is False:
+            return
+        domain_id = self._domain_id(domain)
+        for resolution_sec in self.rollup_resolutions:
+            self._rollup_recompute_bucket(
+                domain_id, resolution_sec, self._rollup_bucket(time_jd, resolution_sec)
+            )
+
+    def _rollup_recompute_bucket(self, domain_id: int, resolution_sec: int, bucket: int):
+        self.cur.execute(
+            "DELETE FROM indra_rollups WHERE domain_id = ? AND resolution_sec = ? AND bucket = ?;",
+            [domain_id, resolution_sec, bucket],
+        )
+        # The time range allows the index to be used, the bucket condition is exact
+        jd_start = (bucket - 1) * resolution_sec / 86400
+        jd_end = (bucket + 2) * resolution_sec / 86400
+        cmd = f"""INSERT INTO indra_rollups (
+                    domain_id, resolution_sec, bucket, count, sum, min, max)
+                 SELECT domain_id, :res, :bucket, COUNT(*), SUM(value_num), MIN(value_num), MAX(value_num)
+                 FROM {self._events_source(jd_start, jd_end)} WHERE domain_id = :domain_id
+                    AND value_num IS NOT NULL
+                    AND time_jd_start >= :jd_start AND time_jd_start < :jd_end
+                    AND CAST(time_jd_start * 86400 / :res AS INTEGER) = :bucket
+                 GROUP BY domain_id;
+              """
+        self.cur.execute(
+            cmd,
+            {
+                "res": resolution_sec,
+                "bucket": bucket,
+                "domain_id": domain_id,
+                "jd_start": jd_start,
+                "jd_end": jd_end,
+            },
+        )
+
+    def _rollup_backfill(self):
+        """Compute the rollups of all existing events, used once when the rollup table is created"""
+        self.cur.execute("SELECT id, domain FROM indra_domains;")
+        domain_ids = [x[0] for x in self.cur.fetchall() if self._is_rollup_domain(x[1])]
+        self.log.info(f"Computing rollups for {len(domain_ids)} domains, this may take a while")
+        cmd = """INSERT INTO indra_rollups (
+                    domain_id, resolution_sec, bucket, count, sum, min, max)
+                 SELECT domain_id, :res, CAST(time_jd_start * 86400 / :res AS INTEGER) AS rollup_bucket,
+                    COUNT(*), SUM(value_num), MIN(value_num), MAX(value_num)
+                 FROM indra_events WHERE domain_id = :domain_id
+                    AND value_num IS NOT NULL
+                    AND time_jd_start IS NOT NULL
+                 GROUP BY rollup_bucket;
+              """
+        for domain_id in domain_ids:
+            for resolution_sec in self.rollup_resolutions:
+                self.cur.execute(cmd, {"res": resolution_sec, "domain_id": domain_id})
+        self.conn.commit()
+        self.log.info("Rollups computed")
+
     def _get_secure_key_names(self, config_data):
         self.secure_keys = ["entity/indrajala/user/+/password"]
         if "secure_keys" in config_data:
@@ -352,7 +1676,7 @@ class IndraProcess(IndraProcessCore):
                  VALUES (
                     :seq_no, :key, :value);
               """
-        self.hash_cache = None
+        self._credential_cache_invalidate(key)
         try:
             self.cur.execute(
                 cmd,
@@ -371,9 +1695,8 @@ class IndraProcess(IndraProcessCore):
 
     def _delete_event(self, uuid4: str):
         """Delete an IndraEvent from the database"""
-        cmd = "DELETE FROM indra_events WHERE uuid4 = ?;"
         try:
-            self.cur.execute(cmd, [uuid4])
+            self._delete_events("uuid4 = ?", [uuid4])
             self._check_commit()
             # self.log.info(f"Deleted {uuid4}")
         except sqlite3.Error as e:
@@ -383,14 +1706,11 @@ class IndraProcess(IndraProcessCore):
 
     def _delete_kv(self, key: str):
         """Delete a key/value pair from the database"""
-        self.hash_cache = None
-        if "%" in key:
-            op1 = "LIKE"
-        else:
-            op1 = "="
-        cmd = f"DELETE FROM indra_kv WHERE key {op1} ?;"
+        self._credential_cache_invalidate(key)
+        key_cond, q_params = self._match_condition("key", key)
+        cmd = f"DELETE FROM indra_kv WHERE {key_cond};"
         try:
-            self.cur.execute(cmd, [key])
+            self.cur.execute(cmd, q_params)
             self._check_commit()
             self.log.info(f"Deleted {key}")
         except sqlite3.Error as e:
@@ -400,16 +1720,15 @@ class IndraProcess(IndraProcessCore):
 
     def _read_kv(self, key: str):
         """Read a value(s) from the database"""
+        key_cond, q_params = self._match_condition("key", key)
         if "%" in key:
-            op1 = "LIKE"
             lim = ""
         else:
-            op1 = "="
             lim = " LIMIT 1"
-        cmd = f"SELECT key, value FROM indra_kv WHERE key {op1} ?{lim};"
+        cmd = f"SELECT key, value FROM indra_kv WHERE {key_cond}{lim};"
         start_time = time.time()
         try:
-            self.cur.execute(cmd, [key])
+            self.cur.execute(cmd, q_params)
             result = self.cur.fetchall()
             if result is not None:
                 value = result
@@ -435,10 +1754,59 @@ class IndraProcess(IndraProcessCore):
             return True
         return False
 
-    def _db_open(self):
-        """Open database and tune it using pragmas"""
+    def _migrate_interned_events(self):
+        """Migrate an indra_events table that stores domain and data_type as text to interned ids"""
+        self.cur.execute("SELECT name FROM pragma_table_info('indra_events');")
+        columns = [x[0] for x in self.cur.fetchall()]
+        if "domain" not in columns:
+            return True
+        self.log.info("Migrating indra_events to interned domains and data_types, this may take a while")
+        cmd = """CREATE TABLE IF NOT EXISTS indra_domains (
+                 id INTEGER PRIMARY KEY,
+                 domain TEXT NOT NULL UNIQUE );
+                 CREATE TABLE IF NOT EXISTS indra_data_types (
+                 id INTEGER PRIMARY KEY,
+                 data_type TEXT NOT NULL UNIQUE );
+                 INSERT OR IGNORE INTO indra_domains (domain) SELECT DISTINCT domain FROM indra_events;
+                 INSERT OR IGNORE INTO indra_data_types (data_type) SELECT DISTINCT data_type FROM indra_events;
+                 ALTER TABLE indra_events RENAME TO indra_events_text;
+                 CREATE TABLE indra_events (
+                 id INTEGER PRIMARY KEY,
+                 seq_no INTEGER NOT NULL,
+                 domain_id INTEGER NOT NULL REFERENCES indra_domains (id),
+                 from_id TEXT NOT NULL,
+                 uuid4 UUID NOT NULL,
+                 parent_uuid4 UUID,
+                 to_scope TEXT NOT NULL,
+                 time_jd_start DOUBLE,
+                 data_type_id INTEGER NOT NULL REFERENCES indra_data_types (id),
+                 data TEXT NOT NULL,
+                 auth_hash TEXT,
+                 time_jd_end DOUBLE );
+                 INSERT INTO indra_events (
+                    id, seq_no, domain_id, from_id, uuid4, parent_uuid4, to_scope,
+                    time_jd_start, data_type_id, data, auth_hash, time_jd_end)
+                 SELECT e.id, e.seq_no, d.id, e.from_id, e.uuid4, e.parent_uuid4, e.to_scope,
+                    e.time_jd_start, t.id, e.data, e.auth_hash, e.time_jd_end
+                 FROM indra_events_text e
+                 JOIN indra_domains d ON d.domain = e.domain
+                 JOIN indra_data_types t ON t.data_type = e.data_type;
+                 DROP TABLE indra_events_text;
+              """
         try:
-            self.conn = sqlite3.connect(self.database)
+            # executescript() commits pending changes first, the script is one transaction
+            self.cur.executescript("BEGIN;\n" + cmd + "\nCOMMIT;")
+        except sqlite3.Error as e:
+            self.log.error(f"Failed to migrate indra_events: {e}")
+            self.conn.rollback()
+            return False
+        self.log.info("Migration of indra_events complete, run VACUUM to reclaim space")
+        return True
+
+    def _db_open(self):
+        """Open database and tune it using pragmas"""
+        try:
+            self.conn = sqlite3.connect(self.database, cached_statements=self.cached_statements)
             self.cur = self.conn.cursor()
         except sqlite3.Error as e:
             self.log.error(f"Failed to open database at {self.database}: {e}")
@@ -481,22 +1849,29 @@ class IndraProcess(IndraProcessCore):
         else:
             self.log.debug("PRAGMA optimization success")
 
-        cmd = """CREATE TABLE IF NOT EXISTS indra_events (
+        if self._migrate_interned_events() is False:
+            return False
+
+        cmd = """CREATE TABLE IF NOT EXISTS indra_domains (
                  id INTEGER PRIMARY KEY,
-                 seq_no INTEGER NOT NULL,
-                 domain TEXT NOT NULL,
-                 from_id TEXT NOT NULL,
-                 uuid4 UUID NOT NULL,
-                 parent_uuid4 UUID,
-                 to_scope TEXT NOT NULL,
-                 time_jd_start DOUBLE,
-                 data_type TEXT NOT NULL,
-                 data TEXT NOT NULL,
-                 auth_hash TEXT,
-                 time_jd_end DOUBLE );
+                 domain TEXT NOT NULL UNIQUE );
+                 CREATE TABLE IF NOT EXISTS indra_data_types (
+                 id INTEGER PRIMARY KEY,
+                 data_type TEXT NOT NULL UNIQUE );
+                 CREATE TABLE IF NOT EXISTS indra_partitions (
+                 name TEXT PRIMARY KEY,
+                 jd_start DOUBLE NOT NULL,
+                 jd_end DOUBLE NOT NULL,
+                 version INTEGER NOT NULL DEFAULT 0 );
+                 CREATE TABLE IF NOT EXISTS indra_archive (
+                 name TEXT PRIMARY KEY,
+                 jd_start DOUBLE NOT NULL,
+                 jd_end DOUBLE NOT NULL,
+                 version INTEGER NOT NULL,
+                 domains TEXT NOT NULL );
               """
         try:
-            _ = self.cur.execute(cmd)
+            _ = self.cur.executescript(cmd)
         except sqlite3.Error as e:
             self.log.error(f"Failure to create table: {e}")
             return False
@@ -514,25 +1889,53 @@ class IndraProcess(IndraProcessCore):
             self.log.error(f"Failure to create table: {e}")
             return False
 
+        self.cur.execute("SELECT name FROM pragma_table_info('indra_rollups');")
+        rollup_columns = [x[0] for x in self.cur.fetchall()]
+        if "domain" in rollup_columns:
+            # Rollups are derived data, tables of the text-domain format are rebuilt
+            self.log.info("Rebuilding rollup table with interned domains")
+            self.cur.execute("DROP TABLE indra_rollups;")
+            rollup_columns = []
+        cmd = """CREATE TABLE IF NOT EXISTS indra_rollups (
+             domain_id INTEGER NOT NULL REFERENCES indra_domains (id),
+             resolution_sec INTEGER NOT NULL,
+             bucket INTEGER NOT NULL,
+             count INTEGER NOT NULL,
+             sum DOUBLE NOT NULL,
+             min DOUBLE NOT NULL,
+             max DOUBLE NOT NULL,
+             PRIMARY KEY (domain_id, resolution_sec, bucket) ) WITHOUT ROWID;
+              """
+
+        try:
+            _ = self.cur.execute(cmd)
+        except sqlite3.Error as e:
+            self.log.error(f"Failure to create rollup table: {e}")
+            return False
+
         self.log.debug("Tables available")
 
-        cmd = """CREATE INDEX IF NOT EXISTS indra_events_domain ON indra_events (domain);
-                 CREATE INDEX IF NOT EXISTS indra_events_from_id ON indra_events (to_scope);
-                 CREATE INDEX IF NOT EXISTS indra_events_time_start ON indra_events (time_jd_start);
-                 CREATE INDEX IF NOT EXISTS indra_events_data_type ON indra_events (data_type);
-                 CREATE INDEX IF NOT EXISTS indra_events_time_end ON indra_events (time_jd_end);
-                 CREATE INDEX IF NOT EXISTS indra_events_seq_no ON indra_events (seq_no);
-                 CREATE INDEX IF NOT EXISTS indra_events_uuid4 ON indra_events (uuid4);
-                 CREATE INDEX IF NOT EXISTS indra_events_parent_uuid4 ON indra_events (parent_uuid4);
-              """
+        self.cur.execute("SELECT name FROM pragma_table_info('indra_partitions');")
+        if "version" not in [x[0] for x in self.cur.fetchall()]:
+            self.cur.execute(
+                "ALTER TABLE indra_partitions ADD COLUMN version INTEGER NOT NULL DEFAULT 0;"
+            )
+        self._archive_load()
         try:
-            _ = self.cur.executescript(cmd)
+            if self._migrate_partitions() is False:
+                return False
+            self._partitions_load()
         except sqlite3.Error as e:
-            self.log.error(f"Failure to create indices: {e}")
+            self.log.error(f"Failure to create partitions: {e}")
             return False
+        self.log.info(f"{len(self.partitions)} event partitions available")
 
+        # NOCASE indices serve the case-insensitive prefix ranges of _match_condition()
         cmd = """CREATE INDEX IF NOT EXISTS indra_kv_key ON indra_kv (key);
+                 CREATE INDEX IF NOT EXISTS indra_kv_key_nocase ON indra_kv (key COLLATE NOCASE);
                  CREATE INDEX IF NOT EXISTS indra_kv_seq_no ON indra_kv (seq_no);
+                 CREATE INDEX IF NOT EXISTS indra_domains_nocase ON indra_domains (domain COLLATE NOCASE);
+                 CREATE INDEX IF NOT EXISTS indra_data_types_nocase ON indra_data_types (data_type COLLATE NOCASE);
         """
 
         try:
@@ -541,12 +1944,346 @@ class IndraProcess(IndraProcessCore):
             self.log.error(f"Failure to create indices: {e}")
             return False
 
+        # Update the planner statistics, if needed
+        self.cur.execute("PRAGMA optimize;")
         self.log.debug("Indices available")
 
+        if len(rollup_columns) == 0 and len(self.rollup_patterns) > 0:
+            try:
+                self._rollup_backfill()
+            except sqlite3.Error as e:
+                self.log.error(f"Failure to compute rollups: {e}")
+                return False
+
         seq_no, seq_kv_no = self._get_last_seq_no()
         self.log.info(f"Database opened, seq_no={seq_no}, seq_kv_no={seq_kv_no}")
         return True
 
+    def _start_read_pool(self):
+        """Start worker threads that serve read requests from read-only connections
+
+        The database is in WAL mode, readers don't block the writer connection and vice versa.
+        """
+        if self.read_pool_size <= 0:
+            return True
+        self.read_queue = queue.Queue()
+        for index in range(self.read_pool_size):
+            try:
+                conn = sqlite3.connect(
+                    f"file:{self.database}?mode=ro",
+                    uri=True,
+                    check_same_thread=False,
+                    cached_statements=self.cached_statements,
+                )
+                conn.execute(f"PRAGMA cache_size = {self.cache_size_pages};")
+                conn.execute("PRAGMA mmap_size = 1073741824;")
+            except sqlite3.Error as e:
+                self.log.error(f"Failed to open read connection to {self.database}: {e}")
+                self._stop_read_pool()
+                return False
+            worker = threading.Thread(
+                target=self._read_worker,
+                name=self.name + f"_read_worker_{index}",
+                args=[conn],
+                daemon=True,
+            )
+            self.read_workers.append(worker)
+            worker.start()
+        self.log.info(f"Read pool with {self.read_pool_size} connections started")
+        return True
+
+    def _stop_read_pool(self):
+        if self.read_queue is None:
+            return
+        for _ in self.read_workers:
+            self.read_queue.put(None)
+        for worker in self.read_workers:
+            worker.join()
+        self.read_workers = []
+        self.read_queue = None
+
+    def _read_worker(self, conn):
+        cur = conn.cursor()
+        while True:
+            job = self.read_queue.get()
+            if job is None:
+                break
+            handler, ev = job
+            self._stats_begin(ev.domain)
+            try:
+                handler(ev, cur)
+            except Exception as e:
+                self._trx_err(ev, f"{ev.domain} from {ev.from_id} failed: {e}")
+            self._stats_end()
+        conn.close()
+
+    def _read_request(self, handler, ev: IndraEvent):
+        """Serve a read-only request from the read pool, or from the writer connection if the pool is disabled"""
+        if self.read_queue is None:
+            handler(ev, self.cur)
+            return
+        if self.bUncommitted is True:
+            # Readers only see committed data
+            self.conn.commit()
+            self.bUncommitted = False
+        self._stats_discard()
+        self.read_queue.put((handler, ev))
+
+    def _start_login_pool(self):
+        """Start worker threads that check passwords of verify and login requests
+
+        bcrypt takes ~200ms per check by design, the writer thread only queues the check and
+        replies once the result arrives as $self/verified event.
+        """
+        if self.login_workers <= 0:
+            return
+        self.login_queue = queue.Queue(maxsize=self.login_queue_size)
+        for index in range(self.login_workers):
+            worker = threading.Thread(
+                target=self._login_worker,
+                name=self.name + f"_login_worker_{index}",
+                args=[],
+                daemon=True,
+            )
+            self.login_workers_active.append(worker)
+            worker.start()
+        self.log.info(f"Login pool with {self.login_workers} workers started")
+
+    def _stop_login_pool(self):
+        if self.login_queue is None:
+            return
+        for _ in self.login_workers_active:
+            self.login_queue.put(None)
+        for worker in self.login_workers_active:
+            worker.join()
+        self.login_workers_active = []
+        self.login_queue = None
+
+    def _login_worker(self):
+        while True:
+            job = self.login_queue.get()
+            if job is None:
+                break
+            job_id, plain_password, hashed_password = job
+            try:
+                # bcrypt releases the GIL while hashing
+                verified = bcrypt.checkpw(
+                    plain_password.encode("utf-8"), hashed_password.encode("utf-8")
+                )
+            except Exception as e:
+                self.log.error(f"Failed to check password: {e}")
+                verified = False
+            ev = IndraEvent()
+            ev.domain = "$self/verified"
+            ev.from_id = self.name
+            ev.data_type = "json"
+            ev.data = json.dumps({"job_id": job_id, "verified": verified})
+            self.event_send_self(ev)
+
+    def _trx_verify(self, ev: IndraEvent, key: str, value: str):
+        """Check the password of a verify or login request, in the login pool if available"""
+        if self.login_queue is None:
+            self._trx_verify_reply(ev, key, self._verify_kv(key, value))
+            return
+        if self._is_secure_key(key) is False:
+            self._trx_verify_reply(ev, key, False)
+            return
+        encr_pw = self._read_kv(key)
+        if encr_pw is None or len(encr_pw) == 0 or len(encr_pw[0]) != 2:
+            self._trx_verify_reply(ev, key, False)
+            return
+        if self._credential_cached(key, value, encr_pw[0][1]) is True:
+            self._trx_verify_reply(ev, key, True)
+            return
+        if self.login_active_keys.get(key, 0) >= self.login_max_per_key:
+            self._trx_err(
+                ev, f"{ev.domain} from {ev.from_id} rejected, too many pending checks for {key}"
+            )
+            return
+        if self.login_active_sources.get(ev.from_id, 0) >= self.login_max_per_source:
+            self._trx_err(
+                ev, f"{ev.domain} from {ev.from_id} rejected, too many pending checks from {ev.from_id}"
+            )
+            return
+        self.login_job_id += 1
+        try:
+            self.login_queue.put_nowait((self.login_job_id, value, encr_pw[0][1]))
+        except queue.Full:
+            self._trx_err(ev, f"{ev.domain} from {ev.from_id} rejected, login queue is full")
+            return
+        self.login_pending[self.login_job_id] = (ev, key, encr_pw[0][1])
+        self.login_active_keys[key] = self.login_active_keys.get(key, 0) + 1
+        self.login_active_sources[ev.from_id] = self.login_active_sources.get(ev.from_id, 0) + 1
+
+    def _login_done(self, ev: IndraEvent):
+        """Reply to a verify or login request, once its password was checked by a login worker"""
+        result = json.loads(ev.data)
+        if result["job_id"] not in self.login_pending:
+            self.log.error(f"Password check {result['job_id']} is not pending")
+            return
+        rq_ev, key, hashed_password = self.login_pending.pop(result["job_id"])
+        for active, name in [(self.login_active_keys, key), (self.login_active_sources, rq_ev.from_id)]:
+            active[name] -= 1
+            if active[name] == 0:
+                del active[name]
+        if result["verified"] is True:
+            self._credential_cache_put(key, json.loads(rq_ev.data)["value"], hashed_password)
+        self._trx_verify_reply(rq_ev, key, result["verified"])
+
+    def _trx_verify_reply(self, ev: IndraEvent, key: str, verified: bool):
+        if verified is True:
+            self.log.info(f"Verified {key}, {time.time()}")
+            rev = IndraEvent.reply_to(ev, self.name)
+            rev.time_jd_start = IndraTime.datetime_to_julian(
+                datetime.datetime.now(tz=datetime.timezone.utc)
+            )
+            rev.time_jd_end = IndraTime.datetime_to_julian(
+                datetime.datetime.now(tz=datetime.timezone.utc)
+            )
+            rev.data_type = "string"
+            rev.data = json.dumps("OK")
+            if ev.domain == "$trx/kv/req/login":
+                rev.auth_hash = self._create_session(key=key, from_id=ev.from_id)
+            self.event_send(rev)
+        else:
+            self._trx_err(
+                ev,
+                f"$trx/kv/req/verify from {ev.from_id} failed, verify failed",
+            )
+
+    def _domain_stats_load(self):
+        """Fill the in-memory domain statistics that serve $trx/db/req/uniquedomains"""
+        start_time = time.time()
+        self.domain_stats = {}
+        self.cur.execute(
+            """SELECT d.domain, t.data_type, COUNT(*), MIN(e.time_jd_start), MAX(e.time_jd_start)
+               FROM indra_events e
+               JOIN indra_domains d ON d.id = e.domain_id
+               JOIN indra_data_types t ON t.id = e.data_type_id
+               GROUP BY e.domain_id, e.data_type_id;"""
+        )
+        for domain, data_type, count, first, last in self.cur.fetchall():
+            self._domain_stats_add(domain, data_type, count, first, last)
+        self.log.info(
+            f"Domain statistics of {len(self.domain_stats)} domains loaded in {time.time() - start_time:.3f} sec"
+        )
+
+    def _domain_stats_add(self, domain: str, data_type: str, count: int, first, last):
+        stats = self.domain_stats.get(domain)
+        if stats is None:
+            stats = {"data_types": {}, "count": 0, "first": first, "last": last}
+            self.domain_stats[domain] = stats
+        stats["data_types"][data_type] = stats["data_types"].get(data_type, 0) + count
+        stats["count"] += count
+        if first is not None and (stats["first"] is None or first < stats["first"]):
+            stats["first"] = first
+        if last is not None and (stats["last"] is None or last > stats["last"]):
+            stats["last"] = last
+
+    def _domain_stats_refresh(self, domain: str):
+        """Recompute the statistics of `domain` from the database, after deletes or updates"""
+        if self.domain_stats is None:
+            return
+        self.domain_stats.pop(domain, None)
+        self.cur.execute(
+            """SELECT t.data_type, COUNT(*), MIN(e.time_jd_start), MAX(e.time_jd_start)
+               FROM indra_events e
+               JOIN indra_data_types t ON t.id = e.data_type_id
+               WHERE e.domain_id = (SELECT id FROM indra_domains WHERE domain = ?)
+               GROUP BY e.data_type_id;""",
+            [domain],
+        )
+        for data_type, count, first, last in self.cur.fetchall():
+            self._domain_stats_add(domain, data_type, count, first, last)
+
+    @staticmethod
+    def _like_regex(pattern: str):
+        """Compile a SQL LIKE pattern ('%' and '_' wildcards) for in-memory matching
+
+        Like SQLite's LIKE, only ASCII letters match case-insensitive."""
+        regex = "".join(
+            ".*" if c == "%" else "." if c == "_" else re.escape(c) for c in pattern
+        )
+        return re.compile(regex, re.IGNORECASE | re.ASCII | re.DOTALL)
+
+    def _check_query_plans(self):
+        """Warn about request query shapes that need a full scan of indra_events"""
+        rq_data = {
+            "domain": "$event/measurement/check",
+            "data_type": "number/float",
+            "time_jd_start": 0.0,
+            "time_jd_end": 1.0,
+        }
+        where_cmd, q_params = self._history_where(rq_data)
+        prefix_where_cmd, prefix_params = self._history_where(
+            {"domain": "$event/measurement/%", "time_jd_start": 0.0}
+        )
+        self.cur.execute(self.update_batch_table)
+        shapes = {
+            "history": (
+                f"SELECT time_jd_start, data FROM indra_events WHERE {where_cmd} ORDER BY time_jd_start ASC;",
+                q_params,
+            ),
+            "history-page": self._history_page_query(
+                "indra_events", where_cmd, q_params, [0.0, 0], 1
+            ),
+            "history-range": (
+                f"SELECT MIN(time_jd_start), MAX(time_jd_start) FROM indra_events WHERE {where_cmd};",
+                q_params,
+            ),
+            "last": (
+                f"{self.event_select.format(source=self.partitions[-1][2])} WHERE d.domain = ? ORDER BY e.time_jd_start DESC LIMIT 1;",
+                [rq_data["domain"]],
+            ),
+            "history-prefix": (
+                f"SELECT time_jd_start, data FROM indra_events WHERE {prefix_where_cmd} ORDER BY time_jd_start ASC;",
+                prefix_params,
+            ),
+            "update": (
+                f"""SELECT b.n, e.id FROM temp.indra_update_batch b
+                    JOIN indra_domains d ON d.domain = b.domain
+                    JOIN {self.partitions[-1][2]} e ON e.domain_id = d.id
+                       AND e.time_jd_start > b.time_jd_start - :eps AND e.time_jd_start < b.time_jd_start + :eps;""",
+                {"eps": self.epsilon},
+            ),
+            "uniquedomains": (
+                """SELECT d.domain FROM indra_domains d WHERE EXISTS (SELECT 1 FROM indra_events e WHERE e.domain_id = d.id
+                   AND e.data_type_id IN (SELECT id FROM indra_data_types WHERE data_type = ?));""",
+                [rq_data["data_type"]],
+            ),
+            "del-domain": (
+                f"DELETE FROM {self.partitions[-1][2]} WHERE domain_id IN (?, ?) AND time_jd_start >= ? AND time_jd_start <= ?;",
+                [1, 2, 0.0, 1.0],
+            ),
+            "del-uuid4": (f"DELETE FROM {self.partitions[-1][2]} WHERE uuid4 = ?;", ["check"]),
+        }
+        ok = True
+        for shape in shapes:
+            sql_cmd, params = shapes[shape]
+            try:
+                self.cur.execute(f"EXPLAIN QUERY PLAN {sql_cmd}", params)
+                plan = [x[3] for x in self.cur.fetchall()]
+            except sqlite3.Error as e:
+                self.log.error(f"Query plan check of {shape} failed: {e}")
+                ok = False
+                continue
+            self.log.debug(f"Query plan {shape}: {plan}")
+            # A scan of the view's co-routine reads the rows that the partition searches deliver
+            coroutines = [x.split()[-1] for x in plan if x.startswith("CO-ROUTINE") or x.startswith("MATERIALIZE")]
+            for step in plan:
+                words = step.split()
+                if (
+                    words[0] == "SCAN"
+                    and words[1] not in coroutines
+                    and (words[1] == "e" or words[1].startswith("indra_events"))
+                ):
+                    self.log.warning(
+                        f"Query {shape} requires a full scan of indra_events: {plan}"
+                    )
+                    ok = False
+                    break
+        return ok
+
     def _db_seed_check(self):
         # create a default admin user, if kv is empty
         admin_user = "admin"
@@ -611,6 +2348,9 @@ class IndraProcess(IndraProcessCore):
         return True
 
     def outbound_init(self):
+        self.credential_secret = os.urandom(32)
+        self.stats_lock = threading.Lock()
+        self.stats_local = threading.local()
         db_dir = os.path.dirname(self.database)
         if os.path.exists(db_dir) is False:
             self.log.error(f"Database path {db_dir} does not exist!")
@@ -618,10 +2358,66 @@ class IndraProcess(IndraProcessCore):
         ret = self._db_open()
         if ret is False:
             return False
+        self._check_query_plans()
+        self._domain_stats_load()
         ret = self._db_seed_check()
-        return ret
+        if ret is False:
+            return False
+        # Seeding needs to be committed before read connections are opened
+        self.conn.commit()
+        if self._start_read_pool() is False:
+            self.log.warning("Read pool not available, read requests are served by the writer")
+        self._start_login_pool()
+        if (
+            self.create_timer_thread("sessions", "periodic@1m", self._session_timer)
+            is False
+        ):
+            self.log.error("Session expiry job not started")
+        if self.archive_directory is not None:
+            if pq is None:
+                # archive_directory stays set: retention must not drop partitions that were never archived
+                self.log.error("Module pyarrow is required for archive_directory, archive job not started")
+            elif (
+                self.create_timer_thread(
+                    "archive", self.archive_run_condition, self._archive_timer
+                )
+                is False
+            ):
+                self.log.error("Archive job not started")
+        if len(self.retention) > 0:
+            if (
+                self.create_timer_thread(
+                    "retention", self.retention_run_condition, self._retention_timer
+                )
+                is False
+            ):
+                self.log.error("Retention job not started, old events are not removed")
+        if (
+            self.create_timer_thread(
+                "checkpoint", self.checkpoint_run_condition, self._checkpoint_timer
+            )
+            is False
+        ):
+            self.log.error("WAL checkpoint job not started")
+        if (
+            self.create_timer_thread("stats", self.stats_run_condition, self._stats_timer)
+            is False
+        ):
+            self.log.error("Request statistics job not started")
+        if self.backup_directory is not None:
+            if (
+                self.create_timer_thread(
+                    "backup", self.backup_run_condition, self._backup_timer
+                )
+                is False
+            ):
+                self.log.error("Backup job not started")
+        return True
 
     def shutdown(self):
+        self._stop_login_pool()
+        self._stop_read_pool()
+        self._flush_ingest_buffer()
         seq_no, seq_kv_no = self._write_last_seq_no()
         self.log.info(
             f"Closing database, last seq_no={seq_no}, last_kv_seq_no={seq_kv_no}"
@@ -635,14 +2431,51 @@ class IndraProcess(IndraProcessCore):
         else:
             self.log.info("Shutdown DB complete")
 
+    def outbound_idle(self):
+        if (
+            len(self.ingest_buffer) > 0
+            and time.time() - self.ingest_buffer_start >= self.commit_delay_sec
+        ):
+            self._flush_ingest_buffer()
+
     def outbound(self, ev: IndraEvent):
-        if ev.domain.startswith("$self/timer") is True:
+        if ev.domain == "$self/retention":
+            self._apply_retention()
+        elif ev.domain == "$self/archived":
+            self._archive_done(ev)
+        elif ev.domain == "$self/lastcache":
+            self._last_cache_fill(ev)
+        elif ev.domain == "$self/verified":
+            self._login_done(ev)
+        elif ev.domain == "$self/checkpoint":
+            self._checkpoint()
+        elif ev.domain == "$self/delete":
+            self._delete_job_step()
+        elif ev.domain == "$self/sessions":
+            self._expire_sessions()
+        elif ev.domain.startswith("$self/timer") is True:
+            self._flush_ingest_buffer()
             if self.bUncommitted is True:
                 self.conn.commit()
                 self.bUncommitted = False
                 self.log.debug("Timer commit")
         elif ev.domain.startswith("$trx"):
-            self.trx(ev)
+            # Requests need to see all events that arrived before them
+            self._flush_ingest_buffer()
+            self._stats_begin(ev.domain)
+            if (
+                ev.auth_hash is not None
+                and ev.auth_hash != ""
+                and ev.domain != "$trx/kv/req/login"
+                and self._check_session(ev.auth_hash) is None
+            ):
+                # The $interactive/session/end event was sent when the session expired
+                self._trx_err(
+                    ev, f"{ev.domain} from {ev.from_id} rejected, session {ev.auth_hash} unknown or expired"
+                )
+            else:
+                self.trx(ev)
+            self._stats_end()
         elif ev.domain.startswith("$event"):
             self._write_event(ev)
         else:
@@ -650,11 +2483,10 @@ class IndraProcess(IndraProcessCore):
 
     def _trx_err(self, ev: IndraEvent, err_msg: str):
         self.log.error(err_msg)
-        rev = IndraEvent()
-        rev.domain = ev.from_id
-        rev.from_id = self.name
-        rev.uuid4 = ev.uuid4
-        rev.to_scope = ev.domain
+        current = self._stats_current()
+        if current is not None:
+            current["error"] = True
+        rev = IndraEvent.reply_to(ev, self.name)
         rev.time_jd_start = IndraTime.datetime_to_julian(
             datetime.datetime.now(tz=datetime.timezone.utc)
         )
@@ -665,434 +2497,1022 @@ class IndraProcess(IndraProcessCore):
         rev.data = json.dumps(err_msg)
         self.event_send(rev)
 
-    def trx(self, ev: IndraEvent):
-        columns = [
-            "id",
+    def _trx_history(self, ev: IndraEvent, cur):
+        try:
+            rq_data = json.loads(ev.data)
+        except Exception as e:
+            self._trx_err(
+                ev, f"Invalid $trx/db/req/history from {ev.from_id}: {ev.data}: {e}"
+            )
+            return
+
+        rq_fields = [
             "domain",
-            "from_id",
-            "uuid4",
-            "parent_uuid4",
-            "seq_no",
-            "to_scope",
-            "time_jd_start",
-            "data_type",
-            "data",
-            "auth_hash",
-            "time_jd_end",
+            # "time_jd_start",
+            # "time_jd_end",
+            # "limit",
+            # "data_type",
+            "mode",
         ]
-        if ev.domain.startswith("$trx/db"):
-            if ev.domain == "$trx/db/req/history":
-                try:
-                    rq_data = json.loads(ev.data)
-                except Exception as e:
-                    self._trx_err(
-                        ev, f"Invalid $trx/db/req/history from {ev.from_id}: {ev.data}: {e}"
-                    )
-                    return
-
-                rq_fields = [
-                    "domain",
-                    # "time_jd_start",
-                    # "time_jd_end",
-                    # "limit",
-                    # "data_type",
-                    "mode",
-                ]
-                valid = True
-                inv_err = ""
-                for field in rq_fields:
-                    if field not in rq_data:
-                        valid = False
-                        inv_err = f"missing: {field}"
-                        break
-                if valid is False:
-                    self._trx_err(
-                        ev,
-                        f"$trx/db/req/history from {ev.from_id} failed, request missing field {inv_err}",
-                    )
-                    return
-                if rq_data["mode"] not in ["Sample", "Sequential"]:
-                    self._trx_err(
-                        ev,
-                        f"$trx/db/req/history from {ev.from_id} failed, invalid mode {rq_data['mode']}",
-                    )
-                    return
-                if "%" in rq_data["domain"]:
-                    op1 = "LIKE"
-                else:
-                    op1 = "="
-                sql_cmd = f"SELECT time_jd_start, data FROM (SELECT * FROM indra_events WHERE domain {op1} ?"  #  AND data_type {op2} ?)"
-                q_params = [rq_data["domain"]]
-                if (
-                    "data_type" in rq_data
-                    and rq_data["data_type"] is not None
-                    and len(rq_data["data_type"]) > 0
-                ):
-                    if "%" in rq_data["data_type"]:
-                        op2 = "LIKE"
-                    else:
-                        op2 = "="
-                    q_params.append(rq_data["data_type"])
-                    sql_cmd += f" AND data_type {op2} ?"
-                if "time_jd_start" in rq_data and rq_data["time_jd_start"] is not None:
-                    q_params.append(rq_data["time_jd_start"])
-                    sql_cmd += " AND time_jd_start >= ?"
-                if "time_jd_end" in rq_data and rq_data["time_jd_end"] is not None:
-                    q_params.append(rq_data["time_jd_end"])
-                    sql_cmd += " AND time_jd_end <= ?"
-                if "limit" in rq_data and rq_data["limit"] is not None:
-                    q_params.append(rq_data["limit"])
-                    if rq_data["mode"] == "Sample":
-                        sql_cmd += " ORDER BY RANDOM() LIMIT ?)"
-                    elif rq_data["mode"] == "Sequential":
-                        sql_cmd += " LIMIT ?)"
-                    else:
-                        self.log.error(
-                            f"Failure, unexpected mode {rq_data['mode']}, internal error, rq from {ev.from_id}"
-                        )
+        valid = True
+        inv_err = ""
+        for field in rq_fields:
+            if field not in rq_data:
+                valid = False
+                inv_err = f"missing: {field}"
+                break
+        if valid is False:
+            self._trx_err(
+                ev,
+                f"$trx/db/req/history from {ev.from_id} failed, request missing field {inv_err}",
+            )
+            return
+        if rq_data["mode"] not in self.history_modes:
+            self._trx_err(
+                ev,
+                f"$trx/db/req/history from {ev.from_id} failed, invalid mode {rq_data['mode']}",
+            )
+            return
+        current = self._stats_current()
+        if current is not None:
+            current["kind"] += f"/{rq_data['mode']}"
+        where_cmd, q_params = self._history_where(rq_data)
+        # Only partitions that overlap the requested time range are read
+        source = self._events_source(rq_data.get("time_jd_start"), rq_data.get("time_jd_end"))
+        t_start = datetime.datetime.now(tz=datetime.timezone.utc)
+        if (
+            rq_data.get("page_size") is not None
+            and rq_data["mode"] in ["Sample", "Sequential"]
+            and not (rq_data["mode"] == "Sample" and rq_data.get("limit") is not None)
+        ):
+            self._trx_history_page(ev, cur, rq_data, where_cmd, q_params, t_start)
+            return
+        if rq_data["mode"] in ["Sample", "Sequential"]:
+            sql_cmd = f"SELECT time_jd_start, value_num, data FROM (SELECT * FROM {source} WHERE {where_cmd}"
+            count_params = list(q_params)
+            if "limit" in rq_data and rq_data["limit"] is not None:
+                q_params.append(rq_data["limit"])
+                if rq_data["mode"] == "Sample":
+                    sql_cmd += " ORDER BY RANDOM() LIMIT ?)"
                 else:
-                    sql_cmd += ")"
-                sql_cmd += " ORDER BY time_jd_start ASC;"
-                t_start = datetime.datetime.now(tz=datetime.timezone.utc)
-                self.log.info(f"Executing {sql_cmd} with {q_params}")
-                self.cur.execute(sql_cmd, q_params)
-                self.log.info(f"Executed {sql_cmd} with {q_params}")
-                result = self.cur.fetchall()
-                self.log.info(f"Result len: {len(result)}")
-                rev = IndraEvent()
-                rev.domain = ev.from_id
-                rev.from_id = self.name
-                rev.uuid4 = ev.uuid4
-                rev.to_scope = ev.domain
-                rev.time_jd_start = IndraTime.datetime_to_julian(t_start)
-                rev.time_jd_end = IndraTime.datetime_to_julian(
-                    datetime.datetime.now(tz=datetime.timezone.utc)
+                    sql_cmd += " LIMIT ?)"
+            else:
+                sql_cmd += ")"
+            sql_cmd += " ORDER BY time_jd_start ASC;"
+            result = self._query(cur, sql_cmd, q_params)
+            try:
+                # Only events without non-integral numeric value need their JSON data parsed
+                jd_y = [(x[0], self._history_value(x[1], x[2])) for x in result]
+            except Exception as e:
+                self.log.error(f"Failed to process result: {e}")
+                jd_y = []
+            try:
+                cold = self._archive_history(
+                    rq_data, rq_data.get("time_jd_start"), rq_data.get("time_jd_end")
                 )
-                rev.data_type = "vector/tuple/jd/float"
-                try:
-                    jd_y = [(x[0], json.loads(x[1])) for x in result]
-                    rev.data = json.dumps(jd_y)
-                except Exception as e:
-                    self.log.error(f"Failed to process result: {e}")
-                    rev.data = json.dumps([])
-                self.event_send(rev)
-            elif ev.domain == "$trx/db/req/last":
-                try:
-                    rq_data = json.loads(ev.data)
-                except Exception as e:
-                    self._trx_err(
-                        ev, f"Invalid $trx/db/req/last from {ev.from_id}: {ev.data}: {e}"
-                    )
-                    return
-                rq_fields = [
-                    "domain",
-                ]
-                valid = True
-                inv_err = ""
-                for field in rq_fields:
-                    if field not in rq_data:
-                        valid = False
-                        inv_err = f"missing: {field}"
-                        break
-                if valid is False:
-                    self._trx_err(
-                        ev,
-                        f"$trx/db/req/last from {ev.from_id} failed, request missing field {inv_err}",
+            except Exception as e:
+                self.log.error(f"Failed to read history from archive: {e}")
+                cold = []
+            if len(cold) > 0:
+                limit = rq_data.get("limit")
+                if limit is not None and rq_data["mode"] == "Sample":
+                    # Uniform sample of archive and database events: the number of archive
+                    # events in a sample of `limit` events follows the hypergeometric distribution
+                    num_db = self._query(
+                        cur, f"SELECT COUNT(*) FROM {source} WHERE {where_cmd};", count_params
+                    )[0][0]
+                    num_cold = int(
+                        np.random.hypergeometric(len(cold), num_db, min(limit, len(cold) + num_db))
                     )
-                    return
-                q_params = [rq_data["domain"]]
-                sel_list = ", ".join(columns)
-                sql_cmd = f"SELECT {sel_list} FROM indra_events WHERE domain = ? ORDER BY time_jd_start DESC LIMIT 1;"
-                t_start = datetime.datetime.now(tz=datetime.timezone.utc)
-                self.cur.execute(sql_cmd, q_params)
-                result = self.cur.fetchall()
-                rev = IndraEvent()
-                rev.domain = ev.from_id
-                rev.from_id = self.name
-                rev.uuid4 = ev.uuid4
-                rev.to_scope = ev.domain
-                rev.time_jd_start = IndraTime.datetime_to_julian(t_start)
-                rev.time_jd_end = IndraTime.datetime_to_julian(
-                    datetime.datetime.now(tz=datetime.timezone.utc)
-                )
-                if result and len(result) == 1:
-                    lev = IndraEvent.from_json(
-                        json.dumps(dict(zip(columns, result[0])))
+                    jd_y = random.sample(cold, num_cold) + random.sample(
+                        jd_y, min(len(jd_y), limit - num_cold)
                     )
-                    rev.data_type = "json/indraevent"
-                    rev.data = lev.to_json()
+                    jd_y.sort(key=lambda x: x[0])
                 else:
-                    self.log.warning(f"Not found: {sql_cmd} with {q_params}")
-                    rev.data_type = "error/notfound"
-                self.event_send(rev)
-            elif ev.domain == "$trx/db/req/uniquedomains":
-                try:
-                    rq_data = json.loads(ev.data)
-                except Exception as e:
-                    self._trx_err(
-                        ev,
-                        f"Invalid $trx/db/req/uniquedomains from {ev.from_id}: {ev.data}: {e}",
-                    )
-                    return
-                rq_fields = []
-                valid = True
-                inv_err = ""
-                for field in rq_fields:
-                    if field not in rq_data:
-                        valid = False
-                        inv_err = f"missing: {field}"
-                        break
-                if valid is False:
-                    self._trx_err(
-                        ev,
-                        f"$trx/db/req/uniquedomains from {ev.from_id} failed, request missing field {inv_err}",
-                    )
-                    return
-                q_params = []
-                sql_cmd = "SELECT DISTINCT domain FROM indra_events"
-                post_filter = False
-                if "data_type" in rq_data:
-                    self.log.warning(
-                        "Inefficient SQL query, uniqueDomain with data_type breaks optimization"
-                    )
-                    if "domain" in rq_data:
-                        d = rq_data["domain"]
-                        if "%" in d:
-                            op1 = "LIKE"
-                        else:
-                            op1 = "="
-                        q_params.append(d)
-                        sql_cmd += f" WHERE domain {op1} ?"
-                    dt = rq_data["data_type"]
-                    if "%" in dt:
-                        op2 = "LIKE"
-                    else:
-                        op2 = "="
-                        q_params.append(dt)
-                        sql_cmd += f" AND data_type {op2} ?"
-                else:
-                    post_filter = True
-                sql_cmd += ";"
-                if post_filter is True and self.unique_domains_cache is not None:
-                    t_start = datetime.datetime.now(tz=datetime.timezone.utc)
-                    self.log.info(f"Executing {sql_cmd} with {q_params}, using cache")
-                    res_list = self.unique_domains_cache
-                else:
-                    t_start = datetime.datetime.now(tz=datetime.timezone.utc)
-                    self.log.info(f"Executing {sql_cmd} with {q_params}")
-                    self.cur.execute(sql_cmd, q_params)
-                    result = self.cur.fetchall()
-                    res_list = [x[0] for x in result]
-                    self.unique_domains_cache = res_list
-                if post_filter is True and "domain" in rq_data:
-                    filter = rq_data["domain"].split("%")[0]
-                    res_list = [x for x in res_list if x.startswith(filter)]
-                rev = IndraEvent()
-                rev.domain = ev.from_id
-                rev.from_id = self.name
-                rev.uuid4 = ev.uuid4
-                rev.to_scope = ev.domain
-                rev.time_jd_start = IndraTime.datetime_to_julian(t_start)
-                rev.time_jd_end = IndraTime.datetime_to_julian(
-                    datetime.datetime.now(tz=datetime.timezone.utc)
+                    jd_y = sorted(cold + jd_y, key=lambda x: x[0])
+                    if limit is not None:
+                        jd_y = jd_y[:limit]
+        else:
+            try:
+                jd_y = self._history_downsampled(cur, rq_data, source, where_cmd, q_params)
+            except Exception as e:
+                self.log.error(f"Failed to downsample history: {e}")
+                jd_y = []
+        rev = IndraEvent.reply_to(ev, self.name)
+        rev.time_jd_start = IndraTime.datetime_to_julian(t_start)
+        rev.time_jd_end = IndraTime.datetime_to_julian(
+            datetime.datetime.now(tz=datetime.timezone.utc)
+        )
+        rev.data_type = "vector/tuple/jd/float"
+        rev.data = self._encode(jd_y)
+        self.event_send(rev)
+
+    def _trx_history_page(
+        self, ev: IndraEvent, cur, rq_data, where_cmd: str, q_params: list, t_start
+    ):
+        """Reply one page of a Sequential history request (keyset pagination)
+
+        Events are ordered by (time_jd_start, id). The reply is a `json/historypage` object
+        `{"history": [[jd, value], ...], "cursor": cursor}`: the request for the next page
+        passes `cursor` back unchanged, `null` marks the last page. A request `limit` is the
+        number of events still wanted, the client reduces it by the events received. Archived
+        periods are merged into the walk, as for non-paged requests.
+        """
+        page_size = min(max(int(rq_data["page_size"]), 1), self.history_max_page_size)
+        limit = rq_data.get("limit")
+        if limit is not None:
+            count = min(page_size, max(int(limit), 0))
+        else:
+            count = page_size
+        cursor = rq_data.get("cursor")
+        if cursor is not None and (
+            not isinstance(cursor, list)
+            or len(cursor) != 2
+            or not all(isinstance(x, (int, float)) for x in cursor)
+        ):
+            self._trx_err(
+                ev,
+                f"$trx/db/req/history from {ev.from_id} failed, invalid cursor {cursor}",
+            )
+            return
+        if count > 0:
+            jd_start = rq_data.get("time_jd_start")
+            if cursor is not None and (jd_start is None or cursor[0] > jd_start):
+                jd_start = cursor[0]
+            source = self._events_source(jd_start, rq_data.get("time_jd_end"))
+            sql_cmd, q_params = self._history_page_query(
+                source, where_cmd, q_params, cursor, count
+            )
+            current = self._stats_current()
+            if current is not None:
+                current["kind"] += "/page"
+            result = self._query(cur, sql_cmd, q_params)
+        else:
+            result = []
+        try:
+            result = [(x[0], x[1], self._history_value(x[3], x[2])) for x in result]
+            if count > 0:
+                cold = self._archive_history_page(rq_data, jd_start, cursor)
+                if len(cold) > 0:
+                    result = sorted(cold + result, key=lambda x: (x[0], x[1]))[:count]
+            jd_y = [(x[0], x[2]) for x in result]
+        except Exception as e:
+            self._trx_err(ev, f"Failed to process history page: {e}")
+            return
+        if len(result) == count and count > 0 and (limit is None or count < limit):
+            next_cursor = [result[-1][0], result[-1][1]]
+        else:
+            next_cursor = None
+        rev = IndraEvent.reply_to(ev, self.name)
+        rev.time_jd_start = IndraTime.datetime_to_julian(t_start)
+        rev.time_jd_end = IndraTime.datetime_to_julian(
+            datetime.datetime.now(tz=datetime.timezone.utc)
+        )
+        rev.data_type = "json/historypage"
+        rev.data = self._encode({"history": jd_y, "cursor": next_cursor})
+        self.event_send(rev)
+
+    def _archive_history_page(self, rq_data, jd_start, cursor):
+        """(jd, id, value) of the archived events that follow `cursor`, for keyset pagination
+
+        Archived events have no database id, their id is their rank among the archived events
+        with the same time, offset below all database ids (which start at 1).
+        """
+        points = []
+        rank = 0
+        for i, (jd, value) in enumerate(
+            self._archive_history(rq_data, jd_start, rq_data.get("time_jd_end"))
+        ):
+            if i > 0 and jd == points[-1][0]:
+                rank += 1
+            else:
+                rank = 0
+            points.append((jd, rank - 2**62, value))
+        if cursor is not None:
+            points = [x for x in points if x[0] > cursor[0] or (x[0] == cursor[0] and x[1] > cursor[1])]
+        return points
+
+    @staticmethod
+    def _history_page_query(source: str, where_cmd: str, q_params: list, cursor, count: int):
+        """Query for the `count` events following `cursor` ([time_jd_start, id] or None)"""
+        q_params = list(q_params)
+        if cursor is not None:
+            where_cmd += " AND time_jd_start >= ? AND NOT (time_jd_start = ? AND id <= ?)"
+            q_params.extend([cursor[0], cursor[0], cursor[1]])
+        q_params.append(count)
+        sql_cmd = f"SELECT time_jd_start, id, data, value_num FROM {source} WHERE {where_cmd} ORDER BY time_jd_start ASC, id ASC LIMIT ?;"
+        return sql_cmd, q_params
+
+    @staticmethod
+    def _like_prefix(pattern: str):
+        """The prefix of a LIKE pattern that is a prefix followed by a single trailing '%', else None"""
+        if (
+            pattern.endswith("%") is False
+            or "%" in pattern[:-1]
+            or "_" in pattern[:-1]
+            or (len(pattern) > 1 and ord(pattern[-2]) >= 0x10FFFF)
+        ):
+            return None
+        return pattern[:-1]
+
+    @classmethod
+    def _match_condition(cls, column: str, pattern: str):
+        """Canonical condition and parameters that match `column` against `pattern`
+
+        A pattern without '%' is an exact match, a prefix pattern ('abC%') becomes the NOCASE index
+        range `column >= 'abc' AND column < 'abd'`, all other patterns use LIKE. SQLite's LIKE and
+        NOCASE both fold ASCII letters only, so the range matches exactly what LIKE matches. Only
+        these three statement shapes exist per column, the pattern is always a parameter, so the
+        statements are reused from the connection's statement cache.
+        """
+        if "%" not in pattern:
+            return f"{column} = ?", [pattern]
+        prefix = cls._like_prefix(pattern)
+        if prefix is None:
+            return f"{column} LIKE ?", [pattern]
+        if prefix == "":
+            return f"{column} >= ?", [prefix]
+        prefix = prefix.translate(cls.ascii_lower)
+        upper = chr(ord(prefix[-1]) + 1)
+        if "A" <= upper <= "Z":
+            # NOCASE compares upper case letters as lower case, '[' follows '@' in NOCASE order
+            upper = "["
+        return (
+            f"{column} COLLATE NOCASE >= ? AND {column} COLLATE NOCASE < ?",
+            [prefix, prefix[:-1] + upper],
+        )
+
+    @classmethod
+    def _history_where(cls, rq_data):
+        """WHERE clause and parameters that select the events of a history request
+
+        Clauses are always added in the same order, so each combination of request fields
+        maps to one canonical statement.
+        """
+        domain_cond, q_params = cls._match_condition("domain", rq_data["domain"])
+        if "%" in rq_data["domain"]:
+            where_cmd = f"domain_id IN (SELECT id FROM indra_domains WHERE {domain_cond})"
+        else:
+            # A single domain_id lets the (domain_id, time_jd_start) index deliver time order
+            where_cmd = f"domain_id = (SELECT id FROM indra_domains WHERE {domain_cond})"
+        if (
+            "data_type" in rq_data
+            and rq_data["data_type"] is not None
+            and len(rq_data["data_type"]) > 0
+        ):
+            data_type_cond, data_type_params = cls._match_condition("data_type", rq_data["data_type"])
+            q_params.extend(data_type_params)
+            where_cmd += f" AND data_type_id IN (SELECT id FROM indra_data_types WHERE {data_type_cond})"
+        if "time_jd_start" in rq_data and rq_data["time_jd_start"] is not None:
+            q_params.append(rq_data["time_jd_start"])
+            where_cmd += " AND time_jd_start >= ?"
+        if "time_jd_end" in rq_data and rq_data["time_jd_end"] is not None:
+            # time_jd_start <= time_jd_end, the implied bound on time_jd_start limits the index range
+            q_params.extend([rq_data["time_jd_end"], rq_data["time_jd_end"]])
+            where_cmd += " AND time_jd_start <= ? AND time_jd_end <= ?"
+        return where_cmd, q_params
+
+    def _history_downsampled(self, cur, rq_data, source: str, where_cmd: str, q_params: list):
+        """Reduce the events selected by `where_cmd` to at most `limit` points
+
+        The time range [time_jd_start, time_jd_end] (default: range of the selected events)
+        is split into `limit` equally sized buckets. Min, Max, Mean, Count, First and Last
+        return one aggregate per non-empty bucket, computed in SQL. LTTB (largest triangle
+        three buckets) selects the one event per bucket that best preserves the visual shape.
+        Min, Max, Mean and Count of rollup domains are served from the coarsest rollup resolution
+        that still provides `limit` buckets. LTTB includes archived periods that are no longer
+        partitions, the other modes rely on the rollups, which are kept after retention.
+        """
+        if "limit" in rq_data and rq_data["limit"] is not None:
+            num_points = max(int(rq_data["limit"]), 1)
+        else:
+            num_points = self.history_default_points
+        jd_start = rq_data.get("time_jd_start")
+        jd_end = rq_data.get("time_jd_end")
+        mode = rq_data["mode"]
+        if mode == "LTTB":
+            sql_cmd = f"SELECT time_jd_start, value_num FROM {source} WHERE {where_cmd} AND value_num IS NOT NULL ORDER BY time_jd_start ASC;"
+            points = self._query(cur, sql_cmd, q_params)
+            cold = [
+                x for x in self._archive_history(rq_data, jd_start, jd_end) if isinstance(x[1], (int, float))
+            ]
+            if len(cold) > 0:
+                points = sorted(cold + points, key=lambda x: x[0])
+            return self.lttb(points, num_points)
+        use_rollups = (
+            mode in ["Min", "Max", "Mean", "Count"]
+            and "%" not in rq_data["domain"]
+            and rq_data.get("data_type") in [None, "", "number/%"]
+            and self._is_rollup_domain(rq_data["domain"])
+        )
+        if jd_start is None or jd_end is None:
+            sql_cmd = f"SELECT MIN(time_jd_start), MAX(time_jd_start) FROM {source} WHERE {where_cmd};"
+            first, last = self._query(cur, sql_cmd, q_params)[0]
+            if use_rollups:
+                # Rollups also cover events that were removed by retention
+                resolution_sec = self.rollup_resolutions[0]
+                cur.execute(
+                    """SELECT MIN(bucket), MAX(bucket) FROM indra_rollups
+                       WHERE domain_id = (SELECT id FROM indra_domains WHERE domain = ?) AND resolution_sec = ?;""",
+                    [rq_data["domain"], resolution_sec],
                 )
-                rev.data_type = "vector/string"
-                rev.data = json.dumps(res_list)
-                self.event_send(rev)
-            elif ev.domain == "$trx/db/req/del":
-                try:
-                    rq_data = json.loads(ev.data)
-                except Exception as e:
-                    self._trx_err(
-                        ev, f"Invalid $trx/db/req/del {ev.from_id}: {ev.data}: {e}"
+                result = cur.fetchone()
+                if result[0] is not None:
+                    if first is None or result[0] * resolution_sec / 86400 < first:
+                        first = result[0] * resolution_sec / 86400
+                    if last is None or result[1] * resolution_sec / 86400 > last:
+                        last = result[1] * resolution_sec / 86400
+            if first is None:
+                return []
+            if jd_start is None:
+                jd_start = first
+            if jd_end is None:
+                jd_end = last
+        if use_rollups:
+            # Coarsest rollup resolution that still provides num_points buckets
+            span_sec = (jd_end - jd_start) * 86400
+            for resolution_sec in reversed(self.rollup_resolutions):
+                if span_sec / resolution_sec >= num_points:
+                    return self._history_rollup(
+                        cur, rq_data["domain"], mode, resolution_sec, jd_start, jd_end, num_points
                     )
-                    return
-                rq_fields = ["domains", "uuid4s"]
-                valids = 0
-                for field in rq_fields:
-                    if field in rq_data:
-                        valids += 1
-                        break
-                if valids != 1:
-                    self._trx_err(
-                        ev,
-                        f"$trx/db/req/del from {ev.from_id} failed, requires either an array `uuid4s` or an array `domains` as key(s)",
-                    )
-                    return
-                t_start = datetime.datetime.now(tz=datetime.timezone.utc)
-                num_deleted = 0
-                if "domains" in rq_data and rq_data["domains"] is not None:
-                    if isinstance(rq_data["domains"], list):
-                        # Handle array case
-                        domains = rq_data["domains"]
-                    else:
-                        # Handle scalar case
-                        domains = [rq_data["domains"]]
-                    # Process the domains
-                    for domain in domains:
-                        if "%" in domain:
-                            op1 = "LIKE"
-                        else:
-                            op1 = "="
-                        sql_cmd = f"DELETE FROM indra_events WHERE domain {op1} ?"
-                        q_params = [domain]
-                        # check if data is deleted:
-                        self.cur.execute(sql_cmd, q_params)
-                        num_deleted += self.cur.rowcount
-                    self._check_commit()
-                elif "uuid4s" in rq_data and rq_data["uuid4s"] is not None:
-                    if isinstance(rq_data["uuid4s"], list):
-                        # Handle array case
-                        uuid4s = rq_data["uuid4s"]
-                    else:
-                        # Handle scalar case
-                        uuid4s = [rq_data["uuid4s"]]
-                    # Process the uuid4s
-                    for uuid4 in uuid4s:
-                        sql_cmd = "DELETE FROM indra_events WHERE uuid4 = ?"
-                        q_params = [uuid4]
-                        self.log.info(f"Deleting {uuid4} via {sql_cmd}")
-                        self.cur.execute(sql_cmd, q_params)
-                        num_deleted += self.cur.rowcount
-                    self._check_commit()
+        bucket_width = (jd_end - jd_start) / num_points
+        if bucket_width <= 0.0:
+            bucket_width = 1.0
+        # SQLite returns the bare columns of the row that has the MIN() or MAX() value
+        aggregates = {
+            "Min": "time_jd_start, MIN(value_num)",
+            "Max": "time_jd_start, MAX(value_num)",
+            "Mean": "AVG(time_jd_start), AVG(value_num)",
+            "Count": "MIN(time_jd_start), COUNT(*)",
+            "First": "MIN(time_jd_start), data",
+            "Last": "MAX(time_jd_start), data",
+        }
+        if mode in ["Min", "Max", "Mean"]:
+            # Buckets without numeric events are omitted, like in LTTB
+            where_cmd += " AND value_num IS NOT NULL"
+        sql_cmd = f"""SELECT MIN(CAST((time_jd_start - ?) / ? AS INTEGER), ?) AS bucket, {aggregates[mode]}
+                      FROM {source} WHERE {where_cmd} GROUP BY bucket ORDER BY bucket ASC;"""
+        params = [jd_start, bucket_width, num_points - 1] + q_params
+        result = self._query(cur, sql_cmd, params)
+        if mode == "First" or mode == "Last":
+            return [(x[1], json.loads(x[2])) for x in result]
+        return [(x[1], x[2]) for x in result]
+
+    def _history_rollup(
+        self, cur, domain: str, mode: str, resolution_sec: int, jd_start: float, jd_end: float, num_points: int
+    ):
+        """Aggregate the rollup buckets of resolution_sec between jd_start and jd_end into num_points buckets"""
+        aggregates = {
+            "Min": "bucket * :res_days, MIN(min)",
+            "Max": "bucket * :res_days, MAX(max)",
+            "Mean": "SUM((bucket + 0.5) * count) * :res_days / SUM(count), SUM(sum) / SUM(count)",
+            "Count": "MIN(bucket) * :res_days, SUM(count)",
+        }
+        sql_cmd = f"""SELECT MIN(CAST((bucket * :res_days - :jd_start) / :width AS INTEGER), :last) AS b, {aggregates[mode]}
+                      FROM indra_rollups WHERE domain_id = (SELECT id FROM indra_domains WHERE domain = :domain)
+                         AND resolution_sec = :res
+                         AND bucket >= :first_bucket AND bucket <= :last_bucket
+                      GROUP BY b ORDER BY b ASC;"""
+        params = {
+            "res_days": resolution_sec / 86400,
+            "jd_start": jd_start,
+            "width": (jd_end - jd_start) / num_points,
+            "last": num_points - 1,
+            "domain": domain,
+            "res": resolution_sec,
+            "first_bucket": self._rollup_bucket(jd_start, resolution_sec),
+            "last_bucket": self._rollup_bucket(jd_end, resolution_sec),
+        }
+        return [(x[1], x[2]) for x in self._query(cur, sql_cmd, params)]
+
+    @staticmethod
+    def lttb(points, num_points: int):
+        """Largest-Triangle-Three-Buckets downsampling of time-ordered (jd, value) tuples
+
+        Keeps the first and last point and selects one point from each of `num_points - 2`
+        buckets in between, the one that spans the largest triangle with the previously selected
+        point and the mean of the next bucket.
+        """
+        if num_points >= len(points):
+            return [(x[0], x[1]) for x in points]
+        if num_points < 3:
+            return [(x[0], x[1]) for x in [points[0], points[-1]][:num_points]]
+        data = np.array(points, dtype=np.float64)
+        x = data[:, 0]
+        y = data[:, 1]
+        # Bucket boundaries, first and last point are buckets of their own
+        edges = np.linspace(1, len(points) - 1, num_points - 1).astype(np.int64)
+        selected = [0]
+        a = 0
+        for i in range(num_points - 2):
+            start, end = edges[i], edges[i + 1]
+            if i + 2 < len(edges):
+                next_start, next_end = edges[i + 1], edges[i + 2]
+            else:
+                next_start, next_end = len(points) - 1, len(points)
+            cx = x[next_start:next_end].mean()
+            cy = y[next_start:next_end].mean()
+            areas = np.abs(
+                (x[a] - cx) * (y[start:end] - y[a]) - (x[a] - x[start:end]) * (cy - y[a])
+            )
+            a = start + int(np.argmax(areas))
+            selected.append(a)
+        selected.append(len(points) - 1)
+        return [(float(x[i]), float(y[i])) for i in selected]
+
+    def _last_cache_put(self, domain: str, lev: dict):
+        if self.last_cache_size <= 0:
+            return
+        self.last_cache[domain] = lev
+        self.last_cache.move_to_end(domain)
+        if len(self.last_cache) > self.last_cache_size:
+            self.last_cache.popitem(last=False)
+
+    def _last_cache_update(self, row: dict):
+        """Replace the cached last event of a domain, if the newly written `row` is more recent"""
+        lev = self.last_cache.get(row["domain"])
+        if lev is None or row["time_jd_start"] is None:
+            return
+        if lev["time_jd_start"] is None or row["time_jd_start"] >= lev["time_jd_start"]:
+            self.last_cache[row["domain"]] = {
+                field: row[field] for field in IndraEvent.wire_fields
+            }
+
+    def _last_event_db(self, cur, domain: str):
+        """Latest event of `domain` as dict from the database, None if not found"""
+        # Newest partition first, most domains are found in the current one
+        result = None
+        for partition in reversed(self.partitions):
+            sql_cmd = f"{self.event_select.format(source=partition[2])} WHERE d.domain = ? ORDER BY e.time_jd_start DESC LIMIT 1;"
+            rows = self._query(cur, sql_cmd, [domain])
+            row = rows[0] if len(rows) > 0 else None
+            if row is not None and (result is None or row[7] is not None):
+                result = row
+                if row[7] is not None:
+                    break
+        if result is None:
+            return None
+        lev = dict(zip(self.event_columns, result))
+        del lev["id"]
+        return lev
+
+    def _last_cache_fill(self, ev: IndraEvent):
+        """Cache the last events that a read worker fetched ($self/lastcache)
+
+        Events written after the read worker's snapshot make its result stale, only results
+        that are still the latest event of their domain according to domain_stats are cached."""
+        for domain, lev in json.loads(ev.data).items():
+            if domain in self.last_cache or self.domain_stats is None:
+                continue
+            stats = self.domain_stats.get(domain)
+            if stats is not None and lev["time_jd_start"] is not None and lev["time_jd_start"] == stats["last"]:
+                self._last_cache_put(domain, lev)
+
+    def _trx_last(self, ev: IndraEvent):
+        try:
+            rq_data = json.loads(ev.data)
+        except Exception as e:
+            self._trx_err(
+                ev, f"Invalid $trx/db/req/last from {ev.from_id}: {ev.data}: {e}"
+            )
+            return
+        if "domain" not in rq_data and "domains" not in rq_data:
+            self._trx_err(
+                ev,
+                f"$trx/db/req/last from {ev.from_id} failed, request requires either `domain` or an array `domains`",
+            )
+            return
+        if "domains" in rq_data:
+            domains = rq_data["domains"]
+        else:
+            domains = [rq_data["domain"]]
+        # Cache hits are resolved by the writer, misses search the partitions in the read pool
+        levs = {}
+        for domain in domains:
+            lev = self.last_cache.get(domain)
+            if lev is not None:
+                self.last_cache.move_to_end(domain)
+                levs[domain] = lev
+        if len(levs) == len(domains):
+            self._trx_last_reply(ev, self.cur, rq_data, levs)
+        else:
+            self._read_request(
+                lambda ev, cur: self._trx_last_reply(ev, cur, rq_data, levs), ev
+            )
+
+    def _trx_last_reply(self, ev: IndraEvent, cur, rq_data, levs: dict):
+        t_start = datetime.datetime.now(tz=datetime.timezone.utc)
+        found = {}
+        if "domains" in rq_data:
+            domains = rq_data["domains"]
+        else:
+            domains = [rq_data["domain"]]
+        for domain in domains:
+            if domain not in levs:
+                levs[domain] = self._last_event_db(cur, domain)
+                if levs[domain] is not None:
+                    found[domain] = levs[domain]
+        if len(found) > 0:
+            if cur is self.cur:
+                for domain in found:
+                    self._last_cache_put(domain, found[domain])
+            else:
+                # The cache belongs to the writer
+                cev = IndraEvent()
+                cev.domain = "$self/lastcache"
+                cev.data_type = "json/indraevents"
+                cev.data = json.dumps(found)
+                self.event_send_self(cev)
+        rev = IndraEvent.reply_to(ev, self.name)
+        if "domains" in rq_data:
+            # Batch request: domain -> latest event, None for unknown domains
+            rev.data_type = "json/indraevents"
+            rev.data = self._encode(levs)
+        else:
+            lev = levs[rq_data["domain"]]
+            if lev is not None:
+                rev.data_type = "json/indraevent"
+                rev.data = self._encode(lev)
+            else:
+                self.log.warning(f"Not found: last event of {rq_data['domain']}")
+                rev.data_type = "error/notfound"
+        rev.time_jd_start = IndraTime.datetime_to_julian(t_start)
+        rev.time_jd_end = IndraTime.datetime_to_julian(
+            datetime.datetime.now(tz=datetime.timezone.utc)
+        )
+        self.event_send(rev)
+
+    def _trx_uniquedomains(self, ev: IndraEvent, cur=None):
+        try:
+            rq_data = json.loads(ev.data)
+        except Exception as e:
+            self._trx_err(
+                ev,
+                f"Invalid $trx/db/req/uniquedomains from {ev.from_id}: {ev.data}: {e}",
+            )
+            return
+        t_start = datetime.datetime.now(tz=datetime.timezone.utc)
+        # Served from the in-memory domain statistics, the semantics of LIKE for patterns with '%',
+        # otherwise `domain` is a prefix and `data_type` has to match exactly
+        domain_filter = rq_data.get("domain")
+        domain_regex = None
+        if domain_filter is not None and "%" in domain_filter:
+            domain_regex = self._like_regex(domain_filter)
+        data_type_filter = rq_data.get("data_type")
+        data_type_regex = None
+        if data_type_filter is not None and "%" in data_type_filter:
+            data_type_regex = self._like_regex(data_type_filter)
+        res_list = []
+        # Served by read workers, while the writer updates domain_stats: list() and copy() are atomic
+        domain_stats = self.domain_stats
+        for domain in list(domain_stats):
+            stats = domain_stats.get(domain)
+            if stats is None:
+                continue
+            if domain_regex is not None:
+                if domain_regex.fullmatch(domain) is None:
+                    continue
+            elif domain_filter is not None and domain.startswith(domain_filter) is False:
+                continue
+            if data_type_filter is not None:
+                data_types = stats["data_types"].copy()
+                if data_type_regex is not None:
+                    if not any(data_type_regex.fullmatch(dt) for dt in data_types):
+                        continue
+                elif data_type_filter not in data_types:
+                    continue
+            res_list.append((domain, stats))
+        rev = IndraEvent.reply_to(ev, self.name)
+        rev.time_jd_start = IndraTime.datetime_to_julian(t_start)
+        rev.time_jd_end = IndraTime.datetime_to_julian(
+            datetime.datetime.now(tz=datetime.timezone.utc)
+        )
+        if rq_data.get("details") is True:
+            rev.data_type = "json/domainstats"
+            rev.data = self._encode(
+                {domain: dict(stats, data_types=stats["data_types"].copy()) for domain, stats in res_list}
+            )
+        else:
+            rev.data_type = "vector/string"
+            rev.data = self._encode([domain for domain, _ in res_list])
+        self.event_send(rev)
+
+    def _trx_del(self, ev: IndraEvent):
+        try:
+            rq_data = json.loads(ev.data)
+        except Exception as e:
+            self._trx_err(
+                ev, f"Invalid $trx/db/req/del {ev.from_id}: {ev.data}: {e}"
+            )
+            return
+        # domains: deletes all events of the domains (% wildcards), or those between time_jd_start and time_jd_end,
+        # uuid4s: deletes single events, background: true deletes in chunks of delete_chunk_size events,
+        # events that arrive in the meantime are written between the chunks.
+        if isinstance(rq_data, dict) is False or (
+            rq_data.get("domains") is not None
+        ) == (rq_data.get("uuid4s") is not None):
+            self._trx_err(
+                ev,
+                f"$trx/db/req/del from {ev.from_id} failed, requires either an array `uuid4s` or an array `domains` as key(s)",
+            )
+            return
+        job = {
+            "ev": ev,
+            "t_start": datetime.datetime.now(tz=datetime.timezone.utc),
+            "num_deleted": 0,
+            "jd_start": rq_data.get("time_jd_start"),
+            "jd_end": rq_data.get("time_jd_end"),
+            "chunk_size": self.delete_chunk_size if rq_data.get("background") is True else None,
+            "domains": {},
+            "uuid4s": [],
+            "stale_rollups": set(),
+            "changed_domains": set(),
+        }
+        try:
+            if rq_data.get("domains") is not None:
+                if isinstance(rq_data["domains"], list):
+                    domains = rq_data["domains"]
                 else:
-                    self._trx_err(
-                        ev,
-                        f"$trx/db/req/del from {ev.from_id} failed, requires either an array `uuid4s` or an array `domains` as key(s)",
-                    )
-                    return
-                if num_deleted > 0:
-                    self.unique_domains_cache = None
-                rev = IndraEvent()
-                rev.domain = ev.from_id
-                rev.from_id = self.name
-                rev.uuid4 = ev.uuid4
-                rev.to_scope = ev.domain
-                rev.time_jd_start = IndraTime.datetime_to_julian(t_start)
-                rev.time_jd_end = IndraTime.datetime_to_julian(
-                    datetime.datetime.now(tz=datetime.timezone.utc)
+                    domains = [rq_data["domains"]]
+                for domain in domains:
+                    domain_cond, q_params = self._match_condition("domain", domain)
+                    self.cur.execute(f"SELECT id, domain FROM indra_domains WHERE {domain_cond};", q_params)
+                    for domain_id, domain_name in self.cur.fetchall():
+                        job["domains"][domain_id] = domain_name
+                job["tables"] = [
+                    x[2]
+                    for x in self.partitions
+                    if (job["jd_end"] is None or x[0] <= job["jd_end"])
+                    and (job["jd_start"] is None or x[1] > job["jd_start"])
+                ]
+            else:
+                if isinstance(rq_data["uuid4s"], list):
+                    job["uuid4s"] = rq_data["uuid4s"]
+                else:
+                    job["uuid4s"] = [rq_data["uuid4s"]]
+        except sqlite3.Error as e:
+            self._trx_err(ev, f"$trx/db/req/del from {ev.from_id} failed: {e}")
+            return
+        self.delete_jobs.append(job)
+        if len(self.delete_jobs) == 1:
+            self._delete_job_step()
+
+    def _delete_job_step(self):
+        """Delete the next chunk of the oldest delete job, or all of it, if it is not a background job"""
+        if len(self.delete_jobs) == 0:
+            return
+        job = self.delete_jobs[0]
+        try:
+            if len(job["domains"]) > 0:
+                done = self._delete_domains_chunk(job)
+            else:
+                done = self._delete_uuid4s_chunk(job)
+            if done is True:
+                self._delete_job_finish(job)
+            self._check_commit()
+        except sqlite3.Error as e:
+            self.conn.rollback()
+            self.domain_ids = {}
+            self.last_cache.clear()
+            self._domain_stats_load()
+            self._trx_err(job["ev"], f"$trx/db/req/del from {job['ev'].from_id} failed: {e}")
+            done = True
+        if done is True:
+            self.delete_jobs.pop(0)
+            rev = IndraEvent.reply_to(job["ev"], self.name)
+            rev.time_jd_start = IndraTime.datetime_to_julian(job["t_start"])
+            rev.time_jd_end = IndraTime.datetime_to_julian(
+                datetime.datetime.now(tz=datetime.timezone.utc)
+            )
+            rev.data_type = "number/int"
+            rev.data = json.dumps(job["num_deleted"])
+            self.event_send(rev)
+        if len(self.delete_jobs) > 0:
+            # Continue after the events that are already queued
+            self.conn.commit()
+            self.bUncommitted = False
+            ev = IndraEvent()
+            ev.domain = "$self/delete"
+            self.event_send_self(ev)
+
+    def _delete_domains_chunk(self, job: dict):
+        """Delete (a chunk of) the events of the job's domains in the time range with one statement per partition"""
+        where_cmd = f"domain_id IN ({', '.join(['?'] * len(job['domains']))})"
+        q_params = list(job["domains"].keys())
+        if job["jd_start"] is not None:
+            where_cmd += " AND time_jd_start >= ?"
+            q_params.append(job["jd_start"])
+        if job["jd_end"] is not None:
+            where_cmd += " AND time_jd_start <= ?"
+            q_params.append(job["jd_end"])
+        while len(job["tables"]) > 0:
+            table = job["tables"][0]
+            if job["chunk_size"] is None:
+                self.cur.execute(f"DELETE FROM {table} WHERE {where_cmd};", q_params)
+            else:
+                self.cur.execute(
+                    f"DELETE FROM {table} WHERE id IN (SELECT id FROM {table} WHERE {where_cmd} LIMIT ?);",
+                    q_params + [job["chunk_size"]],
                 )
-                rev.data_type = "number/int"
-                rev.data = json.dumps(num_deleted)
-                self.event_send(rev)
-            elif ev.domain == "$trx/db/req/update":
-                try:
-                    rq_data = json.loads(ev.data)
-                except Exception as e:
-                    self._trx_err(
-                        ev, f"Invalid $trx/db/req/update from {ev.from_id}: {ev.data}: {e}"
-                    )
-                    return
-                # check if rq_data is an array, (if not, make it array of size 1) and that each element is a dict with the following:
-                rq_fields = ["domain", "time_jd_start", "data_type", "data"]
-                if not isinstance(rq_data, list):
-                    rq_data = [rq_data]
-                    self.log.warning(
-                        f"Non-array input to $trx/db/req/update from {ev.from_id}, converted to array of size 1"
-                    )
-                valid = True
-                inv_err = ""
-                ut_start = IndraTime.datetime_to_julian(
-                    datetime.datetime.now(tz=datetime.timezone.utc)
+            num_deleted = self.cur.rowcount
+            if num_deleted > 0:
+                job["num_deleted"] += num_deleted
+                self._partition_changed(table)
+            if job["chunk_size"] is not None and num_deleted >= job["chunk_size"]:
+                return False
+            job["tables"].pop(0)
+            if job["chunk_size"] is not None:
+                return len(job["tables"]) == 0
+        return True
+
+    def _delete_uuid4s_chunk(self, job: dict):
+        """Delete (a chunk of) the job's uuid4s with one statement per partition"""
+        if job["chunk_size"] is None:
+            uuid4s = job["uuid4s"]
+            job["uuid4s"] = []
+        else:
+            uuid4s = job["uuid4s"][: job["chunk_size"]]
+            job["uuid4s"] = job["uuid4s"][job["chunk_size"] :]
+        self.cur.execute("CREATE TEMP TABLE IF NOT EXISTS indra_del_uuid4s (uuid4 TEXT PRIMARY KEY);")
+        self.cur.execute("DELETE FROM temp.indra_del_uuid4s;")
+        self.cur.executemany(
+            "INSERT OR IGNORE INTO temp.indra_del_uuid4s (uuid4) VALUES (?);", [[x] for x in uuid4s]
+        )
+        for partition in self.partitions:
+            table = partition[2]
+            self.cur.execute(
+                f"""SELECT d.domain, e.time_jd_start FROM {table} e JOIN indra_domains d ON d.id = e.domain_id
+                    WHERE e.uuid4 IN temp.indra_del_uuid4s;"""
+            )
+            deleted_events = self.cur.fetchall()
+            if len(deleted_events) == 0:
+                continue
+            self.cur.execute(f"DELETE FROM {table} WHERE uuid4 IN temp.indra_del_uuid4s;")
+            job["num_deleted"] += self.cur.rowcount
+            self._partition_changed(table)
+            for domain, time_jd in deleted_events:
+                job["changed_domains"].add(domain)
+                if time_jd is not None and self._is_rollup_domain(domain):
+                    for resolution_sec in self.rollup_resolutions:
+                        job["stale_rollups"].add(
+                            (domain, resolution_sec, self._rollup_bucket(time_jd, resolution_sec))
+                        )
+        return len(job["uuid4s"]) == 0
+
+    def _delete_job_finish(self, job: dict):
+        """Bring rollups, domain statistics and the last-event cache in line with the deleted events"""
+        if len(job["domains"]) > 0:
+            for domain_id, domain in job["domains"].items():
+                self.last_cache.pop(domain, None)
+                if job["jd_start"] is None and job["jd_end"] is None:
+                    if self.domain_stats is not None:
+                        self.domain_stats.pop(domain, None)
+                    self.cur.execute("DELETE FROM indra_rollups WHERE domain_id = ?;", [domain_id])
+                    continue
+                self._domain_stats_refresh(domain)
+                if self._is_rollup_domain(domain) is False:
+                    continue
+                for resolution_sec in self.rollup_resolutions:
+                    # Buckets inside the time range are empty now, the boundary buckets are recomputed
+                    where_cmd = "domain_id = ? AND resolution_sec = ?"
+                    q_params = [domain_id, resolution_sec]
+                    for time_jd, op in [(job["jd_start"], ">"), (job["jd_end"], "<")]:
+                        if time_jd is not None:
+                            bucket = self._rollup_bucket(time_jd, resolution_sec)
+                            where_cmd += f" AND bucket {op} ?"
+                            q_params.append(bucket)
+                            job["stale_rollups"].add((domain, resolution_sec, bucket))
+                    self.cur.execute(f"DELETE FROM indra_rollups WHERE {where_cmd};", q_params)
+        for domain, resolution_sec, bucket in job["stale_rollups"]:
+            self._rollup_recompute_bucket(self._domain_id(domain), resolution_sec, bucket)
+        for domain in job["changed_domains"]:
+            self._domain_stats_refresh(domain)
+            self.last_cache.pop(domain, None)
+        if job["num_deleted"] > 0:
+            self._drop_unused_domains()
+
+    def _trx_update(self, ev: IndraEvent):
+        try:
+            rq_data = json.loads(ev.data)
+        except Exception as e:
+            self._trx_err(
+                ev, f"Invalid $trx/db/req/update from {ev.from_id}: {ev.data}: {e}"
+            )
+            return
+        # {"events": [...]} replies with the counts of inserted, updated, unchanged and ambiguous records,
+        # an array of records with the number of inserted and updated records.
+        reply_counts = False
+        if isinstance(rq_data, dict) and "events" in rq_data:
+            reply_counts = True
+            rq_data = rq_data["events"]
+        # check if rq_data is an array, (if not, make it array of size 1) and that each element is a dict with the following:
+        rq_fields = ["domain", "time_jd_start", "data_type", "data"]
+        if not isinstance(rq_data, list):
+            rq_data = [rq_data]
+            self.log.warning(
+                f"Non-array input to $trx/db/req/update from {ev.from_id}, converted to array of size 1"
+            )
+        valid = True
+        inv_err = ""
+        ut_start = IndraTime.datetime_to_julian(
+            datetime.datetime.now(tz=datetime.timezone.utc)
+        )
+        for rq in rq_data:
+            for field in rq_fields:
+                if field not in rq:
+                    valid = False
+                    inv_err = f"missing: {field} in {rq}"
+                    break
+            if valid is False:
+                break
+        if valid is False:
+            self._trx_err(
+                ev,
+                f"$trx/db/req/update from {ev.from_id} failed, request missing field {inv_err}",
+            )
+            return
+        try:
+            counts = self._update_events(rq_data, ev.from_id)
+            # An update can move a record to another domain
+            self._drop_unused_domains()
+            self._check_commit()
+        except sqlite3.Error as e:
+            self.conn.rollback()
+            # Interned ids and in-memory state may refer to the rolled back transaction
+            self.ingest_buffer = []
+            self.domain_ids = {}
+            self.data_type_ids = {}
+            self.last_cache.clear()
+            self._domain_stats_load()
+            self._trx_err(ev, f"$trx/db/req/update from {ev.from_id} failed: {e}")
+            return
+        self.log.info(f"Update from {ev.from_id}: {counts}")
+        rev = IndraEvent.reply_to(ev, self.name)
+        rev.time_jd_start = ut_start
+        rev.time_jd_end = IndraTime.datetime_to_julian(
+            datetime.datetime.now(tz=datetime.timezone.utc)
+        )
+        if reply_counts is True:
+            rev.data_type = "json/updatecounts"
+            rev.data = json.dumps(counts)
+        else:
+            rev.data_type = "number/int"
+            rev.data = json.dumps(counts["inserted"] + counts["updated"])
+        self.event_send(rev)
+
+    def _update_events(self, records: list, from_id: str):
+        """Insert or update records, matched by domain and time_jd_start
+
+        If epsilon is > 0, searches for julian time allow variation of epsilon while still being considered equal.
+        If epsilon is 0, searches for exact match of julian time.
+        The trade-off is: epsilon=0 will lead to duplicate entries on update, since the float conversions
+        between various languages and SQL are __not__ deterministic.
+        epsilon > 0 will falsely equal entries that are not equal, but are within epsilon of each other.
+
+        The records are matched set-wise: they are loaded into a temp table that is joined with each
+        overlapping partition on (domain_id, time_jd_start) ranges, which uses the partition index.
+        Changed events are deleted and written again together with the new events in one transaction.
+        Records that match more than one event are not updated.
+
+        :return: dict with the number of inserted, updated, unchanged and ambiguous records
+        """
+        counts = {"inserted": 0, "updated": 0, "unchanged": 0, "ambiguous": 0}
+        times = []
+        for rq in records:
+            if rq["time_jd_start"] is not None:
+                times.append(rq["time_jd_start"])
+                # New partitions are committed on creation, create them before the update transaction
+                self._partition_of(rq["time_jd_start"])
+        self.cur.execute(self.update_batch_table)
+        self.cur.execute("DELETE FROM temp.indra_update_batch;")
+        self.cur.executemany(
+            "INSERT INTO temp.indra_update_batch (n, domain, time_jd_start) VALUES (?, ?, ?);",
+            [
+                (n, rq["domain"], rq["time_jd_start"])
+                for n, rq in enumerate(records)
+                if rq["time_jd_start"] is not None
+            ],
+        )
+        if self.epsilon > 0:
+            time_cond = "e.time_jd_start > b.time_jd_start - :eps AND e.time_jd_start < b.time_jd_start + :eps"
+        else:
+            time_cond = "e.time_jd_start = b.time_jd_start"
+        # record index -> [(partition, event)] of the matching events
+        matches = {}
+        for jd_start, jd_end, table in self.partitions:
+            if (
+                len(times) == 0
+                or jd_end <= min(times) - self.epsilon
+                or jd_start >= max(times) + self.epsilon
+            ):
+                continue
+            result = self._query(
+                self.cur,
+                f"""SELECT b.n, e.id, d.domain, e.from_id, e.uuid4, e.parent_uuid4, e.seq_no,
+                       e.to_scope, e.time_jd_start, t.data_type, e.data, e.auth_hash, e.time_jd_end
+                    FROM temp.indra_update_batch b
+                    JOIN indra_domains d ON d.domain = b.domain
+                    JOIN {table} e ON e.domain_id = d.id AND {time_cond}
+                    JOIN indra_data_types t ON t.id = e.data_type_id;""",
+                {"eps": self.epsilon},
+            )
+            for row in result:
+                if row[0] not in matches:
+                    matches[row[0]] = []
+                matches[row[0]].append((table, dict(zip(self.event_columns, row[1:]))))
+
+        deleted_ids = {}
+        # (domain, resolution_sec, bucket) of the rollups of changed events
+        stale_rollups = set()
+        changed_domains = set()
+        for n, rq in enumerate(records):
+            found = matches.get(n, [])
+            if len(found) > 1:
+                # More than one record found, this is an error
+                self.log.error(
+                    f"Multiple records found for domain={rq['domain']} and time_jd_start={rq['time_jd_start']}, NOT UPDATED!"
                 )
-                for rq in rq_data:
-                    for field in rq_fields:
-                        if field not in rq:
-                            valid = False
-                            inv_err = f"missing: {field} in {rq}"
-                            break
-                    if valid is False:
-                        break
-                if valid is False:
-                    self._trx_err(
-                        ev,
-                        f"$trx/db/req/update from {ev.from_id} failed, request missing field {inv_err}",
-                    )
-                    return
-                num_updated = 0
-                for rq in rq_data:
-                    # Search for `domain` and `time_jd_start` and update all fields in rq. If not
-                    # found, insert a new record by creating a new IndraEvent() and then inserting all fields
-                    # NO % wildcard
-
-                    # Search for domain and time_jd_start:
-                    fields = ", ".join(columns)
-                    # If epsilon is > 0, searches for julian time allow variation of epsilon while still being considered equal.
-                    # If epsilon is 0, searches for exact match of julian time.
-                    # The trade-off is: epsilon=0 will lead to duplicate entries on update, since the float conversions
-                    # between various languages and SQL are __not__ deterministic.
-                    # epsilon > 0 will falsely equal entries that are not equal, but are within epsilon of each other.
-                    if self.epsilon > 0:
-                        sql_cmd = f"SELECT {fields} FROM indra_events WHERE domain = ? AND ABS(time_jd_start - ?) < {self.epsilon};"
+                counts["ambiguous"] += 1
+                continue
+            if len(found) == 0:
+                # Insert a new record
+                dev = IndraEvent().to_dict()
+                for key in rq:
+                    if key in dev:
+                        dev[key] = rq[key]
                     else:
-                        sql_cmd = f"SELECT {fields} FROM indra_events WHERE domain = ? AND time_jd_start = ?;"
-                    q_params = [rq["domain"], rq["time_jd_start"]]
-                    self.cur.execute(sql_cmd, q_params)
-                    result = self.cur.fetchall()
-                    # Check that exactly one record was found
-                    if len(result) == 1:
-                        changed = False
-                        # Update the record
-                        dev = dict(zip(columns, result[0]))
-                        for key in rq:
-                            if key in dev:
-                                if (
-                                    dev[key] != rq[key]
-                                    and key != "seq_no"
-                                    and key != "uuid4"
-                                ):
-                                    changed = True
-                                    self.log.info(
-                                        f"Updating {key} from {dev[key]} to {rq[key]} in {dev['uuid4']}"
-                                    )
-                                    dev[key] = rq[key]
-                            else:
-                                self.log.error(
-                                    f"Invalid field {key} in $trx/db/req/update from {ev.from_id}, ignored"
-                                )
-                        if changed is True:
-                            lev = IndraEvent.from_json(json.dumps(dev))
-                            # Write the updated record
-                            self.log.info(f"Updating {lev.uuid4}")
-                            if self._delete_event(lev.uuid4) is True:
-                                if self._write_event(lev) is True:
-                                    num_updated += 1
-                        else:
-                            self.log.info(
-                                f"No changes in {lev.uuid4}, not updated, rq from {ev.from_id}"
-                            )
-                    elif len(result) == 0:
-                        # Insert a new record
-                        dev = json.loads(IndraEvent().to_json())
-                        for key in rq:
-                            if key in dev:
-                                dev[key] = rq[key]
-                            else:
-                                self.log.error(
-                                    f"Invalid field {key} in $trx/db/req/update from {ev.from_id}, ignored"
-                                )
-                        lev = IndraEvent.from_json(json.dumps(dev))
-                        if self._write_event(lev) is True:
-                            num_updated += 1
+                        self.log.error(
+                            f"Invalid field {key} in $trx/db/req/update from {from_id}, ignored"
+                        )
+                counts["inserted"] += 1
+            else:
+                table, dev = found[0]
+                changed = False
+                for key in rq:
+                    if key in dev:
+                        if dev[key] != rq[key] and key != "seq_no" and key != "uuid4":
+                            changed = True
                     else:
-                        # More than one record found, this is an error
                         self.log.error(
-                            f"Multiple records found for domain={rq['domain']} and time_jd_start={rq['time_jd_start']}, NOT UPDATED!"
+                            f"Invalid field {key} in $trx/db/req/update from {from_id}, ignored"
                         )
-                self._check_commit()
-                self.unique_domains_cache = None
-                rev = IndraEvent()
-                rev.domain = ev.from_id
-                rev.from_id = self.name
-                rev.uuid4 = ev.uuid4
-                rev.to_scope = ev.domain
-                rev.time_jd_start = ut_start
-                rev.time_jd_end = IndraTime.datetime_to_julian(
-                    datetime.datetime.now(tz=datetime.timezone.utc)
-                )
-                rev.data_type = "number/int"
-                rev.data = json.dumps(num_updated)
-                self.event_send(rev)
+                if changed is False:
+                    counts["unchanged"] += 1
+                    continue
+                if table not in deleted_ids:
+                    deleted_ids[table] = []
+                deleted_ids[table].append(dev.pop("id"))
+                changed_domains.add(dev["domain"])
+                if dev["time_jd_start"] is not None and self._is_rollup_domain(dev["domain"]):
+                    for resolution_sec in self.rollup_resolutions:
+                        stale_rollups.add(
+                            (
+                                dev["domain"],
+                                resolution_sec,
+                                self._rollup_bucket(dev["time_jd_start"], resolution_sec),
+                            )
+                        )
+                for key in rq:
+                    if key in dev and key != "seq_no" and key != "uuid4":
+                        dev[key] = rq[key]
+                changed_domains.add(dev["domain"])
+                counts["updated"] += 1
+            self.last_state["last_seq_no"] = self.last_state["last_seq_no"] + 1
+            dev["seq_no"] = self.last_state["last_seq_no"]
+            self.ingest_buffer.append(dev)
+
+        self.cur.execute("CREATE TEMP TABLE IF NOT EXISTS indra_update_ids (id INTEGER PRIMARY KEY);")
+        for table in deleted_ids:
+            self.cur.execute("DELETE FROM temp.indra_update_ids;")
+            self.cur.executemany(
+                "INSERT INTO temp.indra_update_ids (id) VALUES (?);",
+                [[x] for x in deleted_ids[table]],
+            )
+            self.cur.execute(f"DELETE FROM {table} WHERE id IN temp.indra_update_ids;")
+            self._partition_changed(table)
+        # Rollups, statistics and last events without the old values, the new values are added by the flush
+        for domain, resolution_sec, bucket in stale_rollups:
+            self._rollup_recompute_bucket(self._domain_id(domain), resolution_sec, bucket)
+        for domain in changed_domains:
+            self._domain_stats_refresh(domain)
+            self.last_cache.pop(domain, None)
+        if self._flush_ingest_buffer() is False:
+            self.log.error(f"Not all records of $trx/db/req/update from {from_id} were written")
+        return counts
+
+    def trx(self, ev: IndraEvent):
+        if ev.domain.startswith("$trx/db"):
+            if ev.domain == "$trx/db/req/history":
+                self._read_request(self._trx_history, ev)
+            elif ev.domain == "$trx/db/req/last":
+                self._trx_last(ev)
+            elif ev.domain == "$trx/db/req/uniquedomains":
+                self._read_request(self._trx_uniquedomains, ev)
+            elif ev.domain == "$trx/db/req/del":
+                self._trx_del(ev)
+            elif ev.domain == "$trx/db/req/update":
+                self._trx_update(ev)
             else:
                 self._trx_err(ev, f"$trx/db not (yet!) implemented: {ev.domain}")
         elif ev.domain.startswith("$trx/kv"):
@@ -1120,11 +3540,7 @@ class IndraProcess(IndraProcessCore):
                     )
                     return
                 if self._write_update_kv(rq_data["key"], rq_data["value"]) is True:
-                    rev = IndraEvent()
-                    rev.domain = ev.from_id
-                    rev.from_id = self.name
-                    rev.uuid4 = ev.uuid4
-                    rev.to_scope = ev.domain
+                    rev = IndraEvent.reply_to(ev, self.name)
                     rev.time_jd_start = IndraTime.datetime_to_julian(
                         datetime.datetime.now(tz=datetime.timezone.utc)
                     )
@@ -1164,11 +3580,7 @@ class IndraProcess(IndraProcessCore):
                     return
                 values = self._read_kv(rq_data["key"])
                 if values is not None:
-                    rev = IndraEvent()
-                    rev.domain = ev.from_id
-                    rev.from_id = self.name
-                    rev.uuid4 = ev.uuid4
-                    rev.to_scope = ev.domain
+                    rev = IndraEvent.reply_to(ev, self.name)
                     rev.time_jd_start = IndraTime.datetime_to_julian(
                         datetime.datetime.now(tz=datetime.timezone.utc)
                     )
@@ -1205,41 +3617,14 @@ class IndraProcess(IndraProcessCore):
                         f"$trx/kv/req/verify from {ev.from_id} failed, request missing field {inv_err}",
                     )
                     return
-                if self._verify_kv(rq_data["key"], rq_data["value"]) is True:
-                    rev = IndraEvent()
-                    rev.domain = ev.from_id
-                    rev.from_id = self.name
-                    rev.uuid4 = ev.uuid4
-                    rev.to_scope = ev.domain
-                    rev.time_jd_start = IndraTime.datetime_to_julian(
-                        datetime.datetime.now(tz=datetime.timezone.utc)
-                    )
-                    rev.time_jd_end = IndraTime.datetime_to_julian(
-                        datetime.datetime.now(tz=datetime.timezone.utc)
-                    )
-                    rev.data_type = "string"
-                    rev.data = json.dumps("OK")
-                    if ev.domain == "$trx/kv/req/login":
-                        rev.auth_hash = self._create_session(
-                            key=rq_data["key"], from_id=ev.from_id
-                        )
-                    self.event_send(rev)
-                else:
-                    self._trx_err(
-                        ev,
-                        f"$trx/kv/req/verify from {ev.from_id} failed, verify failed",
-                    )
+                self._trx_verify(ev, rq_data["key"], rq_data["value"])
             elif ev.domain == "$trx/kv/req/logout":
                 self.log.info(
                     f"Logout request from {ev.from_id}, session {ev.auth_hash}"
                 )
                 session_id = ev.auth_hash
                 if self._remove_session(session_id, ev.from_id) is True:
-                    rev = IndraEvent()
-                    rev.domain = ev.from_id
-                    rev.from_id = self.name
-                    rev.uuid4 = ev.uuid4
-                    rev.to_scope = ev.domain
+                    rev = IndraEvent.reply_to(ev, self.name)
                     rev.time_jd_start = IndraTime.datetime_to_julian(
                         datetime.datetime.now(tz=datetime.timezone.utc)
                     )
@@ -1280,11 +3665,7 @@ class IndraProcess(IndraProcessCore):
                     return
                 cnt = self._delete_kv(rq_data["key"])
                 if cnt > 0:
-                    rev = IndraEvent()
-                    rev.domain = ev.from_id
-                    rev.from_id = self.name
-                    rev.uuid4 = ev.uuid4
-                    rev.to_scope = ev.domain
+                    rev = IndraEvent.reply_to(ev, self.name)
                     rev.time_jd_start = IndraTime.datetime_to_julian(
                         datetime.datetime.now(tz=datetime.timezone.utc)
                     )
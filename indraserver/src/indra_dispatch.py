@@ -3,7 +3,7 @@ import datetime
 import uuid
 import copy
 
-from indralib.indra_event import IndraEvent  # type: ignore
+from indralib.indra_event import IndraEvent, SubscriptionPattern  # type: ignore
 from indralib.indra_time import IndraTime  # type: ignore
 from indra_serverlib import IndraProcessCore
 
@@ -49,11 +49,7 @@ class IndraProcess(IndraProcessCore):
 
     def _trx_err(self, ev: IndraEvent, err_msg: str):
         self.log.error(err_msg)
-        rev = IndraEvent()
-        rev.domain = ev.from_id
-        rev.from_id = self.name
-        rev.uuid4 = ev.uuid4
-        rev.to_scope = ev.domain
+        rev = IndraEvent.reply_to(ev, self.name)
         rev.time_jd_start = IndraTime.datetime_to_julian(
             datetime.datetime.now(tz=datetime.timezone.utc)
         )
@@ -65,7 +61,7 @@ class IndraProcess(IndraProcessCore):
         self.event_send(rev)
 
     def outbound(self, ev: IndraEvent):
-        if IndraEvent.mqcmp(ev.domain, "$interactive/session/#"):
+        if SubscriptionPattern.compile("$interactive/session/#").match(ev.domain):
             comps = ev.domain.split("/")
             if len(comps) != 4:
                 self.log.error(f"Invalid $interactive/session event: {ev.domain}")
@@ -116,7 +112,7 @@ class IndraProcess(IndraProcessCore):
             else:
                 self.log.error(f"Invalid $interactive/session event: {ev.domain}")
                 return
-        elif IndraEvent.mqcmp(ev.domain, "$trx/cs/#"):
+        elif SubscriptionPattern.compile("$trx/cs/#").match(ev.domain):
             try:
                 chat_cmd = json.loads(ev.data)
             except json.JSONDecodeError:
@@ -169,11 +165,7 @@ class IndraProcess(IndraProcessCore):
                     }
                     session_id = str(uuid.uuid4())
                     self.chat_sessions[session_id] = session
-                rev = IndraEvent()
-                rev.domain = ev.from_id
-                rev.from_id = self.name
-                rev.uuid4 = ev.uuid4
-                rev.to_scope = ev.domain
+                rev = IndraEvent.reply_to(ev, self.name)
                 rev.time_jd_start = IndraTime.datetime_to_julian(
                     datetime.datetime.now(tz=datetime.timezone.utc)
                 )
@@ -202,11 +194,7 @@ class IndraProcess(IndraProcessCore):
                     )
                     return
                 del self.chat_sessions[session_id]
-                rev = IndraEvent()
-                rev.domain = ev.from_id
-                rev.from_id = self.name
-                rev.uuid4 = ev.uuid4
-                rev.to_scope = ev.domain
+                rev = IndraEvent.reply_to(ev, self.name)
                 rev.time_jd_start = IndraTime.datetime_to_julian(
                     datetime.datetime.now(tz=datetime.timezone.utc)
                 )
@@ -220,11 +208,7 @@ class IndraProcess(IndraProcessCore):
                 user_sessions = []
                 for user_session in self.user_sessions:
                     user_sessions.append(user_session["user"])
-                rev = IndraEvent()
-                rev.domain = ev.from_id
-                rev.from_id = self.name
-                rev.uuid4 = ev.uuid4
-                rev.to_scope = ev.domain
+                rev = IndraEvent.reply_to(ev, self.name)
                 rev.time_jd_start = IndraTime.datetime_to_julian(
                     datetime.datetime.now(tz=datetime.timezone.utc)
                 )
@@ -238,7 +222,7 @@ class IndraProcess(IndraProcessCore):
                 self.log.error(f"Invalid session command: {chat_cmd['cmd']}")
                 self._trx_err(ev, f"Invalid session command: {chat_cmd['cmd']}")
 
-        elif IndraEvent.mqcmp(ev.domain, "$event/chat/#"):
+        elif SubscriptionPattern.compile("$event/chat/#").match(ev.domain):
             try:
                 chat_msg = json.loads(ev.data)
             except json.JSONDecodeError:
@@ -340,7 +324,7 @@ class IndraProcess(IndraProcessCore):
                 self.event_send(rev)
 
             self.distribute(ev, cur_session, participants)
-        elif IndraEvent.mqcmp(ev.domain, f"{self.name}/annotate/#"):
+        elif SubscriptionPattern.compile(f"{self.name}/annotate/#").match(ev.domain):
             if ev.domain == f"{self.name}/annotate/sentiment":
                 key = ev.uuid4 + "-sentiment"
                 if key in self.async_dist:
@@ -1,7 +1,7 @@
 import paho.mqtt.client as mq  # type: ignore
 import json
 
-from indralib.indra_event import IndraEvent  # type: ignore
+from indralib.indra_event import IndraEvent, SubscriptionPattern, SubscriptionPatternSet  # type: ignore
 
 from indra_serverlib import IndraProcessCore
 
@@ -31,9 +31,11 @@ class IndraProcess(IndraProcessCore):
         self.mqtt_port = config_data["mqtt_port"]
         self.mqtt_keepalive = config_data["mqtt_keepalive"]
         self.raw_mqtt_subscriptions = config_data["raw_mqtt_subscriptions"]
+        self.raw_mqtt_patterns = SubscriptionPatternSet(self.raw_mqtt_subscriptions)
         self.outbound_prefix = config_data["outbound_prefix"]
         parsers = config_data["inbound_parsers"]
         self.inbound_parsers = {}
+        self.inbound_parser_patterns = SubscriptionPatternSet()
         # XXX: import externaly defined parsers at some point
         for pars in parsers:
             if len(pars) != 2:
@@ -50,6 +52,7 @@ class IndraProcess(IndraProcessCore):
                     continue
                 else:
                     self.inbound_parsers[pars[0]] = m_op
+                    self.inbound_parser_patterns.add(pars[0])
                     self.log.info(f"Added inbound parser {pars[0]} -> {pars[1]}")
         parsers = config_data["outbound_parsers"]
         self.outbound_parsers = {}
@@ -83,16 +86,14 @@ class IndraProcess(IndraProcessCore):
 
     def on_message(self, client, userdata, msg):
         self.log.debug(f"MQTT message received: {msg.topic}, {msg.payload}")
-        for sub in self.raw_mqtt_subscriptions:
-            if IndraEvent.mqcmp(msg.topic, sub) is True:
-                ev = IndraEvent()
-                ev.domain = "mqtt/" + msg.topic
-                ev.from_id = self.name
-                ev.data = msg.payload
-                self.event_send(ev)
-        for sub in self.inbound_parsers:
-            if IndraEvent.mqcmp(msg.topic, sub) is True:
-                self.inbound_parsers[sub](msg.topic, msg.payload)
+        for sub in self.raw_mqtt_patterns.match(msg.topic):
+            ev = IndraEvent()
+            ev.domain = "mqtt/" + msg.topic
+            ev.from_id = self.name
+            ev.data = msg.payload
+            self.event_send(ev)
+        for sub in self.inbound_parser_patterns.match(msg.topic):
+            self.inbound_parsers[sub](msg.topic, msg.payload)
 
     def inbound_init(self):
         self.mq_client = mq.Client(mq.CallbackAPIVersion.VERSION1)
@@ -200,7 +201,7 @@ class IndraProcess(IndraProcessCore):
             },
         }
         self.log.debug(f"inbound-parser-muwerk: {topic}, {message}")
-        if IndraEvent.mqcmp(topic, "omu/+/+/sensor/+"):
+        if SubscriptionPattern.compile("omu/+/+/sensor/+").match(topic):
             self.log.debug(f"Checking sensor: {topic}, {message}")
             ti = topic.split("/")
             if len(ti) != 5:
@@ -217,7 +218,7 @@ class IndraProcess(IndraProcessCore):
             factor = 1.0
             found = False
             for cl in cont_locs:
-                if IndraEvent.mqcmp(topic, cl):
+                if SubscriptionPattern.compile(cl).match(topic):
                     if measurement in cont_locs[cl]["measurements"]:
                         tmp_loc = cont_locs[cl]["location"]
                         o_measurement = cont_locs[cl]["measurements"][measurement][
@@ -304,7 +305,7 @@ class IndraProcess(IndraProcessCore):
             ),
         ]
         for topic_i in topic_list:
-            if IndraEvent.mqcmp(topic, topic_i[0]) is True:
+            if SubscriptionPattern.compile(topic_i[0]).match(topic) is True:
                 ev = IndraEvent()
                 ev.domain = f"$event/measurement/{topic_i[1]}/{topic_i[2]}/{topic_i[3]}"
                 ev.from_id = f"{self.name}/{topic_i[0]}"
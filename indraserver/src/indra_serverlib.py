@@ -14,7 +14,122 @@ except ModuleNotFoundError:  # Python 3.10 and older:
     import tomli as tomllib  # type: ignore
 import sys
 
-from indralib.indra_event import IndraEvent  # type: ignore
+from indralib.indra_event import IndraEvent, SubscriptionPattern, SubscriptionPatternSet  # type: ignore
+
+
+class IndraSubscriptionTrie:
+    def __init__(self):
+        """Segment-level topic trie that maps a published domain to subscribed modules
+
+        Subscriptions are split at '/' once on insert, '+' and '#' are stored as
+        wildcard nodes. A lookup walks the domain segments and returns the set of
+        modules with at least one matching subscription, semantics are identical
+        to IndraEvent.mqcmp(). Subscriptions that use wildcards within a segment
+        (e.g. 'ab+') and domains with empty segments (e.g. 'a//b'), which mqcmp()
+        compares character-wise, fall back to mqcmp().
+        Subscriptions are reference counted per (module, subscription), so that
+        the trie only grows with the number of distinct subscriptions, independent
+        of how many sessions of a module subscribe to the same domain.
+        """
+        self.root = {"children": {}, "modules": {}}
+        self.subs = {}
+        self.irregular = set()
+
+    @staticmethod
+    def _segments(sub: str):
+        return SubscriptionPattern.split_pattern(sub)
+
+    def add(self, module: str, sub: str):
+        """Add a reference to subscription `sub` for `module`, returns the new reference count"""
+        if sub not in self.subs:
+            self.subs[sub] = {}
+        if module in self.subs[sub]:
+            self.subs[sub][module] += 1
+            return self.subs[sub][module]
+        self.subs[sub][module] = 1
+        segs = self._segments(sub)
+        if segs is None:
+            self.irregular.add(sub)
+            return 1
+        node = self.root
+        for seg in segs:
+            if seg not in node["children"]:
+                node["children"][seg] = {"children": {}, "modules": {}}
+            node = node["children"][seg]
+        # different subscriptions can end in the same node (e.g. 'a/#' and 'a/#/b')
+        node["modules"][module] = node["modules"].get(module, 0) + 1
+        return 1
+
+    def remove(self, module: str, sub: str):
+        """Remove a reference to subscription `sub` of `module`, returns the remaining reference count or -1, if `sub` didn't exist"""
+        if sub not in self.subs or module not in self.subs[sub]:
+            return -1
+        self.subs[sub][module] -= 1
+        if self.subs[sub][module] > 0:
+            return self.subs[sub][module]
+        del self.subs[sub][module]
+        if len(self.subs[sub]) == 0:
+            del self.subs[sub]
+            self.irregular.discard(sub)
+        segs = self._segments(sub)
+        if segs is None:
+            return 0
+        path = [self.root]
+        for seg in segs:
+            path.append(path[-1]["children"][seg])
+        path[-1]["modules"][module] -= 1
+        if path[-1]["modules"][module] == 0:
+            del path[-1]["modules"][module]
+        # prune empty branches
+        for index in range(len(segs), 0, -1):
+            node = path[index]
+            if len(node["modules"]) > 0 or len(node["children"]) > 0:
+                break
+            del path[index - 1]["children"][segs[index - 1]]
+        return 0
+
+    def ref_count(self, module: str, sub: str):
+        """Number of references of `module` to subscription `sub`"""
+        if sub not in self.subs:
+            return 0
+        return self.subs[sub].get(module, 0)
+
+    def has_subscription(self, prefix: str):
+        """Check if any module holds a subscription that starts with `prefix`"""
+        for sub in self.subs:
+            if sub.startswith(prefix):
+                return True
+        return False
+
+    def match(self, domain: str):
+        """Return the set of modules that are subscribed to `domain`"""
+        targets = set()
+        if "+" in domain or "#" in domain:
+            return targets
+        segs = domain.split("/")
+        if "" in segs:
+            for sub in self.subs:
+                if IndraEvent.mqcmp(domain, sub) is True:
+                    targets.update(self.subs[sub])
+            return targets
+        n_segs = len(segs)
+        stack = [(self.root, 0)]
+        while len(stack) > 0:
+            node, index = stack.pop()
+            if index == n_segs:
+                targets.update(node["modules"])
+                continue
+            children = node["children"]
+            if "#" in children:
+                targets.update(children["#"]["modules"])
+            if segs[index] in children:
+                stack.append((children[segs[index]], index + 1))
+            if "+" in children:
+                stack.append((children["+"], index + 1))
+        for sub in self.irregular:
+            if IndraEvent.mqcmp(domain, sub) is True:
+                targets.update(self.subs[sub])
+        return targets
 
 
 class IndraServerLog:
@@ -94,6 +209,11 @@ class IndraProcessCore:
         In 'dual' mode, an additional thread is started for handling inbound() events. [pingpong]
         In 'async' mode, an async runtime is started and the instance needs to implent async_init(),
         async_outbound() and async_shutdown() [Example: async_http]
+        Optionally, outgoing events can be batched: if config_data contains `batch_max_events` > 1,
+        events sent within `batch_max_delay_sec` (default 0.01) are coalesced into one transfer
+        (a list for 'queue', a multipart message for 'zmq'), up to `batch_max_events` events.
+        For 'zmq' transport, config_data `wire_codec` selects the event encoding: 'json' (default)
+        or the compact binary 'msgpack' (requires the msgpack module).
         """
         self.name = config_data["name"]
         self.transports = ["zmq", "queue"]
@@ -119,6 +239,22 @@ class IndraProcessCore:
             self.event_queue = event_queue
             self.zmq_event_socket = None
             self.zmq_send_socket = None
+        if "batch_max_events" in config_data:
+            self.batch_max_events = config_data["batch_max_events"]
+        else:
+            self.batch_max_events = 0
+        if "batch_max_delay_sec" in config_data:
+            self.batch_max_delay_sec = config_data["batch_max_delay_sec"]
+        else:
+            self.batch_max_delay_sec = 0.01
+        # Batching is started in launcher(), the instance is pickled before for 'queue' transport
+        self.event_batch = None
+        # ZMQ sockets are not thread-safe, worker threads of a module share the send socket
+        self.event_send_lock = None
+        if "wire_codec" in config_data:
+            self.wire_codec = config_data["wire_codec"]
+        else:
+            self.wire_codec = "json"
         self.log = IndraServerLog(
             self.name,
             transport,
@@ -126,6 +262,14 @@ class IndraProcessCore:
             self.event_queue,
             self.zmq_event_socket,
         )
+        if self.wire_codec not in IndraEvent.wire_codecs:
+            self.log.error(
+                f"Invalid wire_codec={self.wire_codec}, valid are {IndraEvent.wire_codecs}, using 'json'"
+            )
+            self.wire_codec = "json"
+        elif self.wire_codec == "msgpack" and IndraEvent.msgpack_available() is False:
+            self.log.error("wire_codec=msgpack requires the msgpack module, using 'json'")
+            self.wire_codec = "json"
         self.bActive = True
         self.shutdown_timer = False
         self.config_data = config_data
@@ -159,19 +303,89 @@ class IndraProcessCore:
 
     def event_send(self, ev):
         """Send an event to the event queue"""
+        if self.event_batch is not None:
+            with self.event_batch_lock:
+                self.event_batch.append(ev)
+                if len(self.event_batch) >= self.batch_max_events:
+                    evs = self.event_batch
+                    self.event_batch = []
+                    self._event_send_batch(evs)
+            return
         if self.transport == "zmq":
-            self.zmq_event_socket.send_json(ev.to_dict())
+            if self.event_send_lock is not None:
+                with self.event_send_lock:
+                    self.zmq_event_socket.send(self._zmq_frame(ev))
+            else:
+                self.zmq_event_socket.send(self._zmq_frame(ev))
         else:
             self.event_queue.put(ev)
 
+    def _zmq_frame(self, ev):
+        if self.wire_codec == "msgpack":
+            return ev.to_msgpack()
+        return json.dumps(ev.to_dict()).encode("utf-8")
+
+    def _event_send_batch(self, evs):
+        if self.transport == "zmq":
+            frames = [self._zmq_frame(ev) for ev in evs]
+            if self.event_send_lock is not None:
+                with self.event_send_lock:
+                    self.zmq_event_socket.send_multipart(frames)
+            else:
+                self.zmq_event_socket.send_multipart(frames)
+        else:
+            self.event_queue.put(evs)
+
+    def flush_events(self):
+        """Send all events that are waiting in the batch buffer"""
+        if self.event_batch is None:
+            return
+        with self.event_batch_lock:
+            if len(self.event_batch) > 0:
+                evs = self.event_batch
+                self.event_batch = []
+                self._event_send_batch(evs)
+
+    def _start_event_batching(self):
+        self.event_batch_lock = threading.Lock()
+        self.event_batch = []
+        self.event_batch_thread = threading.Thread(
+            target=self._event_batch_worker,
+            name=self.name + "_event_batch_worker",
+            args=[],
+            daemon=True,
+        )
+        self.event_batch_thread.start()
+        self.log.info(
+            f"Event batching active, max {self.batch_max_events} events or {self.batch_max_delay_sec} sec"
+        )
+
+    def _event_batch_worker(self):
+        while self.bActive is True:
+            time.sleep(self.batch_max_delay_sec)
+            self.flush_events()
+
+    @staticmethod
+    def _unpack_events(item):
+        """Events arrive either one by one or as batch-list"""
+        if item is None:
+            return []
+        if isinstance(item, list) is True:
+            return item
+        return [item]
+
     def event_send_self(self, ev):
         """Send an event to the send queue (incoming to self)"""
         if self.transport == "zmq":
-            self.zmq_send_socket.send_json(ev.to_dict())  # XXX Does this work?
+            self.zmq_send_socket.send(self._zmq_frame(ev))  # XXX Does this work?
         else:
             self.send_queue.put(ev)
 
     def launcher(self):
+        if self.transport == "zmq":
+            self.event_send_lock = threading.Lock()
+        if self.batch_max_events > 1:
+            self._start_event_batching()
         if self.mode == "dual":
             self.sender = threading.Thread(
                 target=self.send_worker,
@@ -268,24 +482,28 @@ class IndraProcessCore:
         while self.bActive is True:
             if self.transport == "zmq":
                 try:
-                    msg = self.zmq_send_socket.recv()
+                    frames = self.zmq_send_socket.recv_multipart()
                 except zmq.error.Again:
-                    msg = None
-                    ev = None
+                    frames = []
                     if self.zmq_send_socket.closed is True:
                         self.log.info("{self.name} ZMQ thread terminated")
                         self.zmq_send_socket.close()
                         exit(0)
-                if msg is not None:
-                    ev = IndraEvent.from_json(msg)
-                else:
-                    ev = None
+                evs = []
+                for frame in frames:
+                    try:
+                        evs.append(IndraEvent.from_wire(frame))
+                    except Exception as e:
+                        # Only the malformed event of a batch is dropped
+                        self.log.error(f"{self.name}: invalid event received, ignored: {e}")
             else:
                 try:
-                    ev = self.send_queue.get(timeout=0.1)
+                    evs = self._unpack_events(self.send_queue.get(timeout=0.1))
                 except queue.Empty:
-                    ev = None
-            if ev is not None:
+                    evs = []
+            if len(evs) == 0 and outbound_active is True:
+                self.outbound_idle()
+            for ev in evs:
                 # self.log.info(f"EVENT {ev.domain} at {self.name}")
                 if self.state_cache is not None:
                     self._update_state_cache(ev)
@@ -294,19 +512,33 @@ class IndraProcessCore:
                 if ev.domain == "$cmd/quit":
                     self.shutdown_timer = True
                     self.shutdown()
+                    self.flush_events()
                     self.log.debug(f"{self.name} terminating receive_worker...")
                     self.bActive = False
                     self.log.info(f"Terminating process {self.name}")
                     exit(0)
                 else:
                     if outbound_active is True:
-                        self.outbound(ev)
+                        try:
+                            self.outbound(ev)
+                        except Exception as e:
+                            # A failing event must not terminate the module or the rest of its batch
+                            self.log.error(
+                                f"{self.name}: failed to process {ev.domain} from {ev.from_id}: {e}"
+                            )
                     else:
                         self.log.warning(
                             f"Ignoring cmd, inactive: {ev.domain} from {ev.from_id}"
                         )
+            if len(evs) > 0 and outbound_active is True and self._send_queue_drained():
+                self.outbound_idle()
         self.log.debug(f"{self.name} termination of receive_worker")
-        return
+
+    def _send_queue_drained(self):
+        """True if no further events are waiting to be received"""
+        if self.transport == "zmq":
+            return self.zmq_send_socket.poll(0, zmq.POLLIN) == 0
+        return self.send_queue.empty()
 
     def outbound_init(self):
         """This function can optionally be overriden for init-purposes, needs to return True to start outbound()"""
@@ -316,6 +548,10 @@ class IndraProcessCore:
         """This function receives an IndraEvent object that is to be transmitted outbound"""
         self.log.error(f"Process {self.name} doesn't override outbound function!")
 
+    def outbound_idle(self):
+        """This function can optionally be overriden, it is called when no event arrived within the receive timeout, or all received events were processed, active in 'single' and 'dual' mode"""
+        pass
+
     def async_rt_worker(self):
         asyncio.run(self.in_out_bound())
 
@@ -325,16 +561,17 @@ class IndraProcessCore:
         await self.async_init()
         while bActive is True:
             if self.send_queue.empty() is False:
-                ev = self.send_queue.get()
-                if ev.domain == "$cmd/quit":
-                    self.shutdown_timer = True
-                    await self.async_shutdown()
-                    self.log.info("Terminating async handler")
-                    return
-                else:
-                    if self.state_cache is not None:
-                        self._update_state_cache(ev)
-                    await self.async_outbound(ev)
+                for ev in self._unpack_events(self.send_queue.get()):
+                    if ev.domain == "$cmd/quit":
+                        self.shutdown_timer = True
+                        await self.async_shutdown()
+                        self.flush_events()
+                        self.log.info("Terminating async handler")
+                        return
+                    else:
+                        if self.state_cache is not None:
+                            self._update_state_cache(ev)
+                        await self.async_outbound(ev)
             else:
                 await asyncio.sleep(0.05)
 
@@ -383,12 +620,20 @@ class IndraProcessCore:
         return True
 
     def get_last_event(self, domain):
+        """Request the latest event of `domain`, or of each domain if `domain` is a list.
+
+        The reply to a list request is a `json/indraevents` map domain -> event (or null)."""
         ev = IndraEvent()
         ev.domain = "$trx/db/req/last"
         ev.from_id = self.name
-        rq_data = {
-            "domain": domain,
-        }
+        if isinstance(domain, list):
+            rq_data = {
+                "domains": domain,
+            }
+        else:
+            rq_data = {
+                "domain": domain,
+            }
         ev.data = json.dumps(rq_data)
         ev.data_type = "json/rq_data"
         self.event_send(ev)
@@ -615,17 +860,16 @@ class IndraProcessCore:
 
     def _init_state_cache(self, subscriptions):
         self.state_cache = {}
-        self.state_cache_subscriptions = subscriptions
+        self.state_cache_subscriptions = SubscriptionPatternSet(subscriptions)
         for sub in subscriptions:
             self.log.info(f"State_cache subscription {sub}")
             self.subscribe(sub)
 
     def _update_state_cache(self, ev):
-        for sub in self.state_cache_subscriptions:
-            if IndraEvent.mqcmp(ev.domain, sub) is True:
-                self.state_cache[ev.domain] = ev.__dict__
-                # self.log.info(f"State cache updated: {ev.domain}")
-                return
+        if self.state_cache_subscriptions.match_any(ev.domain) is True:
+            self.state_cache[ev.domain] = ev.to_dict()
+            # self.log.info(f"State cache updated: {ev.domain}")
+            return
         # self.log.info(f"State cache NOT updated: {ev.domain}")
 
     def get_state_cache(self, domain):
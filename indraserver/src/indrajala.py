@@ -14,6 +14,7 @@ import threading
 import json
 import time
 import signal
+from collections import deque
 # from pyzmq:
 import zmq  # type: ignore
 import shlex
@@ -25,20 +26,51 @@ except ModuleNotFoundError:  # Python 3.10 and older:
     import tomli as tomllib  # type: ignore
 
 from indralib.indra_event import IndraEvent  # type: ignore
+from indra_serverlib import IndraSubscriptionTrie
 
 INDRAJALA_VERSION = "0.1.0"
 
 
+def _zmq_frame(module_data, ev):
+    """Encode an event for a ZMQ module with the module's configured `wire_codec`"""
+    if (
+        module_data["config_data"].get("wire_codec", "json") == "msgpack"
+        and IndraEvent.msgpack_available() is True
+    ):
+        return ev.to_msgpack()
+    return json.dumps(ev.to_dict()).encode("utf-8")
+
+
+def _send_batched_routes(main_logger, modules, batched_routes):
+    """Send events that were routed to batch-enabled modules as one transfer per module"""
+    for module in batched_routes:
+        evs = batched_routes[module]
+        if len(evs) == 0:
+            continue
+        batched_routes[module] = []
+        if modules[module]["mode"] == "queue":
+            modules[module]["send_queue"].put(evs)
+        elif modules[module]["mode"] == "zeromq":
+            if modules[module]["push_socket"] is not None:
+                modules[module]["push_socket"].send_multipart(
+                    [_zmq_frame(modules[module], ev) for ev in evs]
+                )
+            else:
+                main_logger.error(
+                    f"ZMQ socket for {module} not available, cannot send {len(evs)} batched events"
+                )
+
+
 def main_runner(main_logger, event_queue, modules):
     global abort_zmq_thread
-    subs = {}
+    # Reference-counted subscriptions per (module, subscription)
+    sub_trie = IndraSubscriptionTrie()
 
     for module in modules:
         default_subs = ["$cmd/quit", f"{module}/#"]
-        subs[module] = []
         for sub in default_subs:
-            if sub not in subs[module]:
-                subs[module].append(sub)
+            if sub_trie.ref_count(module, sub) == 0:
+                sub_trie.add(module, sub)
 
     for module in modules:
         if modules[module]["mode"] == "queue":
@@ -66,6 +98,13 @@ def main_runner(main_logger, event_queue, modules):
     overview_mode = False
     qsize_implemented = True
     sysstat_subs = False
+    # Events arrive one by one or as batch-list from modules with `batch_max_events` > 1,
+    # events of one incoming batch that route to batch-enabled modules are sent as one batch.
+    pending_events = deque()
+    batched_routes = {}
+    for module in modules:
+        if modules[module]["config_data"].get("batch_max_events", 0) > 1:
+            batched_routes[module] = []
     while terminate_main_runner is False:
         if time.time() - stat_timer > 1.0:
             if qsize_implemented:
@@ -94,14 +133,23 @@ def main_runner(main_logger, event_queue, modules):
                     )
             stat_timer = time.time()
         ev = None
-        while stop_timer is not None and event_queue.empty():
-            if time.time() > stop_timer:
-                terminate_main_runner = True
+        if len(pending_events) == 0:
+            _send_batched_routes(main_logger, modules, batched_routes)
+            while stop_timer is not None and event_queue.empty():
+                if time.time() > stop_timer:
+                    terminate_main_runner = True
+                    break
+                time.sleep(0.1)
+            if terminate_main_runner is True:
                 break
-            time.sleep(0.1)
-        if terminate_main_runner is True:
-            break
-        ev = event_queue.get()
+            item = event_queue.get()
+            if isinstance(item, list) is True:
+                pending_events.extend(item)
+            else:
+                pending_events.append(item)
+            if len(pending_events) == 0:
+                continue
+        ev = pending_events.popleft()
         # main_logger.info(f"Got event: {ev.to_json()}")
 
         origin_module = ev.from_id
@@ -121,6 +169,7 @@ def main_runner(main_logger, event_queue, modules):
         elif ev.domain.startswith("$cmd"):
             if ev.domain == "$cmd/quit":
                 stop_timer = time.time() + 0.5
+                _send_batched_routes(main_logger, modules, batched_routes)
                 for module in modules:
                     if modules[module]["mode"] == "queue":
                         main_logger.debug(
@@ -137,36 +186,48 @@ def main_runner(main_logger, event_queue, modules):
                             f"Module {module} has no valid mode {modules[module]['mode']}, cannot send termination cmd"
                         )
             elif ev.domain == "$cmd/subs":
+                if origin_module not in modules:
+                    main_logger.error(
+                        f"Subscription request by unknown module {origin_module}, ignored"
+                    )
+                    continue
                 sub_list = json.loads(ev.data)
                 if isinstance(sub_list, list) is True:
                     for sub in sub_list:
                         if sub is not None:
                             if sub.startswith("$sys/stat"):
                                 sysstat_subs = True
-                            # if sub not in subs[origin_module]:  # XXX different sessions can sub to the same thing, alternative would be reference counting...
-                            subs[origin_module].append(sub)
-                            main_logger.info(f"Subscribing to {sub} by {origin_module}")
+                            # different sessions can sub to the same thing, reference counted:
+                            ref_cnt = sub_trie.add(origin_module, sub)
+                            main_logger.info(
+                                f"Subscribing to {sub} by {origin_module}, references: {ref_cnt}"
+                            )
                         else:
                             main_logger.error(
                                 f"Invalid subscription {sub} requested by {origin_module}"
                             )
             elif ev.domain == "$cmd/unsubs":
+                if origin_module not in modules:
+                    main_logger.error(
+                        f"Unsubscription request by unknown module {origin_module}, ignored"
+                    )
+                    continue
                 sub_list = json.loads(ev.data)
                 if isinstance(sub_list, list) is True:
                     for sub in sub_list:
                         if sub is not None:
-                            if sub in subs[origin_module]:
-                                subs[origin_module].remove(sub)
+                            ref_cnt = sub_trie.remove(origin_module, sub)
+                            if ref_cnt >= 0:
                                 main_logger.debug(
-                                    f"Unsubscribing from {sub} by {origin_module}"
+                                    f"Unsubscribing from {sub} by {origin_module}, references: {ref_cnt}"
+                                )
+                            else:
+                                main_logger.warning(
+                                    f"Unsubscription from {sub} by {origin_module}, but no subscription exists"
                                 )
                             if sub.startswith("$sys/stat"):
-                                sysstat_subs = False
                                 # Check if subscriber to sysstat is still active
-                                for module in subs:
-                                    for sub in subs[module]:
-                                        if sub.startswith("$sys/stat"):
-                                            sysstat_subs = True
+                                sysstat_subs = sub_trie.has_subscription("$sys/stat")
                         else:
                             main_logger.error(
                                 f"Invalid unsubscription {sub} requested by {origin_module}"
@@ -176,85 +237,79 @@ def main_runner(main_logger, event_queue, modules):
                     f"Unknown command {ev.domain} received from {ev.from_id}, ignored."
                 )
         else:
-            mod_found = False
+            mod_found = origin_module in modules
             route_target = False
-            for module in modules:
-                if module == origin_module:
-                    mod_found = True
-                if module != origin_module or True:
-                    for sub in subs[module]:
-                        if IndraEvent.mqcmp(ev.domain, sub) is True:
-                            dt = time.time() - last_msg
-                            if dt_mean == 0:
-                                dt_mean = dt
-                            avger = 100.0
-                            dt_mean = ((avger - 1.0) * dt_mean + dt) / avger
-                            if dt_mean > 0.0:
-                                msg_sec = 1.0 / dt_mean
-                            else:
-                                msg_sec = 0.0
-                            last_msg = time.time()
-                            if msg_sec < 10.0:
-                                if overview_mode is True:
-                                    main_logger.info(
-                                        "Switching back to single-message ROUTE infos, due to reduced message volume"
-                                    )
-                                    overview_mode = False
-                                if time.time() - last_stat_output > 1.0:
-                                    if sysstat_subs is True:
-                                        # Only send statistics, if there is a subscriber
-                                        ev_stat = IndraEvent()
-                                        ev_stat.domain = "$sys/stat/msgpersec"
-                                        ev_stat.data_type = "Float"
-                                        ev_stat.from_id = "indrajala"
-                                        ev_stat.data = json.dumps(msg_sec)
-                                        # main_logger.info(f"JD-Time: {ev.time_jd_start}")
-                                        event_queue.put(ev_stat)
-                                    last_stat_output = time.time()
-                                main_logger.info(
-                                    f"ROUTE {ev.domain[:30]}={ev.data[:10]} to {module}, {msg_sec:0.2f} msg/s, que: {unprocessed_items}"
-                                )
-                            else:
-                                if overview_mode is False:
-                                    overview_mode = True
-                                    main_logger.info(
-                                        "Switching to ROUTE summary mode for routing, message volume > 10msg/sec"
-                                    )
-                                # main_logger.info(
-                                #     f"ROUTE {ev.domain[:30]}={ev.data[:10]} to {module}, {msg_sec:0.2f} msg/s, que: {unprocessed_items}"
-                                # )
-                                if time.time() - last_stat_output > 1.0:
-                                    main_logger.info(
-                                        f"ROUTE summary {msg_sec:0.2f} msg/sec, queued: {unprocessed_items}"
-                                    )
-                                    if sysstat_subs is True:
-                                        # Only send statistics, if there is a subscriber
-                                        ev_stat = IndraEvent()
-                                        ev_stat.domain = "$sys/stat/msgpersec"
-                                        ev_stat.data_type = "Float"
-                                        ev_stat.from_id = "indrajala"
-                                        ev_stat.data = json.dumps(msg_sec)
-                                        event_queue.put(ev_stat)
-                                    last_stat_output = time.time()
-                            if modules[module]["mode"] == "queue":
-                                modules[module]["send_queue"].put(ev)
-                            elif modules[module]["mode"] == "zeromq":
-                                if modules[module]["push_socket"] is not None:
-                                    modules[module]["push_socket"].send_json(
-                                        ev.to_dict()
-                                    )
-                                else:
-                                    main_logger.error(
-                                        f"ZMQ socket for {module} not available, cannot send event {ev.domain}"
-                                    )
-                            else:
-                                main_logger.error(
-                                    f"Module {module} has no valid mode {modules[module]['mode']}, cannot route event {ev.domain}"
-                                )
-                            route_target = True
-                            break
+            for module in sub_trie.match(ev.domain):
+                dt = time.time() - last_msg
+                if dt_mean == 0:
+                    dt_mean = dt
+                avger = 100.0
+                dt_mean = ((avger - 1.0) * dt_mean + dt) / avger
+                if dt_mean > 0.0:
+                    msg_sec = 1.0 / dt_mean
                 else:
-                    mod_found = True
+                    msg_sec = 0.0
+                last_msg = time.time()
+                if msg_sec < 10.0:
+                    if overview_mode is True:
+                        main_logger.info(
+                            "Switching back to single-message ROUTE infos, due to reduced message volume"
+                        )
+                        overview_mode = False
+                    if time.time() - last_stat_output > 1.0:
+                        if sysstat_subs is True:
+                            # Only send statistics, if there is a subscriber
+                            ev_stat = IndraEvent()
+                            ev_stat.domain = "$sys/stat/msgpersec"
+                            ev_stat.data_type = "Float"
+                            ev_stat.from_id = "indrajala"
+                            ev_stat.data = json.dumps(msg_sec)
+                            # main_logger.info(f"JD-Time: {ev.time_jd_start}")
+                            event_queue.put(ev_stat)
+                        last_stat_output = time.time()
+                    main_logger.info(
+                        f"ROUTE {ev.domain[:30]}={ev.data[:10]} to {module}, {msg_sec:0.2f} msg/s, que: {unprocessed_items}"
+                    )
+                else:
+                    if overview_mode is False:
+                        overview_mode = True
+                        main_logger.info(
+                            "Switching to ROUTE summary mode for routing, message volume > 10msg/sec"
+                        )
+                    # main_logger.info(
+                    #     f"ROUTE {ev.domain[:30]}={ev.data[:10]} to {module}, {msg_sec:0.2f} msg/s, que: {unprocessed_items}"
+                    # )
+                    if time.time() - last_stat_output > 1.0:
+                        main_logger.info(
+                            f"ROUTE summary {msg_sec:0.2f} msg/sec, queued: {unprocessed_items}"
+                        )
+                        if sysstat_subs is True:
+                            # Only send statistics, if there is a subscriber
+                            ev_stat = IndraEvent()
+                            ev_stat.domain = "$sys/stat/msgpersec"
+                            ev_stat.data_type = "Float"
+                            ev_stat.from_id = "indrajala"
+                            ev_stat.data = json.dumps(msg_sec)
+                            event_queue.put(ev_stat)
+                        last_stat_output = time.time()
+                if module in batched_routes:
+                    batched_routes[module].append(ev)
+                elif modules[module]["mode"] == "queue":
+                    modules[module]["send_queue"].put(ev)
+                elif modules[module]["mode"] == "zeromq":
+                    if modules[module]["push_socket"] is not None:
+                        modules[module]["push_socket"].send(
+                            _zmq_frame(modules[module], ev)
+                        )
+                    else:
+                        main_logger.error(
+                            f"ZMQ socket for {module} not available, cannot send event {ev.domain}"
+                        )
+                else:
+                    main_logger.error(
+                        f"Module {module} has no valid mode {modules[module]['mode']}, cannot route event {ev.domain}"
+                    )
+                route_target = True
             if mod_found is False and ev.from_id != "indrajala":
                 main_logger.error(
                     f"Task {origin_module} not found, {origin_module} did not set from_id correctly"
@@ -313,16 +368,27 @@ def _handle_zmq_messages(socket):
     main_logger.info("ZMQ thread started")
     while True:
         try:
-            msg = socket.recv()
+            frames = socket.recv_multipart()
         except zmq.error.Again:
             if socket.closed or abort_zmq_thread is True:
                 main_logger.info("ZMQ thread terminated")
                 socket.close()
                 return
             continue
-        # main_logger.info(f"ZMQ message received: {msg}")
-        ev = IndraEvent.from_json(msg)
-        event_queue.put(ev)
+        # main_logger.info(f"ZMQ message received: {frames}")
+        # frames are JSON or binary (msgpack) encoded, depending on the module's wire_codec
+        evs = []
+        for frame in frames:
+            try:
+                evs.append(IndraEvent.from_wire(frame))
+            except Exception as e:
+                # Only the malformed event of a batch is dropped
+                main_logger.error(f"Invalid ZMQ message received: {e}")
+        if len(evs) == 1:
+            event_queue.put(evs[0])
+        elif len(evs) > 1:
+            # multipart messages are batches of events
+            event_queue.put(evs)
 
 
 def _create_zmq(zmq_port):
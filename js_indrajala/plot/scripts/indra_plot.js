@@ -478,7 +478,7 @@ function plotPage(currentUser) {
                     if (plotStartTimeOffset !== null) {
                         startTime = IndraTime.datetimeNowToJulian() - plotStartTimeOffset;
                     }
-                    getHistory(curSubscription, startTime, null, 1000, "Sample", (data) => { measurementEvent(data, 0, curSubscription); });
+                    getHistory(curSubscription, startTime, null, 1000, "LTTB", (data) => { measurementEvent(data, 0, curSubscription); });
                     subscribe(curSubscription, (data) => { measurementEvent(data, 1); });
                 }
             }